@@ -0,0 +1,121 @@
+from asyncio import to_thread
+from io import BytesIO
+from sys import stderr
+from flask import request
+from flask_app import app, ENDPOINTS, RESPONSE_CACHE, get_params
+from src.async_client import close_sessions
+from src.helpers import gen_response, responds_async
+from src.response_cache import RESPONSES
+from src.routes import alerts_async, current_async, reverse_async
+
+# ASGI mode: uvicorn asgi_app:asgi --port 5000 (one process keeps thousands of upstream
+# requests in flight). GET routes run on the event loop with the sync app's hooks, routing and
+# validation; everything else (POST, /batch, /metrics, docs) is passed to the Flask app
+
+
+def threaded(route):
+    # Returns an async route running a @responds route's raw function in a worker thread, for
+    # routes whose upstream clients or work don't have a non-blocking version
+    return responds_async(lambda **params: to_thread(route.__wrapped__, **params))
+
+ASYNC_ENDPOINTS = {
+    "geo": {"forward": threaded(ENDPOINTS["geo"]["forward"]), "reverse": reverse_async},
+    "wx": {
+        "alerts": alerts_async,
+        "almanac": threaded(ENDPOINTS["wx"]["almanac"]),
+        "current": current_async,
+        "forecast": threaded(ENDPOINTS["wx"]["forecast"]),
+        "hourly": threaded(ENDPOINTS["wx"]["hourly"]),
+    },
+}
+
+
+async def dispatcher(resource, route):
+    # flask_app.dispatcher for ASYNC_ENDPOINTS
+    params = get_params(route, request.args.to_dict())
+    if type(params) == str: return gen_response(params)
+
+    if RESPONSE_CACHE:
+        return await RESPONSES.respond_async(resource, route, params, ASYNC_ENDPOINTS[resource][route], request.if_none_match)
+
+    return await ASYNC_ENDPOINTS[resource][route](**params)
+
+async def dispatch(environ, resource, route):
+    # Returns the Flask response to a GET of an ASYNC_ENDPOINTS route, running the app's
+    # request hooks and error handling around dispatcher like Flask.wsgi_app
+    with app.request_context(environ):
+        try:
+            try:
+                rv = app.preprocess_request()
+                if rv is None: rv = await dispatcher(resource, route)
+            except Exception as e: rv = app.handle_user_exception(e)
+
+            return app.finalize_request(rv)
+        except Exception as e: return app.handle_exception(e)
+
+def call_wsgi(wsgi, environ):
+    # Returns (status, headers, body) from a WSGI app (or response) called with environ
+    out = {}
+    def start_response(status, headers, exc_info=None): out.update(status=int(status.split()[0]), headers=headers)
+
+    chunks = wsgi(environ, start_response)
+    try: body = b"".join(chunks)
+    finally:
+        if hasattr(chunks, "close"): chunks.close()
+
+    return out["status"], out["headers"], body
+
+def to_environ(scope, body):
+    # Returns the WSGI environ for an ASGI HTTP scope and its request body
+    root, path = scope.get("root_path", ""), scope["path"]
+    server, client = scope.get("server") or ("localhost", 80), scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"], "SCRIPT_NAME": root.encode().decode("latin1"),
+        "PATH_INFO": (path[len(root):] if path.startswith(root) else path).encode().decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"), "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "SERVER_NAME": server[0], "SERVER_PORT": str(server[1] or 80), "REMOTE_ADDR": client[0], "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0), "wsgi.url_scheme": scope.get("scheme", "http"), "wsgi.input": BytesIO(body),
+        "wsgi.errors": stderr, "wsgi.multithread": True, "wsgi.multiprocess": True, "wsgi.run_once": False
+    }
+
+    # Repeated headers are joined with commas
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value.decode('latin1')}" if key in environ else value.decode("latin1")
+
+    return environ
+
+async def lifespan(receive, send):
+    # Closes the upstream sessions on shutdown
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup": await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_sessions()
+            return await send({"type": "lifespan.shutdown.complete"})
+
+async def asgi(scope, receive, send):
+    if scope["type"] == "lifespan": return await lifespan(receive, send)
+    if scope["type"] != "http": return
+
+    chunks, more = [], True
+    while more:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more = message.get("more_body", False)
+
+    environ = to_environ(scope, b"".join(chunks))
+    parts = environ["PATH_INFO"].split("/")
+
+    # Answer GET routes on the loop, the rest in a thread (the Flask app blocks)
+    if scope["method"] == "GET" and len(parts) == 3 and parts[2] in ASYNC_ENDPOINTS.get(parts[1], {}):
+        status, headers, body = call_wsgi(await dispatch(environ, *parts[1:]), environ)
+    else: status, headers, body = await to_thread(call_wsgi, app, environ)
+
+    await send({
+        "type": "http.response.start", "status": status,
+        "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers]
+    })
+    await send({"type": "http.response.body", "body": body})
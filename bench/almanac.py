@@ -0,0 +1,64 @@
+from datetime import datetime as dt, timedelta as tdelta
+from random import Random
+from time import perf_counter
+from zoneinfo import ZoneInfo
+import ephem
+
+from src.almanac_mthds import get_lunar, get_solar, lunar_dates, lunar_table, solar_table
+from src.helpers import get_sun, get_tz, icon_wx, sun_on
+
+# Checks the memoized almanac tables against the per-request computations they replaced
+# for random US points and dates, then times cold vs warm requests
+# Run from the repo root: python -m bench.almanac
+
+def get_solar_ref(lat, lon, tz, date):
+    msg, days = [], [date, date + tdelta(days=1)]
+    for day in days:
+        s = get_sun(float(lat), float(lon), day)
+        msg.append({
+            "wday": day.strftime("%A"), "tz": day.tzname(),
+            "rise": s["sunrise"].strftime("%I:%M %p") if s else None,
+            "set": s["sunset"].strftime("%I:%M %p") if s else None,
+        })
+    return msg
+
+def get_lunar_ref(lat, lon, tz, date):
+    data = sorted([
+        ("New", ephem.next_new_moon(ephem.Date(date.date()))),
+        ("First", ephem.next_first_quarter_moon(ephem.Date(date.date()))),
+        ("Full", ephem.next_full_moon(ephem.Date(date.date()))),
+        ("Last", ephem.next_last_quarter_moon(ephem.Date(date.date()))),
+    ], key=lambda x: x[1])
+    return [{
+        "date": ephem.to_timezone(d, tz).strftime("%b %#d"), "icon": icon_wx(lat, lon, p)["icon"], "phase": p
+    } for p, d in data]
+
+def almanac(f_solar, f_lunar, points, dates):
+    # Returns the solar and lunar data and mean ms per request for points on dates
+    start, out = perf_counter(), []
+    for (lat, lon, tz), date in zip(points, dates):
+        local = date.astimezone(tz)
+        out.append((f_solar(lat, lon, tz, local), f_lunar(lat, lon, tz, local)))
+    return out, 1000 * (perf_counter() - start) / len(points)
+
+def clear():
+    for f in (solar_table, lunar_table, lunar_dates, sun_on): f.cache_clear()
+
+
+if __name__ == "__main__":
+    rnd = Random(1)
+    points = [(rnd.uniform(25, 49), rnd.uniform(-124, -67)) for _ in range(2000)]
+    points = [(lat, lon, ZoneInfo(get_tz(lat, lon))) for lat, lon in points if get_tz(lat, lon)]
+    dates = [dt(2026, 3, 1, tzinfo=ZoneInfo("UTC")) + tdelta(hours=rnd.randint(0, 24 * 60)) for _ in points]
+
+    clear()
+    ref, ref_ms = almanac(get_solar_ref, get_lunar_ref, points, dates)
+    clear()
+    cold, cold_ms = almanac(get_solar, get_lunar, points, dates)
+    warm, warm_ms = almanac(get_solar, get_lunar, points, dates)
+
+    mismatches = [i for i in range(len(points)) if cold[i] != ref[i] or warm[i] != ref[i]]
+    print(f"{len(points)} requests: per-request {ref_ms:.3f}ms, tables cold {cold_ms:.3f}ms, "
+          f"warm {warm_ms:.3f}ms ({ref_ms / warm_ms:.0f}x), {len(mismatches)} mismatches")
+
+    if mismatches: exit(1)
@@ -0,0 +1,143 @@
+from asyncio import Semaphore, gather, run as run_async
+from concurrent.futures import ThreadPoolExecutor
+from os import environ, path
+from subprocess import PIPE, Popen
+from sys import executable
+from tempfile import mkdtemp
+from time import perf_counter
+
+# Checks that the ASGI app (asgi_app.asgi) answers every GET route with the same status,
+# body bytes and headers as the Flask app against bench/server.py, starting each mode from
+# empty last good, geocode and alert state. Then compares /wx/current throughput of the two
+# under upstream latency: Flask with a thread per request vs. one event loop with as many
+# requests in flight as clients. The stand-in runs in its own process for that so its
+# threads don't hold up the loop's thread on the GIL
+# Run from the repo root: python -m bench.asgi_parity [requests] [latency secs] [clients]
+
+WORK_DIR = mkdtemp(prefix="rainbow-asgi-")
+environ.update({
+    "NBM_DIR": path.join(WORK_DIR, "nbm"), "GEOCODE_DB": path.join(WORK_DIR, "geocode.sqlite"), "RESPONSE_CACHE": "0"
+})
+environ.setdefault("MAPS_KEY", "AIzaBenchmarkKeyForTheLocalStandInServer")
+environ.setdefault("PERSONAL_USER_AGENT", "{'User-Agent': 'rainbow-rest-bench'}")
+environ.setdefault("SYNOPTIC_TOKEN", "bench")
+
+from bench import server
+
+UPSTREAMS = server.start()
+
+import httpx
+
+from asgi_app import asgi
+from flask_app import app
+from src.alerts_store import ALERTS
+from src.async_client import close_sessions
+from src.client import stats
+from src.geocode_cache import GEOCODES
+from src.helpers import URLS
+from src.last_good import LAST_GOOD
+
+# Unknown routes raise KeyError in both modes (logged as 500s)
+app.logger.disabled = True
+
+BASE = "http://127.0.0.1:5000"
+POINTS = [(39.65, -104.99), (40.01, -105.27), (41.1, -95.1)]
+
+# (path, query) of each GET route, plus invalid params and an unknown route
+REQUESTS = [
+    *[(f"/wx/{route}", {"lat": lat, "lon": lon}) for route in ("current", "alerts", "almanac", "forecast", "hourly") for lat, lon in POINTS],
+    *[("/geo/reverse", {"lat": lat, "lon": lon}) for lat, lon in POINTS],
+    ("/geo/forward", {"address": "Englewood CO"}), ("/wx/forecast", {"lat": 39.65, "lon": -104.99, "days": 7}),
+    ("/wx/hourly", {"lat": 39.65, "lon": -104.99, "hours": 48}), ("/wx/current", {"lat": 95, "lon": 0}),
+    ("/wx/hourly", {"lat": 39.65, "lon": -104.99, "hours": 0}), ("/wx/nope", {"lat": 39.65, "lon": -104.99})
+]
+
+# Headers that differ between any two requests
+VARYING = {"server-timing", "date"}
+
+def reset():
+    # Empties the state requests fill so each mode starts cold
+    LAST_GOOD.entries.clear()
+    ALERTS.points, ALERTS.zones, ALERTS.texts = {}, {}, {}
+    with GEOCODES.conn() as conn: conn.execute("DELETE FROM geocode")
+
+def sync_get(url, query):
+    with app.test_client() as client: response = client.get(url, query_string=query, base_url=BASE)
+    headers = {k.lower(): v for k, v in response.headers.items() if k.lower() not in VARYING}
+    return response.status_code, headers, response.get_data()
+
+async def async_get(client, url, query):
+    response = await client.get(url, params=query)
+    headers = {k.lower(): v for k, v in response.headers.items() if k.lower() not in VARYING}
+    return response.status_code, headers, response.content
+
+def asgi_client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi), base_url=BASE, timeout=60)
+
+def parity():
+    reset()
+    sync = [sync_get(url, query) for url, query in REQUESTS]
+
+    reset()
+    async def main():
+        async with asgi_client() as client: out = [await async_get(client, url, query) for url, query in REQUESTS]
+        await close_sessions()
+        return out
+    asgi_out = run_async(main())
+
+    bad = [(url, query, a[0], b[0]) for (url, query), a, b in zip(REQUESTS, sync, asgi_out) if a != b]
+    for url, query, a, b in bad: print(f"  mismatch {url} {query}: sync {a}, asgi {b}")
+    print(f"parity: {len(REQUESTS)} requests, {len(bad)} mismatches, statuses {sorted({s[0] for s in sync})}")
+
+    return not bad
+
+def errors():
+    return sum([v["errors"] for v in stats().values()])
+
+def throughput(n, latency, clients):
+    # Returns whether n /wx/current requests for distinct points all succeeded without
+    # upstream errors in both modes, printing each mode's requests/sec
+    stand_in = Popen([executable, "-m", "bench.server", str(latency)], stdout=PIPE, text=True)
+    urls, base = dict(URLS), stand_in.stdout.readline().split()[3]
+    URLS.update({k: base + v for k, v in server.PATHS.items()})
+
+    points = [(30 + (i % 150) * 0.1, -110 + (i // 150) * 0.1) for i in range(n)]
+    query = lambda p: {"lat": round(p[0], 2), "lon": round(p[1], 2)}
+
+    reset()
+    start, before = perf_counter(), errors()
+    with ThreadPoolExecutor(max_workers=32) as pool: sync = list(pool.map(lambda p: sync_get("/wx/current", query(p))[0], points))
+    sync_rps, sync_errors = n / (perf_counter() - start), errors() - before
+
+    reset()
+    async def main():
+        limit = Semaphore(clients)
+        async def get(client, p):
+            async with limit: return (await async_get(client, "/wx/current", query(p)))[0]
+
+        async with asgi_client() as client:
+            start = perf_counter()
+            out = await gather(*[get(client, p) for p in points])
+            secs = perf_counter() - start
+        await close_sessions()
+        return out, secs
+    before = errors()
+    asgi_statuses, secs = run_async(main())
+    asgi_rps, asgi_errors = n / secs, errors() - before
+
+    stand_in.terminate()
+    URLS.update(urls)
+    print(f"/wx/current x{n} at {1e3 * latency:.0f} ms upstream latency: flask (32 threads) {sync_rps:.0f} req/s "
+          f"{dict((s, sync.count(s)) for s in set(sync))} {sync_errors} upstream errors, asgi ({clients} clients) "
+          f"{asgi_rps:.0f} req/s {dict((s, asgi_statuses.count(s)) for s in set(asgi_statuses))} {asgi_errors} upstream errors "
+          f"({asgi_rps / sync_rps:.1f}x)")
+
+    return set(sync) == set(asgi_statuses) == {200} and not sync_errors and not asgi_errors
+
+
+if __name__ == "__main__":
+    from sys import argv
+    ok = parity()
+    args = [f(x) for f, x in zip((int, float, int), argv[1:])]
+    ok &= throughput(*args, *(600, 0.1, 128)[len(args):])
+    if not ok: exit(1)
@@ -0,0 +1,100 @@
+from asyncio import gather, run as run_async
+from os import environ, path
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Barrier, Thread
+
+# Bursts of identical /wx/current, /wx/alerts and /wx/forecast requests (a metro area's users
+# on its geocoded center) against bench/server.py, each from cold last good, alert and NBM
+# bulletin state, with single flight on and off, through the Flask app (a thread per
+# request) and the ASGI app. Prints the upstream calls each burst cost and the coalescing
+# ratio. Forecast bursts already cost one probe/download per product and cycle (BULLETINS
+# holds a lock per product while it discovers cycles); they're shown for comparison
+# Run from the repo root: python -m bench.coalesce [burst size] [latency secs]
+
+WORK_DIR = mkdtemp(prefix="rainbow-coalesce-")
+environ.update({
+    "NBM_DIR": path.join(WORK_DIR, "nbm"), "GEOCODE_DB": path.join(WORK_DIR, "geocode.sqlite"), "RESPONSE_CACHE": "0"
+})
+environ.setdefault("MAPS_KEY", "AIzaBenchmarkKeyForTheLocalStandInServer")
+environ.setdefault("PERSONAL_USER_AGENT", "{'User-Agent': 'rainbow-rest-bench'}")
+environ.setdefault("SYNOPTIC_TOKEN", "bench")
+
+from bench import server
+
+UPSTREAMS = server.start()
+
+import httpx
+
+import src.client
+from asgi_app import asgi
+from flask_app import app
+from src.alerts_store import ALERTS
+from src.async_client import close_sessions
+from src.client import FLIGHTS
+from src.last_good import LAST_GOOD
+from src.nbm_store import BULLETINS
+
+BASE = "http://127.0.0.1:5000"
+CENTER = {"lat": 39.7392, "lon": -104.9903}
+ROUTES = ("current", "alerts", "forecast")
+
+def reset():
+    LAST_GOOD.entries.clear()
+    ALERTS.points, ALERTS.zones, ALERTS.texts = {}, {}, {}
+    BULLETINS.ready.clear(), BULLETINS.cycles.clear(), BULLETINS.missing.clear()
+    rmtree(BULLETINS.dir, ignore_errors=True)
+    FLIGHTS.__init__()
+    UPSTREAMS.counts.clear()
+
+def burst_sync(route, n):
+    # Returns the statuses of n requests released at once from their own threads
+    barrier, statuses = Barrier(n), []
+
+    def get():
+        barrier.wait()
+        with app.test_client() as client: statuses.append(client.get(f"/wx/{route}", query_string=CENTER, base_url=BASE).status_code)
+
+    threads = [Thread(target=get) for _ in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    return statuses
+
+def burst_asgi(route, n):
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi), base_url=BASE, timeout=60) as client:
+            out = await gather(*[client.get(f"/wx/{route}", params=CENTER) for _ in range(n)])
+        await close_sessions()
+        return [r.status_code for r in out]
+
+    return run_async(main())
+
+def run(n, latency):
+    UPSTREAMS.latency, ok = latency, True
+
+    for mode, burst in (("flask", burst_sync), ("asgi", burst_asgi)):
+        for route in ROUTES:
+            costs = {}
+            for single_flight in (False, True):
+                src.client.SINGLE_FLIGHT = single_flight
+                reset()
+                statuses = burst(route, n)
+                calls = {k: v for k, v in sorted(UPSTREAMS.counts.items())}
+                costs[single_flight] = (sum(calls.values()), calls, FLIGHTS.stats()["ratio"], set(statuses))
+
+            (off, off_calls, _, off_status), (on, on_calls, ratio, on_status) = costs[False], costs[True]
+            print(f"{mode} /wx/{route} x{n}: {off} upstream calls {off_calls} -> {on} {on_calls} with single flight, "
+                  f"ratio {ratio}, statuses {off_status | on_status}")
+
+            # Each key's call is made once per burst with single flight (and bursts still succeed)
+            ok &= on_status == off_status == {200}
+            if route != "forecast": ok &= all([v <= 2 for v in on_calls.values()])
+
+    UPSTREAMS.latency = 0
+    return ok
+
+
+if __name__ == "__main__":
+    from sys import argv
+    if not run(int(argv[1]) if len(argv) > 1 else 50, float(argv[2]) if len(argv) > 2 else 0.2): exit(1)
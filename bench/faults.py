@@ -0,0 +1,127 @@
+from os import environ, path
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+
+# Runs the app against bench/server.py with faults injected into its upstreams. It checks
+# that points with last good results are answered at once and marked X-Stale, that points
+# without are answered at the deadline without the slow source, that open breakers fail
+# fast with the upstream's CODES error, and that breakers close again once upstreams
+# recover. Run from the repo root: python -m bench.faults
+
+WORK_DIR = mkdtemp(prefix="rainbow-faults-")
+environ.update({
+    "NBM_DIR": path.join(WORK_DIR, "nbm"), "GEOCODE_DB": path.join(WORK_DIR, "geocode.sqlite"),
+    "RESPONSE_CACHE": "0", "BREAKER_FAILURES": "3", "BREAKER_RESET": "2", "NBM_POLL_EVERY": "3600",
+    "CURRENT_DEADLINE": "1.5"
+})
+environ.setdefault("MAPS_KEY", "AIzaBenchmarkKeyForTheLocalStandInServer")
+environ.setdefault("PERSONAL_USER_AGENT", "{'User-Agent': 'rainbow-rest-bench'}")
+environ.setdefault("SYNOPTIC_TOKEN", "bench")
+
+from bench import server
+
+UPSTREAMS = server.start()
+
+from flask_app import app
+from src.client import BREAKERS, UPSTREAMS as CONFIG
+from src.current_mthds import CURRENT_DEADLINE
+from src.helpers import CODES
+from src.last_good import FRESH, LAST_GOOD
+from src.nbm_store import BULLETINS
+
+# Points with (WARM) and without (COLD) last good results
+WARM, COLD = (39.65, -104.99), [(35.0 + i, -100.0) for i in range(8)]
+
+def request(path, query):
+    # Returns (response, ms) of a GET request
+    start = perf_counter()
+    with app.test_client() as client: response = client.get(path, query_string=query, base_url="http://127.0.0.1:5000")
+    return response, round(1e3 * (perf_counter() - start), 1)
+
+def get(route, point, **args):
+    # Returns (status, ms, X-Stale header) of a GET request
+    response, ms = request(f"/wx/{route}", {"lat": point[0], "lon": point[1], **args})
+    return response.status_code, ms, response.headers.get("X-Stale")
+
+def check(name, ok, detail):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}: {detail}")
+    return ok
+
+def run():
+    results = []
+
+    # Warm up the point, then make every last good result stale so it's served marked
+    results.append(check("warm", get("current", WARM)[0] == 200 and get("forecast", WARM)[0] == 200, "current and forecast 200"))
+    FRESH.clear()
+
+    # Outage: NDFD and Synoptic answer 503 (after retries)
+    UPSTREAMS.fault("ndfd", 503), UPSTREAMS.fault("syn", 503)
+    status, ms, stale = get("current", WARM)
+    results.append(check("outage, last good", status == 200 and stale and "ndfd" in stale, f"{status} in {ms} ms, X-Stale: {stale}"))
+
+    cold = [get("current", p) for p in COLD]
+    results.append(check("outage, no last good", all([c[0] == 523 for c in cold]), f"{[c[:2] for c in cold]}"))
+    fast = [c[1] for c in cold[len(cold) // 2:]]
+    results.append(check("breaker open", BREAKERS["ndfd"].opened is not None and max(fast) < min([c[1] for c in cold[:1]]),
+                         f"ndfd {BREAKERS['ndfd'].stats()}, first {cold[0][1]} ms, then {fast} ms"))
+
+    # Slow period: NDFD answers after 2 secs, past a 0.5 sec read timeout
+    UPSTREAMS.fault("ndfd"), UPSTREAMS.fault("syn")
+    sleep(BREAKERS["ndfd"].reset)
+    get("current", COLD[0])
+    CONFIG["ndfd"]["timeout"], timeout = (0.5, 0.5), CONFIG["ndfd"]["timeout"]
+    UPSTREAMS.fault("ndfd", delay=2)
+
+    status, ms, stale = get("current", WARM)
+    results.append(check("slow, last good", status == 200 and stale and ms < 500, f"{status} in {ms} ms, X-Stale: {stale}"))
+    # Without last good results NDFD (slower than the deadline, within its timeout) is left out
+    CONFIG["ndfd"]["timeout"] = timeout
+    UPSTREAMS.fault("ndfd", delay=2 * CURRENT_DEADLINE)
+    slow, ms = request("/wx/current", {"lat": COLD[-1][0], "lon": COLD[-1][1]})
+
+    # Recovery: the next call after the reset secs closes the breaker
+    UPSTREAMS.fault("ndfd")
+    sleep(BREAKERS["ndfd"].reset)
+    status, rec_ms, stale = get("current", COLD[1])
+
+    # The full answer for the slow point (NDFD's late result is its last good one by now)
+    full = request("/wx/current", {"lat": COLD[-1][0], "lon": COLD[-1][1]})[0].get_json()
+    # (NDFD's fields are filled from the other sources or left empty, so they differ from it)
+    slow, partial = slow.get_json() if slow.status_code == 200 else None, []
+    if slow: partial = [k for k, v in full.items() if k != "stations" and slow[k] != v]
+    results.append(check(
+        "slow, no last good", slow and ms < 1e3 * (CURRENT_DEADLINE + 0.25) and partial and slow["stations"] and
+        sorted(slow["stations"]) == sorted(full["stations"]), f"200 in {ms} ms without NDFD's {partial}, stations {slow and slow['stations']}"
+    ))
+    results.append(check("recovered", status == 200 and BREAKERS["ndfd"].opened is None, f"{status} in {rec_ms} ms, ndfd {BREAKERS['ndfd'].stats()}"))
+
+    # NOMADS down: forecasts keep coming from the ready cycle, marked stale
+    UPSTREAMS.fault("nbm", 503)
+    BULLETINS.poll()
+    status, ms, stale = get("forecast", WARM)
+    results.append(check("nbm outage", status == 200 and stale and "nbm" in stale, f"{status} in {ms} ms, X-Stale: {stale}"))
+    UPSTREAMS.fault("nbm")
+
+    # Nominatim errors answer with its CODES error
+    UPSTREAMS.fault("nominatim", 500)
+    with app.test_client() as client:
+        status = client.get("/geo/reverse", query_string={"lat": 41.1, "lon": -95.1}, base_url="http://127.0.0.1:5000").status_code
+    results.append(check("nominatim outage", status == 524, f"{status}"))
+    UPSTREAMS.fault("nominatim")
+
+    # Google 5xx answers (retried until the retry timeout) answer with its CODES error and
+    # trip its breaker
+    CONFIG["google"]["timeout"] = (0.5, 0.5)
+    UPSTREAMS.fault("google", 503)
+    out = [request("/geo/forward", {"address": f"{i} Main St Denver CO"}) for i in range(5)]
+    statuses, google = [r.status_code for r, _ in out], BREAKERS["google"].stats()
+    results.append(check("google outage", set(statuses) == {CODES["google"]["c"]} and google["trips"] and google["rejected"],
+                         f"{statuses} in {[ms for _, ms in out]} ms, google {google}"))
+    UPSTREAMS.fault("google")
+
+    print(f"last good: {LAST_GOOD.stats()}")
+    return all(results)
+
+
+if __name__ == "__main__":
+    if not run(): exit(1)
@@ -0,0 +1,62 @@
+from datetime import timedelta as tdelta
+from random import Random
+
+# Elems in a real bulletin, not just those the API reads, so blocks are full size
+NBM_ELEMS = [
+    "TXN", "XND", "TMP", "TSD", "DPT", "SKY", "WDR", "WSP", "GST", "P01", "PZR", "PSN", "PPL",
+    "PRA", "S06", "SLV", "I06", "CIG", "VIS", "LCB", "MHT", "TWD", "TWS", "HID", "SOL"
+]
+
+def nbm_value(elem, tstm, rnd):
+    # Returns a plausible random value for an elem, -99 (missing) ~3% of the time
+    if rnd.random() < 0.03: return -99
+    if elem == "CIG": return rnd.choice([-88, 5, 12, 30, 120])
+    if elem == "TMP": return rnd.randint(-20, 105)
+    if elem == "DPT": return rnd.randint(-25, 75)
+    if elem == "VIS": return rnd.choice([1, 5, 50, 100])
+    if elem == "WDR": return rnd.randint(0, 36)
+    if elem in ("SKY", "PRA", "PSN", "PZR", "PPL", "P01", tstm): return rnd.randint(0, 100)
+    return rnd.randint(0, 40)
+
+def nbm_block(station, product, cycle, rnd):
+    # Returns the lines of a station block laid out like the NBM text products
+    title = f" {station:<7} NBM V4.1 {product.upper()} GUIDANCE   {cycle:%m/%d/%Y  %H00} UTC"
+
+    if product == "nbs":
+        hrs, tstm = [cycle + tdelta(hours=3 * (i + 1)) for i in range(23)], "T03"
+
+        # Date labels sit over the 1st col of each day
+        dates, day = " DT ", None
+        for i, h in enumerate(hrs):
+            if h.day != day and len(dates) <= 4 + 3 * i:
+                dates, day = dates.ljust(4 + 3 * i) + f"/{h:%b}".upper() + f"{h.day:3d}", h.day
+
+        lines = [title, dates.ljust(4 + 3 * len(hrs)), " UTC" + "".join(f" {h:%H}" for h in hrs),
+                 " FHR" + "".join(f"{3 * (i + 1):3d}" for i in range(len(hrs)))]
+    elif product == "nbe":
+        day0 = (cycle + tdelta(days=1)).replace(hour=0)
+        hrs, tstm = [day0 + tdelta(hours=12 * i) for i in range(14)], "T12"
+        fhr = lambda h: int((h - cycle).total_seconds() // 3600)
+
+        lines = [title, " " + "|".join(f"{h:%a} {h.day:2d}".upper() for h in hrs[::2]) + "|CLIMO",
+                 " UTC" + "|".join(" 00 12" for _ in hrs[::2]) + "|",
+                 " FHR" + "|".join(f"{fhr(a):3d}{fhr(b):3d}" for a, b in zip(hrs[::2], hrs[1::2])) + "|"]
+    else:
+        hrs, tstm = [cycle + tdelta(hours=i + 1) for i in range(25)], "T01"
+        lines = [title, " UTC" + "".join(f" {h:%H}" for h in hrs)]
+
+    for elem in NBM_ELEMS + [tstm]:
+        vals = [nbm_value(elem, tstm, rnd) for _ in hrs]
+        if product == "nbe":
+            pairs = "|".join(f"{a:3d}{b:3d}" for a, b in zip(vals[::2], vals[1::2]))
+            lines.append(f" {elem}{pairs}|{rnd.randint(0, 99):4d}")
+        else: lines.append(f" {elem}" + "".join(f"{v:3d}" for v in vals))
+
+    return lines
+
+def nbm_bulletin(product, cycle, stations, seed=1):
+    # Returns a synthetic bulletin (str) for product with a block per station
+    rnd, lines = Random(seed), []
+    for station in stations: lines += nbm_block(station, product, cycle, rnd) + [" " * 80]
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,110 @@
+from datetime import datetime as dt, timedelta as tdelta, timezone as tz
+from random import Random
+from time import perf_counter
+from zoneinfo import ZoneInfo
+
+from bench.fixtures import nbm_bulletin
+from bench.nbm_parse import index_blocks
+from src.forecast_mthds import NBM_MSG, PRODUCTS, parse_nbm
+from src.helpers import get_icon_hi, get_tz, icon_wx
+from src.nbm_array import parse_bulletin
+from src.routes import build_forecast, build_hourly
+from src.tables import load
+
+# Checks the array forecast builders against the per-hour parse_nbm loop they replaced on
+# synthetic bulletins for random stations, then times both
+# Run from the repo root: python -m bench.forecast_modes [stations]
+
+# The latest cycle of each product so hours line up with now like a live request's
+NOW = dt.now(tz.utc).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+CYCLES = {"nbs": NOW - tdelta(hours=NOW.hour % 6), "nbe": NOW - tdelta(hours=NOW.hour % 12), "nbh": NOW - tdelta(hours=1)}
+
+def build_forecast_ref(lat, lon, bulletins, days=3):
+    # The per-hour loop, with bulletins as {product: to_dict(station)}
+    local_sd = (dt.now(tz=ZoneInfo(get_tz(lat, lon))) + tdelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    utc_sd = dt.utcfromtimestamp(local_sd.timestamp()).replace(tzinfo=tz.utc)
+
+    msg = []
+    for x in range(days):
+        conds, temps, start = [], [], utc_sd + tdelta(hours=(24 * x))
+
+        for hr in [start + tdelta(hours=x) for x in range(24)]:
+            hdata = None
+            if hr in bulletins["nbs"]: hdata = parse_nbm(bulletins["nbs"][hr])
+            elif hr in bulletins["nbe"]: hdata = parse_nbm(bulletins["nbe"][hr])
+
+            if hdata: conds.append(hdata["name"])
+            if hdata and hdata["t"] is not None: temps.append(hdata["t"])
+
+        day_cond = max(conds, key=lambda x: get_icon_hi()[x]) if conds else "skc"
+
+        msg.append({**{
+            "hi": round(max(temps)) if temps else None,
+            "lo": round(min(temps)) if temps else None,
+            "wday": (local_sd + tdelta(days=x)).strftime("%a").upper()
+        }, **icon_wx(lat, lon, day_cond)})
+
+    return msg
+
+def build_hourly_ref(lat, lon, bulletins, hours=24):
+    # parse_nbm for each hour from now to hours ahead, nbh hours first then nbs
+    now, tzinfo = dt.now(tz.utc).replace(minute=0, second=0, microsecond=0), ZoneInfo(get_tz(lat, lon))
+    data = {**bulletins["nbs"], **bulletins["nbh"]}
+
+    msg = []
+    for hr in sorted([h for h in data if now <= h < now + tdelta(hours=hours)]):
+        hdata, local = parse_nbm(data[hr]), hr.astimezone(tzinfo)
+        msg.append({"time": local.isoformat(), **{k: hdata[k] for k in [*NBM_MSG, "rh"]}, **icon_wx(lat, lon, hdata["name"], date=local)})
+
+    return msg
+
+def same_hour(a, b):
+    # Returns whether two hourly items match, with rh to float tolerance
+    rh = a["rh"] == b["rh"] or (None not in (a["rh"], b["rh"]) and abs(a["rh"] - b["rh"]) < 1e-9)
+    return rh and {k: v for k, v in a.items() if k not in ("rh", "heat", "chill")} == {k: v for k, v in b.items() if k != "rh"}
+
+def timed(f, items):
+    # Returns f over items and its mean ms per item
+    start = perf_counter()
+    out = [f(*x) for x in items]
+    return out, 1e3 * (perf_counter() - start) / len(items)
+
+def run(n):
+    rnd, table = Random(1), load("stations")
+    sample = rnd.sample(range(len(table["id"])), n)
+    stations = [table["id"][i].decode() for i in sample]
+    points = [(float(table["lat"][i]), float(table["lon"][i])) for i in sample]
+
+    arrays = {}
+    for p, cycle in CYCLES.items():
+        bulletin = nbm_bulletin(p, cycle, stations).encode()
+        arrays[p] = parse_bulletin(bulletin, index_blocks(bulletin), cycle, PRODUCTS[p])
+    dicts = [{p: a.to_dict(s) for p, a in arrays.items()} for s in stations]
+
+    ok = True
+    for days in (3, 7):
+        new, new_ms = timed(lambda pt, s: build_forecast(*pt, arrays, s, days), list(zip(points, stations)))
+        ref, ref_ms = timed(lambda pt, d: build_forecast_ref(*pt, d, days), list(zip(points, dicts)))
+
+        # The array builder stops at the last bulletin hour; the loop pads with empty days. In
+        # half-hour offset zones (e.g., St. John's) no bulletin hour falls on the loop's hour
+        # keys, so its days are all empty there; the array builder takes every hour in the day
+        bad = [s for s, a, b in zip(stations, new, ref) if a != b[:len(a)] or any([d["hi"] is not None for d in b[len(a):]])]
+        half = [s for s, pt in zip(stations, points) if s in bad and dt.now(ZoneInfo(get_tz(*pt))).utcoffset().seconds % 3600]
+        ok &= len(bad) == len(half)
+        print(f"forecast days={days}: arrays {new_ms:.2f} ms, loop {ref_ms:.2f} ms ({ref_ms / new_ms:.1f}x), "
+              f"{len(bad) - len(half)} mismatches {[s for s in bad if s not in half][:5]}, {len(half)} half-hour zone stations filled in")
+
+    new, new_ms = timed(lambda pt, s: build_hourly(*pt, arrays, s, 72), list(zip(points, stations)))
+    ref, ref_ms = timed(lambda pt, d: build_hourly_ref(*pt, d, 72), list(zip(points, dicts)))
+
+    bad = [s for s, a, b in zip(stations, new, ref) if len(a) != len(b) or not all([same_hour(x, y) for x, y in zip(a, b)])]
+    ok &= not bad
+    print(f"hourly hours=72: arrays {new_ms:.2f} ms, loop {ref_ms:.2f} ms ({ref_ms / new_ms:.1f}x), {len(bad)} mismatches {bad[:5]}")
+
+    return ok
+
+
+if __name__ == "__main__":
+    from sys import argv
+    if not run(int(argv[1]) if len(argv) > 1 else 300): exit(1)
@@ -0,0 +1,86 @@
+from datetime import datetime as dt, timedelta as tdelta
+from re import findall, finditer, search
+from time import perf_counter
+
+from bench.fixtures import nbm_bulletin
+from src.forecast_mthds import PRODUCTS
+from src.nbm_array import parse_bulletin
+from src.nbm_store import HEADER
+from src.tables import load
+
+# Compares the whole-bulletin array parser against the per-station regex parser on
+# synthetic bulletins for every station. Run from the repo root: python -m bench.nbm_parse
+
+CYCLE = dt(2026, 10, 17, 12)
+
+def index_blocks(bulletin):
+    # Returns station -> (start, end) byte offsets like BulletinStore.add
+    starts = [(m.group(1).decode(), m.start()) for m in HEADER.finditer(bulletin)]
+    return {stn: (start, end) for (stn, start), (_, end) in zip(starts, starts[1:] + [("", len(bulletin))])}
+
+# The per-station regex parser the app used before NBMArray, kept as the reference
+def parse_station(bulletin, station, nbm_date, product):
+    # Returns station data keyed by hour or an error code if it can't be found
+    h_iter, h_row, elems, get_sdate = PRODUCTS[product].values()
+
+    # Get station bulletin for product + 1st datetime; Return error if any fail
+    try:
+        b = bulletin[bulletin.index(station):]
+        b = b[:b.index(search(r"\n\s{10}", b).group(0))].split("\n")
+        hr0 = get_sdate(b, nbm_date)
+    except (ValueError, AttributeError): return "nbm_text"
+
+    # Eliminate CLIMO column if it exists (usually in nbe)
+    if "CLIMO" in b[1]: b = [x[:b[1].index("CLIMO")] for x in b]
+
+    # The values are organized into cols separated by the end-indexes of each hour
+    # (the 1st col starts after the row label so T01/T03/T12 aren't read as values)
+    idxs = [search(r"\w{3}", b[h_row]).end()] + [h.end(0) for h in finditer(r"\d*", b[h_row]) if h.group(0)]
+
+    # Limit bulletin rows to those with relevant elements
+    b = [r for r in b if search(r"\w{3}", r).group(0) in elems]
+
+    # Reorganize bulletin as a dict keyed by elems with lists of their hour-values
+    b = {search(r"\w{3}", row).group(0): [float(v[0]) if v else None for v in [
+        findall(r"-?\d+", row[idxs[i]:idxs[i + 1]])
+        for i in range(len(idxs) - 1)]] for row in b}
+
+    # Modify "CIG" and "VIS" values if necessary
+    # cig measured in 100s miles, -88 if unlimited, vis in 1/10 miles
+    if "CIG" in b: b["CIG"] = ["Unlimited" if v == -88 else v for v in b["CIG"]]
+    if "CIG" in b: b["CIG"] = [v * 100 if type(v) == float else v for v in b["CIG"]]
+    if "VIS" in b: b["VIS"] = [v / 10 if type(v) == float else v for v in b["VIS"]]
+
+    # Organize data into a dict keyed by hour with dicts of element values
+    data = {hr0 + tdelta(hours=(i * h_iter)): {k: v[i] for k, v in b.items()}
+            for i in range(len(idxs) - 1)}
+
+    return data
+
+def normalize(data):
+    # Returns regex-parsed station data with NBM nulls (-99, as cig/vis) as None like NBMArray
+    return {hr: {k: None if v in (-99, -9900, -9.9) else v for k, v in row.items()} for hr, row in data.items()}
+
+def run(product):
+    bulletin = nbm_bulletin(product, CYCLE, [x.decode() for x in load("stations")["id"]]).encode()
+    index = index_blocks(bulletin)
+
+    start = perf_counter()
+    array = parse_bulletin(bulletin, index, CYCLE, PRODUCTS[product])
+    array_s = perf_counter() - start
+
+    start = perf_counter()
+    regex = {stn: parse_station(bulletin[a:b].decode(), stn, CYCLE, product) for stn, (a, b) in index.items()}
+    regex_s = perf_counter() - start
+
+    mismatches = [stn for stn in index if array.to_dict(stn) != normalize(regex[stn])]
+
+    print(f"{product}: {len(bulletin) / 1e6:.1f} MB, {len(index)} stations, "
+          f"array {array_s:.2f}s, regex {regex_s:.2f}s ({regex_s / array_s:.1f}x), "
+          f"{len(mismatches)} mismatches {mismatches[:5]}")
+
+    return not mismatches
+
+
+if __name__ == "__main__":
+    if not all([run(p) for p in PRODUCTS]): exit(1)
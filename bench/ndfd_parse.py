@@ -0,0 +1,73 @@
+from datetime import datetime as dt, timedelta as tdelta
+from os import path
+from time import perf_counter
+from zoneinfo import ZoneInfo
+from bs4 import BeautifulSoup as BSoup
+
+from src.current_mthds import NDFD_MAP, parse_ndfd
+from src.helpers import isnum
+
+# Checks parse_ndfd against the BeautifulSoup parser it replaced on the NDFD fixtures at
+# dates across (and outside) their time layouts, then times both
+# Run from the repo root: python -m bench.ndfd_parse
+
+FIXTURES = path.join(path.dirname(__file__), "fixtures")
+TZ = ZoneInfo("America/Denver")
+
+def parse_ndfd_bsoup(xml, date):
+    # The BeautifulSoup NDFD parser formerly in current_mthds.get_ndfd_data
+    data = BSoup(xml, "xml")
+
+    try:
+        svts = {t.find("layout-key").text: [
+            dt.fromisoformat(x.text).replace(tzinfo=date.tzinfo)
+            for x in t.find_all("start-valid-time")
+        ] for t in data.find_all("time-layout")}
+
+        idxs = {k: v.index(min(v, key=lambda x: abs(x - date))) for k, v in svts.items()}
+        data = data.find("parameters")
+    except: return 500
+
+    if not (all([svts, data, idxs]) and len(svts) == len(idxs)): return 500
+
+    msg = {}
+    for k, v in NDFD_MAP.items():
+        child = "value" if k != "icon" else "icon-link"
+
+        item = data.find(**{x: y for x, y in v.items() if x != "param"})
+        try: item = item.find_all(child)[idxs[item.attrs["time-layout"]]].text
+        except: item = None
+
+        if k == "ceil" and item: item = isnum(item) or item.title()
+        elif k != "icon" and item: item = isnum(item)
+
+        msg[k] = item
+
+    return msg
+
+def timeit(f, *args, n=200):
+    # Returns the mean secs of n calls of f(*args)
+    start = perf_counter()
+    for _ in range(n): f(*args)
+    return (perf_counter() - start) / n
+
+
+if __name__ == "__main__":
+    dates = [dt(2026, 10, 17, 8, tzinfo=TZ) + tdelta(minutes=20 * i) for i in range(27)]
+    ok = True
+
+    for name in ["ndfd.xml", "ndfd_ceil.xml", "ndfd_multi.xml", "ndfd_error.xml"]:
+        with open(path.join(FIXTURES, name), "rb") as f: xml = f.read()
+
+        mismatches = [d for d in dates if parse_ndfd(xml, d) != parse_ndfd_bsoup(xml, d)]
+        ok = ok and not mismatches
+
+        lxml_s, bsoup_s = timeit(parse_ndfd, xml, dates[0]), timeit(parse_ndfd_bsoup, xml, dates[0])
+        print(f"{name}: lxml {1000 * lxml_s:.3f}ms, bsoup {1000 * bsoup_s:.3f}ms "
+              f"({bsoup_s / lxml_s:.1f}x), {len(mismatches)} mismatches {mismatches[:3]}")
+
+    # Responses that aren't NDFD XML at all
+    for xml in [b"", b"<html><body>Service Unavailable</body></html>", b"not xml"]:
+        if parse_ndfd(xml, dates[0]) != parse_ndfd_bsoup(xml, dates[0]): ok = print(f"mismatch on {xml}")
+
+    if not ok: exit(1)
@@ -0,0 +1,186 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+import json
+from os import environ, makedirs, path
+from platform import python_version
+from random import Random
+from statistics import mean
+from subprocess import run as sh
+from tempfile import mkdtemp
+from time import perf_counter
+from zoneinfo import ZoneInfo
+import numpy as np
+
+# Offline benchmarks: microbenchmarks of the parsing/calc hot paths, then end-to-end runs of
+# every ENDPOINTS route through the app against the stand-in upstreams in bench/server.py
+# Results are saved to bench/results/<name>.json; pass --compare <old.json> to diff runs
+# Run from the repo root: python -m bench.run [--requests 200] [--concurrency 8]
+
+# Upstream state (downloaded bulletins, geocodes) in a fresh dir so every run starts cold
+WORK_DIR = mkdtemp(prefix="rainbow-bench-")
+environ.update({"NBM_DIR": path.join(WORK_DIR, "nbm"), "GEOCODE_DB": path.join(WORK_DIR, "geocode.sqlite")})
+environ.setdefault("RESPONSE_CACHE", "0")
+environ.setdefault("MAPS_KEY", "AIzaBenchmarkKeyForTheLocalStandInServer")
+environ.setdefault("PERSONAL_USER_AGENT", "{'User-Agent': 'rainbow-rest-bench'}")
+environ.setdefault("SYNOPTIC_TOKEN", "bench")
+
+from bench import server
+
+UPSTREAMS = server.start(float(environ.get("BENCH_LATENCY", 0)))
+
+from bench.fixtures import nbm_bulletin
+from bench.nbm_parse import CYCLE, index_blocks, parse_station
+from flask_app import ENDPOINTS, app
+from src.current_mthds import parse_ndfd, parse_ndfd_all
+from src.forecast_mthds import PRODUCTS, parse_nbm
+from src.helpers import get_tz, icon_wx, tz_at, wx_calcs, wx_calcs_many
+from src.metrics import METRICS
+from src.nbm_array import parse_bulletin
+from src.tables import load
+
+RESULTS = path.join(path.dirname(__file__), "results")
+TZ = ZoneInfo("America/Denver")
+
+# CONUS box points are drawn from, and addresses for geo/forward
+CONUS = ((25.0, -124.5), (49.0, -67.0))
+ADDRESSES = ["1600 Pennsylvania Ave NW", "Bushwick Brooklyn", "Englewood CO", "Pikes Peak", "Moab UT"]
+
+def timeit(f, n):
+    # Returns per-call stats of n calls of f() in µs
+    times = []
+    for _ in range(n):
+        start = perf_counter()
+        f()
+        times.append(perf_counter() - start)
+
+    return summarize(times, 1e6, "us")
+
+def summarize(times, scale, unit):
+    # Returns mean and p50/p95/p99 of times (secs) in unit
+    times = sorted(times)
+    pct = lambda p: round(scale * times[min(int(p / 100 * len(times)), len(times) - 1)], 3)
+    return {"n": len(times), f"mean_{unit}": round(scale * mean(times), 3), f"p50_{unit}": pct(50),
+            f"p95_{unit}": pct(95), f"p99_{unit}": pct(99)}
+
+def micro(n):
+    # Returns the microbenchmark results by name
+    results, rnd = {}, Random(1)
+    stations = [x.decode() for x in load("stations")["id"]]
+
+    for product in PRODUCTS:
+        bulletin = nbm_bulletin(product, CYCLE, stations).encode()
+        index = index_blocks(bulletin)
+        block = lambda stn: bulletin[slice(*index[stn])].decode()
+        sample = rnd.sample(list(index), 50)
+
+        results[f"parse_bulletin.{product}"] = timeit(lambda: parse_bulletin(bulletin, index, CYCLE, PRODUCTS[product]), 3)
+        results[f"parse_station.{product}"] = timeit(lambda: [parse_station(block(s), s, CYCLE, product) for s in sample], max(n // 50, 3))
+
+        rows = [row for s in sample[:5] for row in parse_bulletin(bulletin, index, CYCLE, PRODUCTS[product]).to_dict(s).values()]
+        results[f"parse_nbm.{product}"] = timeit(lambda: [parse_nbm(row) for row in rows], n // 10)
+
+    date = dt(2026, 10, 17, 12, 20, tzinfo=TZ)
+    for name in ["ndfd.xml", "ndfd_multi.xml"]:
+        xml = server.fixture(name)
+        results[f"parse_ndfd.{name}"] = timeit(lambda: parse_ndfd(xml, date), n)
+        results[f"parse_ndfd_all.{name}"] = timeit(lambda: parse_ndfd_all(xml, date), n)
+
+    inputs = [dict(t=rnd.randint(-30, 110), ws=rnd.randint(0, 40), dpt=rnd.randint(-30, 80)) for _ in range(100)]
+    results["wx_calcs"] = timeit(lambda: [wx_calcs(**x) for x in inputs], n // 10)
+    arrays = {k: np.array([x[k] for x in inputs], dtype=float) for k in inputs[0]}
+    results["wx_calcs_many"] = timeit(lambda: wx_calcs_many(**arrays), n // 10)
+
+    links = [
+        "https://forecast.weather.gov/images/wtf/medium/bkn.png",
+        "https://forecast.weather.gov/DualImage.php?i=bkn&j=ra&ip=20",
+    ]
+    results["icon_wx.name"] = timeit(lambda: icon_wx(39.65, -104.99, "tsra"), n)
+    results["icon_wx.link"] = timeit(lambda: [icon_wx(39.65, -104.99, link=l) for l in links], n)
+    results["icon_wx.daynight"] = timeit(lambda: icon_wx(39.65, -104.99, "ra", date=date), n)
+
+    points = [point(rnd) for _ in range(n)]
+    get_tz(*points[0])
+    tz_at.cache_clear()
+    results["get_tz.cold"] = timeit(lambda: get_tz(*points.pop()), len(points) - 1)
+    results["get_tz.warm"] = timeit(lambda: get_tz(39.65, -104.99), n)
+
+    return results
+
+def point(rnd):
+    # Returns a random CONUS (lat, lon)
+    return round(rnd.uniform(CONUS[0][0], CONUS[1][0]), 4), round(rnd.uniform(CONUS[0][1], CONUS[1][1]), 4)
+
+def end_to_end(n, concurrency):
+    # Returns throughput and latency by route for n requests each across concurrency threads,
+    # after one warm-up request (which pays for bulletin downloads and table loads)
+    results, rnd = {}, Random(2)
+
+    for resource, routes in ENDPOINTS.items():
+        for route in routes:
+            if route == "forward": queries = [{"address": f"{rnd.choice(ADDRESSES)} {i}"} for i in range(n + 1)]
+            else: queries = [dict(zip(("lat", "lon"), point(rnd))) for _ in range(n + 1)]
+
+            def call(query):
+                with app.test_client() as client:
+                    start = perf_counter()
+                    response = client.get(f"/{resource}/{route}", query_string=query, base_url="http://127.0.0.1:5000")
+                    return perf_counter() - start, response.status_code
+
+            warmup, _ = call(queries.pop())
+            start = perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool: calls = list(pool.map(call, queries))
+            elapsed = perf_counter() - start
+
+            statuses = {}
+            for _, status in calls: statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+            results[f"{resource}/{route}"] = {
+                **summarize([t for t, _ in calls], 1e3, "ms"), "rps": round(n / elapsed, 1),
+                "warmup_ms": round(1e3 * warmup, 1), "statuses": statuses
+            }
+            print(f"{resource}/{route}: {results[f'{resource}/{route}']}")
+
+    return results
+
+def compare(old, new):
+    # Prints the change in mean time of each result in both runs
+    for section in ("micro", "end_to_end"):
+        for name, result in new[section].items():
+            if name not in old.get(section, {}): continue
+            unit = "us" if section == "micro" else "ms"
+            a, b = old[section][name][f"mean_{unit}"], result[f"mean_{unit}"]
+            print(f"{section}.{name}: {a} -> {b} {unit} ({100 * (b - a) / a:+.1f}%)" if a else f"{section}.{name}: {b} {unit}")
+
+def commit():
+    # Returns the current git commit, None outside a checkout
+    try: return sh(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200, help="requests per route and calls per microbenchmark")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--name", default=dt.now().strftime("%Y%m%dT%H%M%S"))
+    parser.add_argument("--compare", help="a previous results file to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "name": args.name, "commit": commit(), "python": python_version(), "requests": args.requests,
+        "concurrency": args.concurrency, "latency": UPSTREAMS.latency,
+        "response_cache": environ["RESPONSE_CACHE"] != "0", "metrics": METRICS,
+        "micro": {} if args.skip_micro else micro(args.requests),
+    }
+    for name, result in results["micro"].items(): print(f"{name}: {result}")
+
+    results["end_to_end"] = end_to_end(args.requests, args.concurrency)
+    results["upstream_requests"] = UPSTREAMS.counts
+
+    makedirs(RESULTS, exist_ok=True)
+    with open(path.join(RESULTS, f"{args.name}.json"), "w") as f: json.dump(results, f, indent=1)
+    print(f"Saved {path.join(RESULTS, args.name)}.json")
+
+    if args.compare:
+        with open(args.compare) as f: compare(json.load(f), results)
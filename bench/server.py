@@ -0,0 +1,188 @@
+from datetime import datetime as dt, timedelta as tdelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from math import cos, radians
+from os import path
+import re
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+from bench.fixtures import nbm_bulletin
+from src.helpers import URLS
+from src.tables import load
+
+# Local stand-in for the upstreams in URLS, serving the recorded responses in bench/fixtures
+# (NBM bulletins are synthesized for every station, as recording all 3 products for every station runs to ~100s of MB)
+# Start it in-process with start() before importing the app, which points URLS at it
+# Upstreams.fault injects errors and delays into an upstream's responses (see bench/faults.py)
+
+FIXTURES = path.join(path.dirname(__file__), "fixtures")
+fixture = lambda name: open(path.join(FIXTURES, name), "rb").read()
+
+# Path each upstream is served under, and NOMADS paths' cycle and product
+PATHS = {
+    "nbm": "/nbm/blend.%(d)s/%(h)s/text/blend_%(p)stx.t%(h)sz", "syn": "/syn", "nominatim": "/nominatim",
+    "mapclick": "/mapclick", "ndfd": "/ndfd", "google": "/google",
+}
+NBM_PATH = re.compile(r"/nbm/blend\.(\d{8})/(\d{2})/text/blend_(\w{3})tx\.t\d{2}z")
+
+# Hrs before a cycle's bulletins are posted
+NBM_DELAY = 1
+
+# Deg between the copies of the recorded stations bbox queries get
+SYN_GRID = 0.25
+
+class Upstreams:
+    # Builds fixture responses; latency is secs slept before each response
+    def __init__(self, latency=0):
+        self.latency, self.base, self.counts, self.lock, self.bulletins = latency, None, {}, Lock(), {}
+        self.faults, self.nbm_lock = {}, Lock()
+        self.syn, self.ndfd = json.loads(fixture("synoptic.json")), fixture("ndfd.xml").decode()
+
+    def fault(self, key, status=None, delay=0):
+        # Makes an upstream (a PATHS key or "hazard") answer with status after delay secs
+        # (its normal response after the delay if status is None); fault(key) clears it
+        with self.lock:
+            if status or delay: self.faults[key] = {"status": status, "delay": delay}
+            else: self.faults.pop(key, None)
+
+    def nbm(self, date, hour, product):
+        # Returns a synthetic bulletin for every NBM station, None if the cycle isn't posted yet
+        cycle = dt.strptime(date + hour, "%Y%m%d%H")
+        if cycle > dt.utcnow() - tdelta(hours=NBM_DELAY): return None
+
+        # Synthesizing takes secs, so other upstreams don't wait on it
+        with self.nbm_lock:
+            if (product, cycle) not in self.bulletins:
+                stations = [x.decode() for x in load("stations")["id"]]
+                self.bulletins[(product, cycle)] = nbm_bulletin(product, cycle, stations).encode()
+
+            return self.bulletins[(product, cycle)]
+
+    def synoptic(self, query):
+        # Returns the recorded stations filtered by vars, moved around the radius point or
+        # spread over the bbox, up to limit
+        vars = query.get("vars", [""])[0].split(",")
+        stations = [
+            {**s, "SENSOR_VARIABLES": {k: v for k, v in s["SENSOR_VARIABLES"].items() if k in vars}}
+            for s in self.syn["STATION"]
+        ]
+        stations = [s for s in stations if s["SENSOR_VARIABLES"]]
+
+        # Tile bboxes with the recorded stations every SYN_GRID deg so every point has some in range
+        if "bbox" in query:
+            lon0, lat0, lon1, lat1 = [float(x) for x in query["bbox"][0].split(",")]
+            lats = [lat0 + SYN_GRID * i for i in range(int((lat1 - lat0) / SYN_GRID) + 1)]
+            lons = [lon0 + SYN_GRID * i for i in range(int((lon1 - lon0) / SYN_GRID) + 1)]
+            tiles = [self.place(stations, lat, lon) for lat in lats for lon in lons]
+            stations = [{**s, "STID": f"{s['STID']}{i}"} for i, tile in enumerate(tiles) for s in tile]
+
+            return {**self.syn, "SUMMARY": {**self.syn["SUMMARY"], "NUMBER_OF_OBJECTS": len(stations)}, "STATION": stations}
+
+        lat, lon = [float(x) for x in query["radius"][0].split(",")[:2]]
+        limit = query.get("limit", [None])[0]
+        stations = sorted(self.place(stations, lat, lon), key=lambda s: s["DISTANCE"])[:int(limit) if limit else None]
+
+        return {**self.syn, "SUMMARY": {**self.syn["SUMMARY"], "NUMBER_OF_OBJECTS": len(stations)}, "STATION": stations}
+
+    def place(self, stations, lat, lon):
+        # Returns copies of stations moved around a point, keeping their distances from it
+        placed = []
+
+        for i, s in enumerate(stations):
+            dlat = s["DISTANCE"] / 69 if i % 2 else 0
+            dlon = s["DISTANCE"] / (69 * max(cos(radians(lat)), 0.01)) if not i % 2 else 0
+            placed.append({**s, "LATITUDE": str(round(lat + dlat, 5)), "LONGITUDE": str(round(lon + dlon, 5))})
+
+        return placed
+
+    def ndfd_points(self, points):
+        # Returns the recorded NDFD response with a location and parameter block per point
+        head, rest = self.ndfd.split("    <location>", 1)
+        location, rest = rest.split("    <moreWeatherInformation", 1)
+        layouts = "    <time-layout" + rest.split("<time-layout", 1)[1].split("    <parameters")[0]
+        params, tail = ("    <parameters" + rest.split("    <parameters", 1)[1]).split("  </data>")
+
+        block = lambda text, i, lat, lon: text.replace("point1", f"point{i + 1}").replace(
+            'latitude="39.65" longitude="-104.99"', f'latitude="{lat}" longitude="{lon}"'
+        )
+        locations = "".join(["    <location>" + block(location, i, *p) for i, p in enumerate(points)])
+        parameters = "".join([block(params, i, *p) for i, p in enumerate(points)])
+
+        return (head + locations + layouts + parameters + "  </data>" + tail).encode()
+
+    def respond(self, url):
+        # Returns (status, content type, body) for a request path
+        parts, query = urlsplit(url), parse_qs(urlsplit(url).query)
+        key = parts.path.split("/")[1]
+
+        with self.lock: self.counts[key], fault = self.counts.get(key, 0) + 1, self.faults.get(key)
+        if self.latency: sleep(self.latency)
+
+        if fault:
+            sleep(fault["delay"])
+            if fault["status"]: return fault["status"], "text/plain", b"Injected fault"
+
+        if key == "nbm":
+            body = self.nbm(*NBM_PATH.match(parts.path).groups())
+            return (200, "text/plain", body) if body else (404, "text/plain", b"Not Found")
+        if key == "syn": return 200, "application/json", json.dumps(self.synoptic(query)).encode()
+        if key == "ndfd":
+            if "listLatLon" not in query: return 200, "text/xml", fixture("ndfd.xml")
+            points = [p.split(",") for p in query["listLatLon"][0].split()]
+            return 200, "text/xml", self.ndfd_points(points)
+        if key == "mapclick": return 200, "application/json", fixture("mapclick.json").replace(b"{base}", self.base.encode())
+        if key == "hazard": return 200, "text/html", fixture("hazard.html")
+        if key == "nominatim": return 200, "application/json", fixture("nominatim.json")
+        if key == "google": return 200, "application/json", fixture("google_geocode.json")
+
+        return 404, "text/plain", b"Not Found"
+
+def handler(upstreams):
+    class Handler(BaseHTTPRequestHandler):
+        # Headers and body are written separately; without NODELAY reused connections wait
+        # out the client's delayed ACK (~40 ms) between them
+        protocol_version, disable_nagle_algorithm = "HTTP/1.1", True
+
+        def log_message(self, *args): pass
+
+        def do_GET(self, head=False):
+            status, mimetype, body = upstreams.respond(self.path)
+
+            self.send_response(status)
+            self.send_header("Content-Type", mimetype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if not head: self.wfile.write(body)
+
+        def do_HEAD(self): self.do_GET(head=True)
+
+    return Handler
+
+class Server(ThreadingHTTPServer):
+    # Drops errors writing to clients that gave up (e.g., timed out on an injected delay)
+    # Queues enough connections for an event loop's worth of concurrent requests
+    daemon_threads, request_queue_size = True, 4096
+
+    def handle_error(self, request, client_address): pass
+
+def start(latency=0):
+    # Serves fixtures on a free local port in a daemon thread and points URLS at it
+    # Returns the Upstreams (for request counts)
+    upstreams = Upstreams(latency)
+    server = Server(("127.0.0.1", 0), handler(upstreams))
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    upstreams.base = f"http://127.0.0.1:{server.server_address[1]}"
+    URLS.update({k: upstreams.base + v for k, v in PATHS.items()})
+
+    return upstreams
+
+
+if __name__ == "__main__":
+    # python -m bench.server [latency secs]
+    from sys import argv
+    upstreams = start(float(argv[1]) if len(argv) > 1 else 0)
+    print(f"Serving fixtures at {upstreams.base} (ctrl-c to stop)", flush=True)
+    while True: sleep(3600)
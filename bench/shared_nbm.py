@@ -0,0 +1,158 @@
+from hashlib import sha256
+import json
+from multiprocessing import get_context
+from os import environ
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from sys import argv, executable, stdin
+from tempfile import mkdtemp
+from time import sleep
+
+# Memory of N worker processes (like pre-forked app workers) that have each answered
+# /wx/forecast and /wx/hourly from all 3 NBM products, with parsed cycles shared through
+# NBM_DIR (NBM_SHARED=1) and parsed in every worker (NBM_SHARED=0). Prints the workers'
+# total RSS and PSS (shared pages split among the processes mapping them) while all are
+# alive, and checks both modes answer identically and that shared cycles are parsed once
+# Workers are started as their own interpreters, then (shared) forked from a process that
+# already imported the app, like gunicorn --preload, right as its tracker starts downloading;
+# each forked worker must answer too and track cycles with its own tracker
+# Run from the repo root: python -m bench.shared_nbm [max workers]
+
+POINTS = [(39.74, -104.99), (40.01, -105.27), (41.1, -95.1), (33.45, -112.07), (47.61, -122.33)]
+ROUTES = ("forecast", "hourly")
+
+def memory():
+    # Returns this process's Rss and Pss in MB
+    with open("/proc/self/smaps_rollup") as f: rows = [line.split() for line in f if line.split()[0] in ("Rss:", "Pss:")]
+    return {k[:-1].lower(): int(v) / 1024 for k, v, _ in rows}
+
+def point_urls(base):
+    from bench.server import PATHS
+    from src.helpers import URLS
+    URLS.update({k: base + v for k, v in PATHS.items()})
+
+def answer():
+    # Returns a hash of the routes' answers for POINTS
+    from flask_app import app
+
+    bodies = sha256()
+    with app.test_client() as client:
+        for route in ROUTES:
+            for lat, lon in POINTS:
+                response = client.get(f"/wx/{route}", query_string={"lat": lat, "lon": lon}, base_url="http://127.0.0.1:5000")
+                bodies.update(b"%d " % response.status_code + response.get_data())
+
+    return bodies.hexdigest()
+
+def measure(bodies):
+    # Returns this process's memory, NBM counts and whether its tracker is polling
+    from src.nbm_store import BULLETINS
+
+    counts = {k: BULLETINS.counts[k] for k in ("arrays", "attached", "fetches")}
+    tracking = bool(BULLETINS.tracker and BULLETINS.tracker.is_alive() and BULLETINS.counts["polls"])
+    return {**memory(), **counts, "bodies": bodies, "tracking": tracking}
+
+def worker(base):
+    # Answers the routes from the stand-in at base, then prints its measurements when told
+    # to (once every worker has loaded) and waits for stdin to close
+    point_urls(base)
+    bodies = answer()
+
+    print("loaded", flush=True)
+    input()
+    print(json.dumps([measure(bodies)]), flush=True)
+    stdin.read()
+
+def forked_worker(conn):
+    bodies = answer()
+    conn.send("loaded")
+    conn.recv()
+    conn.send(measure(bodies))
+    try: conn.recv()
+    except EOFError: pass
+
+def preload(base, n):
+    # worker() for n workers forked from this process once it's imported the app (whose
+    # measurements come 1st)
+    point_urls(base)
+    import flask_app
+
+    fork, conns = get_context("fork"), []
+    for _ in range(n):
+        conn, child = fork.Pipe()
+        fork.Process(target=forked_worker, args=(child,), daemon=True).start()
+        conns.append(conn)
+
+    for conn in conns: assert conn.recv() == "loaded"
+    print("loaded", flush=True)
+    input()
+    for conn in conns: conn.send("measure")
+    print(json.dumps([measure(None)] + [conn.recv() for conn in conns]), flush=True)
+
+    stdin.read()
+    for conn in conns: conn.close()
+
+def run(n, shared, base, forked=False):
+    # Returns each of n concurrently alive workers' measurements, sharing a fresh NBM_DIR
+    nbm_dir = mkdtemp(prefix="rainbow-shared-nbm-")
+    env = {**environ, "NBM_DIR": nbm_dir, "NBM_SHARED": "1" if shared else "0", "RESPONSE_CACHE": "0"}
+    env.update({"NBM_POLL_EVERY": "1"} if forked else {"NBM_PREFETCH": ""})
+
+    args = [["preload", base, str(n)]] if forked else [["worker", base]] * n
+    workers = [Popen([executable, "-m", "bench.shared_nbm", *x], stdin=PIPE, stdout=PIPE, env=env, text=True) for x in args]
+
+    for w in workers: assert w.stdout.readline().strip() == "loaded"
+
+    # Let the forked workers' trackers poll at least once
+    if forked: sleep(3)
+
+    for w in workers: w.stdin.write("\n"), w.stdin.flush()
+    out = [x for w in workers for x in json.loads(w.stdout.readline())]
+
+    for w in workers: w.stdin.close(), w.wait()
+    rmtree(nbm_dir, ignore_errors=True)
+    return out
+
+def report(label, out):
+    # Prints and returns the total PSS of out's processes and their parsed and attached cycles
+    rss, pss = sum([x["rss"] for x in out]), sum([x["pss"] for x in out])
+    parsed, attached = sum([x["arrays"] for x in out]), sum([x["attached"] for x in out])
+    print(f"{label}: RSS {rss:.0f} MB, PSS {pss:.0f} MB, {parsed} cycles parsed, {attached} attached, "
+          f"{sum([x['fetches'] for x in out])} downloads")
+
+    return pss, parsed, attached
+
+
+if __name__ == "__main__":
+    environ.setdefault("MAPS_KEY", "AIzaBenchmarkKeyForTheLocalStandInServer")
+    environ.setdefault("PERSONAL_USER_AGENT", "{'User-Agent': 'rainbow-rest-bench'}")
+    environ.setdefault("SYNOPTIC_TOKEN", "bench")
+    if argv[1:2] == ["worker"]: exit(worker(argv[2]))
+    if argv[1:2] == ["preload"]: exit(preload(argv[2], int(argv[3])))
+
+    stand_in = Popen([executable, "-m", "bench.server"], stdout=PIPE, text=True)
+    base, ok, bodies, totals = stand_in.stdout.readline().split()[3], True, set(), {}
+
+    counts = [1] + [x for x in (2, 4, 8) if x <= (int(argv[1]) if len(argv) > 1 else 4)]
+    for shared in (False, True):
+        for n in counts:
+            out = run(n, shared, base)
+            totals[(shared, n)], parsed, attached = report(f"{'shared' if shared else 'per-worker'} x{n}", out)
+
+            bodies |= {x["bodies"] for x in out}
+            if shared: ok &= parsed == 3 and attached == 3 * (n - 1)
+
+    # Cost of each worker added past the 1st
+    extra = {s: (totals[(s, counts[-1])] - totals[(s, 1)]) / max(counts[-1] - 1, 1) for s in (False, True)}
+    print(f"PSS per added worker: {extra[False]:.0f} MB per-worker, {extra[True]:.0f} MB shared")
+
+    # The preloading process (listed 1st) counts towards the cycles parsed but not the answers
+    out = run(counts[-1], True, base, forked=True)
+    _, parsed, attached = report(f"shared x{counts[-1]} forked (with the preloading process)", out)
+    bodies |= {x["bodies"] for x in out[1:]}
+    tracking = all([x["tracking"] for x in out])
+    ok &= tracking and parsed == 3 and attached == 3 * counts[-1]
+    print(f"forked workers tracking cycles: {tracking}; {'identical' if len(bodies) == 1 else 'DIFFERENT'} responses")
+
+    stand_in.terminate()
+    if not ok or len(bodies) != 1: exit(1)
@@ -0,0 +1,66 @@
+from random import Random
+from time import perf_counter
+import numpy as np
+
+from src.current_mthds import current_calcs
+from src.helpers import wx_calcs, wx_calcs_many
+
+# Checks the array wx_calcs against the scalar one on random inputs (with Nones and 0s,
+# which wx_calcs treats as missing), and current_calcs against per-msg wx_calcs, then
+# times both. Run from the repo root: python -m bench.wx_calcs [n]
+
+def sample(rnd, lo, hi, missing=0.1):
+    # Returns a random float in [lo, hi], None or 0 (missing of the time)
+    x = rnd.random()
+    return None if x < missing / 2 else 0.0 if x < missing else round(rnd.uniform(lo, hi), 1)
+
+def inputs(n, seed=1):
+    rnd = Random(seed)
+    return [dict(
+        t=sample(rnd, -40, 120), ws=sample(rnd, 0, 60), dpt=sample(rnd, -40, 85),
+        rh=sample(rnd, 1, 100, 0.7)
+    ) for _ in range(n)]
+
+def close(a, b):
+    # Returns whether two calcs match (rh to float tolerance, heat and chill exactly)
+    if a is None or b is None: return a is b
+    return abs(a - b) <= 1e-9 * max(abs(a), 1)
+
+def run(n):
+    xs = inputs(n)
+    arr = lambda k: np.array([np.nan if x[k] is None else x[k] for x in xs])
+
+    start = perf_counter()
+    ref = [wx_calcs(**x) for x in xs]
+    ref_s = perf_counter() - start
+
+    args = [arr(k) for k in ("t", "ws", "rh", "dpt")]
+    wx_calcs_many(*[x[:10] for x in args])
+    start = perf_counter()
+    new = wx_calcs_many(*args)
+    new_s = perf_counter() - start
+
+    # wx_calcs leaves out rh when it's given, wx_calcs_many passes it through
+    value = lambda v: None if np.isnan(v) else float(v)
+    bad = [i for i, (x, r) in enumerate(zip(xs, ref)) if not all([
+        close(r.get("rh", x["rh"]), value(new["rh"][i])), close(r["heat"], value(new["heat"][i])),
+        close(r["chill"], value(new["chill"][i]))
+    ])]
+    print(f"wx_calcs_many: {n} inputs, arrays {1e3 * new_s:.2f} ms, scalar {1e3 * ref_s:.2f} ms "
+          f"({ref_s / new_s:.0f}x), {len(bad)} mismatches {[xs[i] for i in bad[:3]]}")
+
+    # current_calcs must give wx_calcs' exact types, as finalize_current formats by type
+    msgs = [{"t": x["t"], "wspeed": x["ws"], "rh": x["rh"], "dew": x["dpt"]} for x in xs] + ["ndfd"]
+    calcs = current_calcs(msgs)
+    ref = [wx_calcs(m["t"], m["wspeed"], m["rh"], m["dew"]) for m in msgs[:-1]] + [None]
+    same = lambda a, b: a is b if a is None or b is None else a.keys() == b.keys() and all(
+        [type(a[k]) == type(b[k]) and close(a[k], b[k]) for k in a])
+    bad_msgs = [i for i, (a, b) in enumerate(zip(calcs, ref)) if not same(a, b)]
+    print(f"current_calcs: {len(msgs)} msgs, {len(bad_msgs)} mismatches {[msgs[i] for i in bad_msgs[:3]]}")
+
+    return not bad and not bad_msgs
+
+
+if __name__ == "__main__":
+    from sys import argv
+    if not run(int(argv[1]) if len(argv) > 1 else 100000): exit(1)
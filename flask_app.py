@@ -1,7 +1,16 @@
-from flask import Flask, request, render_template, abort
+from os import getenv
+from time import perf_counter
+from flask import Flask, Response, request, render_template, abort, g
 # from flask_cors import CORS
-from src.routes import forward, reverse, alerts, almanac, current, forecast
-from src.helpers import gen_response, validate, isnum
+from src.routes import forward, reverse, alerts, almanac, current, current_many, forecast, forecast_many, hourly
+from src.alerts_store import ALERTS
+from src.client import FLIGHTS, breaker_stats
+from src.geocode_cache import GEOCODES
+from src.last_good import LAST_GOOD, begin_stale, finish_stale
+from src.helpers import ROUTE_PARAMS, gen_error, gen_response, validate, isint, isnum, tz_at
+from src.metrics import begin, finish, render
+from src.nbm_store import BULLETINS
+from src.response_cache import RESPONSES
 
 app = Flask(__name__)
 # CORS(app)
@@ -13,9 +22,23 @@ ENDPOINTS = {
         "almanac": almanac,
         "current": current,
         "forecast": forecast,
+        "hourly": hourly,
     },
 }
 
+# Routes that also take a JSON list of points by POST (and run batch items together), and
+# the most points and batch items per request
+MULTI_ENDPOINTS = {"wx": {"current": current_many, "forecast": forecast_many}}
+MAX_POINTS = int(getenv("MAX_POINTS", 500))
+MAX_BATCH = int(getenv("MAX_BATCH", 500))
+
+# Track NBM cycles from startup so bulletins are downloaded and parsed before requests need them
+# (forked workers start their own tracker, see BulletinStore.forked)
+BULLETINS.start()
+
+# Serve GET responses from the response cache (set RESPONSE_CACHE=0 to always recompute)
+RESPONSE_CACHE = getenv("RESPONSE_CACHE", "1") != "0"
+
 # Render OpenAPI UI
 @app.route("/")
 def get_ui():
@@ -33,27 +56,138 @@ def check_host():
         abort(401)
 
 
-# Dispatcher for GET requests from any API resource and route
-@app.route("/<resource>/<route>")
-def dispatcher(resource, route):
-    params = request.args.to_dict()
+# Time each request and answer with its stage timings in a Server-Timing header, and the
+# upstream sources it served last good results from (and their age in secs) in an X-Stale one
+@app.before_request
+def start_timing():
+    g.start = perf_counter()
+    begin()
+    begin_stale()
+
+@app.after_request
+def add_timing(response):
+    if "start" not in g: return response
+
+    timing = finish(route_label(), perf_counter() - g.start, response.status_code >= 400)
+    if timing: response.headers["Server-Timing"] = timing
+
+    stale = finish_stale()
+    if stale: response.headers["X-Stale"] = stale
 
-    # Convert lat and lon to floats if they exist
+    return response
+
+def route_label():
+    # Returns the request's route for metrics, grouping unknown routes so labels stay bounded
+    args = request.view_args or {}
+    if args.get("route") in ENDPOINTS.get(args.get("resource"), {}): return f"{request.method} /{args['resource']}/{args['route']}"
+    return f"{request.method} {request.url_rule.rule}" if request.url_rule else "other"
+
+
+# Prometheus latency histograms and error counts per route, upstream and stage, plus cache stats
+@app.route("/metrics")
+def metrics():
+    gauges = {
+        "responses": RESPONSES.stats(), "bulletins": BULLETINS.stats(), "alerts": ALERTS.stats(),
+        "geocodes": GEOCODES.stats(), "tz": tz_at.cache_info()._asdict(), "last_good": LAST_GOOD.stats(),
+        "breakers": breaker_stats(), "flights": FLIGHTS.stats()
+    }
+    return Response(render(gauges), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def get_params(route, args):
+    # Returns a route's params from request args, or the CODES key if they're invalid
+    params = dict(args)
+
+    # Convert lat and lon to floats and the route's optional args to ints if they exist
     params["lat"] = isnum(params.pop("lat", None))
     params["lon"] = isnum(params.pop("lon", None))
+    params.update({k: isint(params[k]) for k in ROUTE_PARAMS.get(route, {}) if k in params})
 
-    # Validate args, return error response if invalid
+    # Validate args, return error code if invalid
     v_status = validate(route, **params)
-    if v_status != 200:
-        return gen_response(v_status)
+    if v_status != 200: return v_status
 
     # Reset params to those req'd for route
-    params = {k: v for k, v in params.items() if v != None}
+    return {k: v for k, v in params.items() if v != None}
+
+
+# Dispatcher for GET requests from any API resource and route
+@app.route("/<resource>/<route>")
+def dispatcher(resource, route):
+    params = get_params(route, request.args.to_dict())
+    if type(params) == str: return gen_response(params)
+
+    if RESPONSE_CACHE:
+        return RESPONSES.respond(resource, route, params, ENDPOINTS[resource][route], request.if_none_match)
 
     response = ENDPOINTS[resource][route](**params)
 
     return response
 
 
+# Dispatcher for multi-point POST requests, body {"points": [[lat, lon] or {"lat", "lon"}, ...]}
+@app.route("/<resource>/<route>", methods=["POST"])
+def multi_dispatcher(resource, route):
+    if route not in MULTI_ENDPOINTS.get(resource, {}): abort(405)
+
+    body = request.get_json(silent=True)
+    points = body.get("points") if type(body) == dict else None
+    if type(points) != list or not 0 < len(points) <= MAX_POINTS: return gen_response("InvalidPoints")
+
+    # The route's optional args apply to every point
+    extra = {k: isint(body[k]) for k in ROUTE_PARAMS.get(route, {}) if k in body}
+    if validate(route, 0, 0, **extra) == "InvalidParams": return gen_response("InvalidParams")
+
+    # Convert points to (lat, lon) floats, answering invalid ones with an error item
+    to_point = lambda p: (p.get("lat"), p.get("lon")) if type(p) == dict else p if type(p) == list and len(p) == 2 else (None, None)
+    points = [tuple([isnum(x) for x in to_point(p)]) for p in points]
+    valid = [i for i, p in enumerate(points) if validate(route, *p) == 200]
+
+    msg = [gen_error("InvalidPoint")] * len(points)
+    if valid:
+        for i, data in zip(valid, MULTI_ENDPOINTS[resource][route]([points[i] for i in valid], **extra)): msg[i] = data
+
+    return gen_response(msg)
+
+
+# Dispatcher for many route calls in one request, body {"items": [{"route", "lat", "lon"}, ...]}
+# Items are grouped by route (and optional args) so multi-point routes share their lookups
+# and upstream calls
+@app.route("/batch", methods=["POST"])
+def batch():
+    body = request.get_json(silent=True)
+    items = body.get("items") if type(body) == dict else None
+    if type(items) != list or not 0 < len(items) <= MAX_BATCH: return gen_response("InvalidBatch")
+
+    resources = {route: resource for resource, routes in ENDPOINTS.items() for route in routes}
+
+    # Validate items, answering invalid ones with an error item
+    msg, groups = [None] * len(items), {}
+    for i, item in enumerate(items):
+        route = item.get("route") if type(item) == dict else None
+        if route not in resources:
+            msg[i] = gen_error("InvalidRoute")
+            continue
+
+        args = ("lat", "lon", "address", *ROUTE_PARAMS.get(route, {}))
+        params = get_params(route, {k: v for k, v in item.items() if k in args})
+        if type(params) == str: msg[i] = gen_error(params)
+        else:
+            extra = tuple(sorted([(k, v) for k, v in params.items() if k in ROUTE_PARAMS.get(route, {})]))
+            groups.setdefault((route, extra), []).append((i, params))
+
+    # Run each group's items together if it has a multi-point handler, else one at a time
+    for (route, extra), group in groups.items():
+        resource, idxs = resources[route], [i for i, _ in group]
+
+        if route in MULTI_ENDPOINTS.get(resource, {}):
+            data = MULTI_ENDPOINTS[resource][route]([(p["lat"], p["lon"]) for _, p in group], **dict(extra))
+        else: data = [ENDPOINTS[resource][route].__wrapped__(**p) for _, p in group]
+
+        for i, d in zip(idxs, data): msg[i] = gen_error(d) if type(d) == str else d
+
+    return gen_response(msg)
+
+
 if __name__ == "__main__":
     app.run()
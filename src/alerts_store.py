@@ -0,0 +1,182 @@
+from asyncio import gather
+from concurrent.futures import wait
+from html import unescape
+from os import register_at_fork
+from threading import Lock, Thread
+from time import sleep, time
+
+from bs4 import BeautifulSoup as BSoup
+from requests import JSONDecodeError, RequestException
+
+from src.async_client import afetch
+from src.client import fetch, submit
+from src.last_good import mark_stale
+
+# Secs before a zone's alert list and a hazard text are refetched, secs an unrequested zone
+# is kept, secs between background refreshes, and decimal places points are snapped to
+ALERT_TTL, TEXT_TTL, ZONE_IDLE, REFRESH_EVERY, POINT_PRECISION = 120, 600, 3600, 60, 3
+
+def mapclick_query(lat, lon):
+    return {"lat": lat, "lon": lon, "unit": 0, "lg": "english", "FcstType": "json"}
+
+class AlertStore:
+    # NWS alerts keyed by zone (zone, firezone, county) with hazard texts cached by url
+    # A background thread keeps recently requested zones current
+
+    def __init__(self):
+        self.points, self.zones, self.texts = {}, {}, {}
+        self.lock, self.refresher, self.version = Lock(), None, 0
+        register_at_fork(after_in_child=self.forked)
+        self.counts = {"hits": 0, "misses": 0, "refreshes": 0, "text_fetches": 0}
+
+    def mapclick(self, lat, lon):
+        # Returns (zones, hazard urls) for a point from the NWS MapClick API, None if it failed
+        try: return self.parse_mapclick(fetch("mapclick", mapclick_query(lat, lon)).json())
+        except (JSONDecodeError, KeyError, RequestException): return None
+
+    async def mapclick_async(self, lat, lon):
+        try: return self.parse_mapclick((await afetch("mapclick", mapclick_query(lat, lon))).json())
+        except (ValueError, KeyError, RequestException): return None
+
+    def parse_mapclick(self, data):
+        # Returns (zones, hazard urls) from a MapClick response, raising KeyError if it has none
+        zdata, adata = data["location"], data["data"]["hazardUrl"]
+        zones = ", ".join([zdata[x] for x in zdata if x in ["zone", "firezone", "county"]])
+        return zones, [unescape(l) for l in adata]
+
+    def update(self, zones, urls, point):
+        # Stores a zone's hazard urls, then maps point to it, bumping the store version if the
+        # urls changed
+        with self.lock:
+            entry = self.zones.setdefault(zones, {"zones": zones, "urls": None, "point": point, "used": time()})
+            if entry["urls"] != urls: self.version += 1
+            entry.update({"urls": urls, "fetched": time()})
+            self.points[point] = zones
+
+        return entry
+
+    def get_pre(self, url):
+        # Returns the <pre> block text of a hazard page (None if it has none), cached for TEXT_TTL
+        text, expires = self.texts.get(url, (None, 0))
+        if expires > time(): return text
+
+        try: html = fetch("hazard", url=url).text
+        except RequestException: return text
+
+        return self.put_pre(url, html)
+
+    async def get_pre_async(self, url):
+        text, expires = self.texts.get(url, (None, 0))
+        if expires > time(): return text
+
+        try: html = (await afetch("hazard", url=url)).text
+        except RequestException: return text
+
+        return self.put_pre(url, html)
+
+    def put_pre(self, url, html):
+        # Caches and returns the <pre> block text of a fetched hazard page
+        pre = BSoup(html, "lxml").pre
+
+        text = pre.text if pre else None
+        self.counts["text_fetches"] += 1
+        with self.lock: self.texts[url] = (text, time() + TEXT_TTL)
+
+        return text
+
+    def get_texts(self, urls):
+        # Returns the alert texts for hazard urls, fetching any that are stale in parallel
+        futures = [submit(self.get_pre, url) for url in urls]
+        wait(futures)
+
+        return [f.result() for f in futures if f.result()]
+
+    async def get_texts_async(self, urls):
+        texts = await gather(*[self.get_pre_async(url) for url in urls])
+        return [t for t in texts if t]
+
+    def get(self, lat, lon):
+        # Returns (zones, alert texts) for a point, None if its zones couldn't be found
+        point, entry, fresh = self.lookup(lat, lon)
+        if not fresh: entry = self.settle(point, entry, self.mapclick(lat, lon))
+        if not entry: return None
+
+        return entry["zones"], self.get_texts(entry["urls"])
+
+    async def get_async(self, lat, lon):
+        # get() with non-blocking MapClick and hazard page requests
+        point, entry, fresh = self.lookup(lat, lon)
+        if not fresh: entry = self.settle(point, entry, await self.mapclick_async(lat, lon))
+        if not entry: return None
+
+        return entry["zones"], await self.get_texts_async(entry["urls"])
+
+    def lookup(self, lat, lon):
+        # Returns (point snapped to POINT_PRECISION, its zones' entry or None, whether the
+        # entry is younger than ALERT_TTL), counting a hit or miss
+        self.start()
+        point = (round(lat, POINT_PRECISION), round(lon, POINT_PRECISION))
+        entry = self.zones.get(self.points.get(point))
+
+        fresh = bool(entry) and entry["fetched"] + ALERT_TTL > time()
+        self.counts["hits" if fresh else "misses"] += 1
+        if fresh: entry["used"] = time()
+
+        return point, entry, fresh
+
+    def settle(self, point, entry, found):
+        # Returns a point's entry updated with a MapClick lookup (found), or its last alert
+        # list marked stale if the lookup failed; None if there's neither
+        if not found and not entry: return None
+        if not found: mark_stale("mapclick", time() - entry["fetched"])
+        if found: entry = self.update(*found, point)
+
+        entry["used"] = time()
+        return entry
+
+    def refresh(self):
+        # Refetches alert lists + texts for recently used zones and drops idle zones/texts
+        # The dicts are changed in place under the lock, as requests read them meanwhile
+        with self.lock: held = list(self.zones.items())
+
+        for zones, entry in held:
+            if entry["used"] + ZONE_IDLE < time():
+                with self.lock: del self.zones[zones]
+                continue
+
+            found = self.mapclick(*entry["point"])
+            if found and found[0] == zones: self.get_texts(self.update(*found, entry["point"])["urls"])
+
+        with self.lock:
+            for k in [k for k, v in self.points.items() if v not in self.zones]: del self.points[k]
+            live = {u for e in self.zones.values() for u in e["urls"]}
+            for k in [k for k in self.texts if k not in live]: del self.texts[k]
+
+        self.counts["refreshes"] += 1
+
+    def start(self):
+        # Starts the background refresher (once per process, on first use)
+        if self.refresher and self.refresher.is_alive(): return
+
+        def loop():
+            while True:
+                sleep(REFRESH_EVERY)
+                try: self.refresh()
+                except Exception: pass
+
+        with self.lock:
+            if not (self.refresher and self.refresher.is_alive()):
+                self.refresher = Thread(target=loop, name="alerts-refresh", daemon=True)
+                self.refresher.start()
+
+    def forked(self):
+        # Runs in forked children: replaces the lock (the parent's refresher may have held
+        # it) and drops the refresher, which didn't survive the fork, so 1st use starts one
+        self.lock, self.refresher = Lock(), None
+
+    def stats(self):
+        # Returns hit/miss counts and the number of zones and texts held
+        return {**self.counts, "zones": len(self.zones), "texts": len(self.texts), "version": self.version}
+
+
+ALERTS = AlertStore()
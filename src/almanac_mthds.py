@@ -1,36 +1,62 @@
 from datetime import datetime as dt, timedelta as tdelta
-from astral import LocationInfo as Loc
-from astral.sun import sun
+from functools import lru_cache
+from os import getenv
 import ephem
 
-from src.helpers import icon_wx
+from src.helpers import SUN_PRECISION, icon_wx, sun_on
+from src.metrics import traced
 
+# Days per memoized solar table and the number of (point, block) tables kept
+SOLAR_DAYS = int(getenv("SOLAR_DAYS", 7))
+SOLAR_CACHE_SIZE = int(getenv("SOLAR_CACHE_SIZE", 4096))
+
+# Dates lunar phase tables are kept for and (date, tz) formatted tables kept
+LUNAR_CACHE_SIZE = int(getenv("LUNAR_CACHE_SIZE", 64))
+
+@lru_cache(maxsize=SOLAR_CACHE_SIZE)
+def solar_table(lat, lon, start, tzinfo):
+    # Returns formatted (rise, set) by local date for the SOLAR_DAYS days from start at an
+    # already-quantized point; (None, None) on days the sun doesn't rise or set
+    table = {}
+    for day in [start + tdelta(days=x) for x in range(SOLAR_DAYS)]:
+        s = sun_on(lat, lon, day, tzinfo)
+        table[day] = (s["sunrise"].strftime("%I:%M %p"), s["sunset"].strftime("%I:%M %p")) if s else (None, None)
+
+    return table
+
+@traced("almanac.solar")
 def get_solar(lat, lon, tz, date):
     msg, days = [], [date, date + tdelta(days=1)]
+    point = (round(float(lat), SUN_PRECISION), round(float(lon), SUN_PRECISION))
 
-    loc = Loc("", "", "", float(lat), float(lon))
+    # Days are read from tables aligned to SOLAR_DAYS blocks so consecutive days share one
     for x in range(len(days)):
-        s = sun(loc.observer, days[x], tzinfo=tz)
-        msg.append({
-            "wday": days[x].strftime("%A"), "tz": days[x].tzname(),
-            "rise": s["sunrise"].strftime("%I:%M %p"),
-            "set": s["sunset"].strftime("%I:%M %p"),
-        })
+        day = days[x].date()
+        rise, sunset = solar_table(*point, day - tdelta(days=day.toordinal() % SOLAR_DAYS), days[x].tzinfo)[day]
+        msg.append({"wday": days[x].strftime("%A"), "tz": days[x].tzname(), "rise": rise, "set": sunset})
 
     return msg
 
-def get_lunar(lat, lon, tz, date):
-    msg, data = [], sorted([
-        ("New", ephem.next_new_moon(ephem.Date(date.date()))),
-        ("First", ephem.next_first_quarter_moon(ephem.Date(date.date()))),
-        ("Full", ephem.next_full_moon(ephem.Date(date.date()))),
-        ("Last", ephem.next_last_quarter_moon(ephem.Date(date.date()))),
+@lru_cache(maxsize=LUNAR_CACHE_SIZE)
+def lunar_table(day):
+    # Returns the next new, 1st quarter, full and last quarter moons from a date, soonest first
+    # Phases don't depend on location, so every request on a date shares one table
+    start = ephem.Date(day)
+    return sorted([
+        ("New", ephem.next_new_moon(start)),
+        ("First", ephem.next_first_quarter_moon(start)),
+        ("Full", ephem.next_full_moon(start)),
+        ("Last", ephem.next_last_quarter_moon(start)),
     ], key=lambda x: x[1])
 
-    for x in range(len(data)):
-        msg.append({
-            "date": ephem.to_timezone(data[x][1], tz).strftime("%b %#d"),
-            "icon": icon_wx(lat, lon, data[x][0])["icon"], "phase": data[x][0]
-        })
+@lru_cache(maxsize=LUNAR_CACHE_SIZE)
+def lunar_dates(day, tz):
+    # Returns (phase, local date str) for lunar_table(day) in tz
+    return tuple([(phase, ephem.to_timezone(date, tz).strftime("%b %#d")) for phase, date in lunar_table(day)])
 
-    return msg
+@traced("almanac.lunar")
+def get_lunar(lat, lon, tz, date):
+    return [
+        {"date": local, "icon": icon_wx(lat, lon, phase)["icon"], "phase": phase}
+        for phase, local in lunar_dates(date.date(), tz)
+    ]
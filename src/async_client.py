@@ -0,0 +1,98 @@
+from asyncio import TimeoutError, sleep
+import json
+from os import getenv
+
+from requests import RequestException
+from requests.utils import get_encoding_from_headers
+
+from src.client import BREAKERS, FLIGHTS, STATS, STATS_LOCK, UPSTREAMS, flight_key, timed
+from src.helpers import URLS
+from src.metrics import upstream_error
+
+# Max connections per upstream in ASGI mode, where one process can have thousands of requests
+# in flight
+ASYNC_CONNECTIONS = int(getenv("ASYNC_CONNECTIONS", 1000))
+
+# Server errors retried like the sync sessions' Retry
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Per-upstream sessions, created on first use in the running event loop
+# aiohttp is only imported there, so the sync app (which imports the async routes) runs
+# without it
+SESSIONS = {}
+
+class Response:
+    # The parts of a requests.Response routes read, from a fully read upstream response
+
+    def __init__(self, status_code, headers, content):
+        self.status_code, self.headers, self.content = status_code, headers, content
+
+    @property
+    def text(self):
+        # Decoded like requests (text/* without a charset as ISO-8859-1), else as UTF-8
+        return self.content.decode(get_encoding_from_headers(self.headers) or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+def get_session(key):
+    # Returns the upstream's pooled ClientSession with its UPSTREAMS timeouts
+    import aiohttp
+
+    if key not in SESSIONS:
+        connect, read = UPSTREAMS[key]["timeout"]
+        SESSIONS[key] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        )
+
+    return SESSIONS[key]
+
+async def close_sessions():
+    # Closes the sessions (on ASGI shutdown)
+    for key in list(SESSIONS): await SESSIONS.pop(key).close()
+
+async def afetch(key, params=None, url=None, method="GET", **kwargs):
+    # Returns fetch()'s response (as a Response) without blocking the event loop: the same
+    # breakers, stats, retries (the 1st at once, then backoff * 2^n secs), timeouts and
+    # sharing of identical calls in flight
+    # Raises requests.RequestException for transport errors (and CircuitOpen) like fetch
+    flight = flight_key(key, params, url, method, kwargs)
+    if flight is None: return await acall(key, params, url, method, **kwargs)
+
+    return await FLIGHTS.do_async(key, flight, lambda: acall(key, params, url, method, **kwargs))
+
+async def acall(key, params=None, url=None, method="GET", **kwargs):
+    # Returns afetch()'s response from a call of its own
+    import aiohttp
+
+    BREAKERS[key].check()
+    cfg, session = UPSTREAMS[key], get_session(key)
+
+    # requests leaves out None params and sends the rest as str()
+    params = {k: str(v) for k, v in params.items() if v is not None} if params else params
+
+    try:
+        with timed(key):
+            for attempt in range(cfg["retries"] + 1):
+                if attempt > 1: await sleep(cfg["backoff"] * 2 ** (attempt - 1))
+
+                try:
+                    async with session.request(method, url or URLS[key], params=params, **kwargs) as r:
+                        response = Response(r.status, r.headers, await r.read())
+                except (aiohttp.ClientError, TimeoutError):
+                    if attempt == cfg["retries"]: raise
+                    continue
+
+                if response.status_code not in RETRY_STATUSES: break
+    except (aiohttp.ClientError, TimeoutError) as e:
+        BREAKERS[key].record(False)
+        raise RequestException(f"{key}: {e!r}") from e
+
+    # Count upstream server errors alongside raised ones
+    BREAKERS[key].record(response.status_code < 500)
+    if response.status_code >= 500:
+        with STATS_LOCK: STATS[key]["errors"] += 1
+        upstream_error(key)
+
+    return response
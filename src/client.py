@@ -0,0 +1,228 @@
+from asyncio import ensure_future, shield
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from os import getenv
+from threading import Lock
+from time import monotonic, perf_counter
+from urllib.parse import urlsplit
+
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.helpers import URLS
+from src.metrics import span, upstream, upstream_error
+
+# Per-upstream (connect, read) timeouts in secs, retry count and retry backoff factor
+# Keys match URLS plus the NWS hazard text pages
+UPSTREAMS = {
+    "nbm": {"timeout": (3.05, 60), "retries": 2, "backoff": 0.5},
+    "syn": {"timeout": (3.05, 10), "retries": 2, "backoff": 0.3},
+    "nominatim": {"timeout": (3.05, 10), "retries": 1, "backoff": 1.0},
+    "mapclick": {"timeout": (3.05, 10), "retries": 2, "backoff": 0.3},
+    "ndfd": {"timeout": (3.05, 15), "retries": 2, "backoff": 0.3},
+    "hazard": {"timeout": (3.05, 10), "retries": 2, "backoff": 0.3, "host": "forecast.weather.gov"},
+    "google": {"timeout": (3.05, 10), "retries": 2, "backoff": 0.3},
+}
+
+# Keep-alive connections held per upstream host
+POOL_SIZE = 32
+
+# Consecutive failed calls (raised or 5xx) that open an upstream's circuit breaker, and secs
+# it stays open before letting a trial call through
+BREAKER_FAILURES = int(getenv("BREAKER_FAILURES", 5))
+BREAKER_RESET = float(getenv("BREAKER_RESET", 30))
+
+# Share one upstream call among identical calls in flight at once (set SINGLE_FLIGHT=0 to
+# make every call)
+SINGLE_FLIGHT = getenv("SINGLE_FLIGHT", "1") != "0"
+
+class CircuitOpen(RequestException):
+    # Raised instead of calling an upstream whose breaker is open, so callers' existing
+    # RequestException handling answers with the upstream's CODES error
+    pass
+
+class Breaker:
+    # Opens after failures consecutive failed calls and fails calls fast for reset secs, then
+    # lets one call through per reset secs until one succeeds and closes it
+
+    def __init__(self, key, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.key, self.failures, self.reset, self.lock = key, failures, reset, Lock()
+        self.count, self.opened, self.trips, self.rejected = 0, None, 0, 0
+
+    def check(self):
+        # Raises CircuitOpen if the breaker is open and it isn't time for a trial call
+        if self.opened is None: return
+
+        with self.lock:
+            if self.opened is not None and monotonic() - self.opened < self.reset:
+                self.rejected += 1
+                raise CircuitOpen(f"{self.key} circuit open")
+
+            # Hold other calls off for another reset secs while this one tries
+            if self.opened is not None: self.opened = monotonic()
+
+    def record(self, ok):
+        # Counts a call's outcome, closing the breaker on success
+        with self.lock:
+            if ok:
+                self.count, self.opened = 0, None
+                return
+
+            self.count += 1
+            if self.count >= self.failures:
+                self.trips += self.opened is None
+                self.opened = monotonic()
+
+    def stats(self):
+        return {"open": int(self.opened is not None), "trips": self.trips, "rejected": self.rejected}
+
+class Flights:
+    # Single flight: the first caller of a key makes the upstream call and identical calls
+    # made while it's in flight wait for and share its response (or exception)
+
+    def __init__(self):
+        self.calls, self.tasks, self.lock = {}, {}, Lock()
+        self.counts = {k: {"calls": 0, "shared": 0} for k in UPSTREAMS}
+
+    def join(self, upstream, flights, key, new):
+        # Returns (key's flight in flights, whether it's shared), starting it with new() if
+        # there's none, and counts the call
+        with self.lock:
+            flight, shared = flights.get(key), key in flights
+            if not shared: flight = flights[key] = new()
+
+            self.counts[upstream]["calls"] += 1
+            self.counts[upstream]["shared"] += shared
+
+        return flight, shared
+
+    def do(self, upstream, key, call):
+        # Returns call(), or the result of the identical call in flight
+        future, shared = self.join(upstream, self.calls, key, Future)
+        if shared:
+            with span("upstream.shared"): return future.result()
+
+        try: future.set_result(call())
+        except BaseException as e: future.set_exception(e)
+        finally:
+            with self.lock: del self.calls[key]
+
+        return future.result()
+
+    async def do_async(self, upstream, key, call):
+        # do() for a coroutine function call. Waiters are shielded so one cancelling (e.g.,
+        # at a deadline) doesn't cancel the others' call
+        task, shared = self.join(upstream, self.tasks, key, lambda: ensure_future(call()))
+        if shared:
+            with span("upstream.shared"): return await shield(task)
+
+        task.add_done_callback(lambda t: self.land(key, t))
+        return await shield(task)
+
+    def land(self, key, task):
+        # Ends an async flight, retrieving its exception in case every waiter was cancelled
+        with self.lock: self.tasks.pop(key, None)
+        if not task.cancelled(): task.exception()
+
+    def stats(self):
+        # Returns calls and shared calls per upstream, flattened for /metrics gauges, and the
+        # coalescing ratio (calls per upstream call made)
+        calls, shared = [sum([v[k] for v in self.counts.values()]) for k in ("calls", "shared")]
+        return {
+            **{f"{k}_{stat}": v for k, c in self.counts.items() for stat, v in c.items()},
+            "ratio": round(calls / (calls - shared), 3) if calls else None
+        }
+
+def flight_key(key, params, url, method, kwargs):
+    # Returns the single flight key of an upstream call (method, URL and params and headers
+    # as requests sends them), None for calls that can't be shared
+    if not SINGLE_FLIGHT or method not in ("GET", "HEAD") or set(kwargs) - {"headers"}: return None
+
+    params = tuple([(k, str(v)) for k, v in sorted((params or {}).items()) if v is not None])
+    return method, url or URLS[key], params, tuple(sorted((kwargs.get("headers") or {}).items()))
+
+def new_session(cfg):
+    # Returns a session with a keep-alive pool that retries idempotent requests on 5xx/conn errors
+    retry = Retry(
+        total=cfg["retries"], backoff_factor=cfg["backoff"], status_forcelist=(500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"), raise_on_status=False
+    )
+
+    session, adapter = Session(), HTTPAdapter(pool_maxsize=POOL_SIZE, max_retries=retry)
+    session.mount("https://", adapter), session.mount("http://", adapter)
+
+    return session
+
+SESSIONS = {k: new_session(v) for k, v in UPSTREAMS.items()}
+BREAKERS = {k: Breaker(k) for k in UPSTREAMS}
+FLIGHTS = Flights()
+
+# Shared worker pool for concurrent upstream requests
+POOL = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="upstream")
+
+def submit(f, *args, **kwargs):
+    # Submits f to the pool in the caller's context so its spans and stale data count toward
+    # the request
+    return POOL.submit(copy_context().run, f, *args, **kwargs)
+
+STATS, STATS_LOCK = {k: {"requests": 0, "errors": 0, "seconds": 0.0} for k in UPSTREAMS}, Lock()
+
+@contextmanager
+def timed(key):
+    # Records the latency of the wrapped upstream call, and an error if it raises
+    start, error = perf_counter(), True
+    try:
+        yield
+        error = False
+    finally:
+        secs = perf_counter() - start
+        with STATS_LOCK:
+            STATS[key]["requests"] += 1
+            STATS[key]["errors"] += error
+            STATS[key]["seconds"] += secs
+        upstream(key, secs, error)
+
+def fetch(key, params=None, url=None, method="GET", **kwargs):
+    # Returns the response from an upstream in UPSTREAMS using its pooled session, shared
+    # with an identical call in flight
+    # Raises requests.RequestException on connection errors and timeouts, and CircuitOpen
+    # without calling it while its breaker is open
+    flight = flight_key(key, params, url, method, kwargs)
+    if flight is None: return call(key, params, url, method, **kwargs)
+
+    return FLIGHTS.do(key, flight, lambda: call(key, params, url, method, **kwargs))
+
+def call(key, params=None, url=None, method="GET", **kwargs):
+    # Returns fetch()'s response from a call of its own
+    BREAKERS[key].check()
+
+    try:
+        with timed(key):
+            response = SESSIONS[key].request(
+                method, url or URLS[key], params=params, timeout=UPSTREAMS[key]["timeout"], **kwargs
+            )
+    except RequestException:
+        BREAKERS[key].record(False)
+        raise
+
+    # Count upstream server errors alongside raised ones
+    BREAKERS[key].record(response.status_code < 500)
+    if response.status_code >= 500:
+        with STATS_LOCK: STATS[key]["errors"] += 1
+        upstream_error(key)
+
+    return response
+
+def stats():
+    # Returns request, error and mean latency counters per upstream host
+    with STATS_LOCK: return {k: {
+        **v, "host": UPSTREAMS[k].get("host") or urlsplit(URLS[k]).netloc,
+        "mean_ms": round(1000 * v["seconds"] / v["requests"], 1) if v["requests"] else None,
+        "breaker": BREAKERS[k].stats(), "shared": FLIGHTS.counts[k]["shared"]
+    } for k, v in STATS.items()}
+
+def breaker_stats():
+    # Returns each upstream's breaker state and counts flattened for /metrics gauges
+    return {f"{k}_{stat}": v for k, b in BREAKERS.items() for stat, v in b.stats().items()}
@@ -1,111 +1,329 @@
 from os import getenv
 from dotenv import load_dotenv
+from asyncio import create_task, wait as wait_async
+from concurrent.futures import wait
 from datetime import datetime as dt, timedelta as tdelta
+from io import BytesIO
+from math import cos, floor, radians
+from time import monotonic
 from zoneinfo import ZoneInfo
-from bs4 import BeautifulSoup as BSoup
-from requests import get, JSONDecodeError
+from lxml.etree import iterparse, XMLSyntaxError
+import numpy as np
+from requests import JSONDecodeError, RequestException
 
-from src.helpers import URLS, get_tz, icon_wx, isnum, wx_calcs
+from src.async_client import afetch
+from src.client import fetch, submit
+from src.helpers import get_tz, icon_wx, isnum, wx_calcs, wx_calcs_many
+from src.last_good import LAST_GOOD, point_key
+from src.metrics import traced
+from src.station_index import EARTH_KM, to_xyz
 
 
 load_dotenv()
 
+# Secs /wx/current waits on upstream sources before answering with what it has
+CURRENT_DEADLINE = float(getenv("CURRENT_DEADLINE", 8))
+
+# Max points per NDFD list-of-points query, deg per side of the cells multi-point Synoptic
+# queries are grouped by, and mi Synoptic stations are searched within
+NDFD_BATCH = int(getenv("NDFD_BATCH", 50))
+SYN_CELL, SYN_RADIUS = float(getenv("SYN_CELL", 1)), 20
+EARTH_MI = EARTH_KM / 1.609344
+
 def get_ndfd(lat, lon, msg):
-    # Get NDFD-NWS station ID
-    tz = ZoneInfo(get_tz(lat, lon))
-    date = dt.now(ZoneInfo(get_tz(lat, lon)))
+    # Returns msg updated with NDFD data and the NWS station id, 500 if NDFD failed
+    data = get_ndfd_data(lat, lon)
+    if data == 500: return 500
 
-    # Maps msg keys to NDFD req. parameters and XML tags
-    data_map = {
-        "t": {"name": "temperature", "param": "temp", "attrs": {"type": "hourly"}}, 
-        "dew": {"name": "temperature", "param": "dew", "attrs": {"type": "dew point"}}, 
-        "wbgt": {"name": "temperature", "param": "wbgt", "attrs": {"type": "wet bulb globe"}}, 
-        "wspeed": {"name": "wind-speed", "param": "wspd", "attrs": {"type": "sustained"}}, 
-        "wgust": {"name": "wind-speed", "param": "wgust", "attrs": {"type": "gust"}}, 
-        "wdir": {"name": "direction", "param": "wdir", "attrs": {"type": "wind"}}, 
-        "rh": {"name": "humidity", "param": "rh", "attrs": {"type": "relative"}}, 
-        "icon": {"name": "conditions-icon", "param": "icons"}, 
-        "ceil": {"name": "ceiling", "param": "ceil"}
-    }
+    msg.update(data)
+    msg["stations"].append(get_metar(lat, lon))
 
-    vars = {v["param"]: v["param"] for v in data_map.values()}
+    return msg
+
+# Maps msg keys to NDFD req. parameters and XML tags
+NDFD_MAP = {
+    "t": {"name": "temperature", "param": "temp", "attrs": {"type": "hourly"}}, 
+    "dew": {"name": "temperature", "param": "dew", "attrs": {"type": "dew point"}}, 
+    "wbgt": {"name": "temperature", "param": "wbgt", "attrs": {"type": "wet bulb globe"}}, 
+    "wspeed": {"name": "wind-speed", "param": "wspd", "attrs": {"type": "sustained"}}, 
+    "wgust": {"name": "wind-speed", "param": "wgust", "attrs": {"type": "gust"}}, 
+    "wdir": {"name": "direction", "param": "wdir", "attrs": {"type": "wind"}}, 
+    "rh": {"name": "humidity", "param": "rh", "attrs": {"type": "relative"}}, 
+    "icon": {"name": "conditions-icon", "param": "icons"}, 
+    "ceil": {"name": "ceiling", "param": "ceil"}
+}
+
+def ndfd_query(date):
+    # Returns the NDFD time-series params for NDFD_MAP's elements from an hour before date to 2 after
+    vars = {v["param"]: v["param"] for v in NDFD_MAP.values()}
     dates = {k: v.replace(minute=0, second=0).isoformat(timespec="seconds") for k, v in 
         {"begin": date - tdelta(hours=1), "end": date + tdelta(hours=2)}.items()
     }
 
-    # Make request for NDFD data
-    data = BSoup(get(URLS["ndfd"], {
-        "lat": lat, "lon": lon, "product": "time-series", **vars, **dates
-    }).text, "xml")
+    return {"product": "time-series", **vars, **dates}
+
+def get_ndfd_data(lat, lon):
+    # Returns the NDFD values nearest the current hour keyed like msg (the point's last good
+    # ones while they're recent or NDFD is failing), 500 if the request failed
+    data = LAST_GOOD.get("ndfd", point_key(lat, lon), lambda: load_ndfd(lat, lon))
+    return 500 if data is None else dict(data)
 
-    # Collect idxs of target date and limit data or return error
-    try: 
-        svts = {t.find("layout-key").text: [
-            dt.fromisoformat(x.text).replace(tzinfo=tz)
-            for x in t.find_all("start-valid-time")
-        ] for t in data.find_all("time-layout")}
+@traced("ndfd")
+def load_ndfd(lat, lon):
+    # Returns get_ndfd_data from a new NDFD request, None if it failed
+    date = dt.now(ZoneInfo(get_tz(lat, lon)))
+
+    # Make request for NDFD data, return error if it failed
+    try: xml = fetch("ndfd", {"lat": lat, "lon": lon, **ndfd_query(date)}).content
+    except RequestException: return None
 
-        idxs = {k: v.index(min(v, key=lambda x: abs(x - date))) for k, v in svts.items()}
-        data = data.find("parameters")
-    except: return 500
+    data = parse_ndfd(xml, date)
+    return None if data == 500 else data
+
+async def get_ndfd_data_async(lat, lon):
+    data = await LAST_GOOD.get_async("ndfd", point_key(lat, lon), lambda: load_ndfd_async(lat, lon))
+    return 500 if data is None else dict(data)
+
+@traced("ndfd")
+async def load_ndfd_async(lat, lon):
+    date = dt.now(ZoneInfo(get_tz(lat, lon)))
+
+    try: xml = (await afetch("ndfd", {"lat": lat, "lon": lon, **ndfd_query(date)})).content
+    except RequestException: return None
+
+    data = parse_ndfd(xml, date)
+    return None if data == 500 else data
+
+@traced("ndfd")
+def get_ndfd_many(points, tz):
+    # Returns get_ndfd_data for each (lat, lon) in points (all in tz) from one list-of-points
+    # query, falling back to each point's last good values where it failed
+    date = dt.now(ZoneInfo(tz))
+
+    try: xml = fetch("ndfd", {
+        "listLatLon": " ".join([f"{lat},{lon}" for lat, lon in points]), **ndfd_query(date)
+    }).content
+    except RequestException: xml = None
+
+    # NDFD keys locations point1, point2, ... in request order
+    data = parse_ndfd_all(xml, date) if xml else 500
+    data = [500 if data == 500 else data.get(f"point{i + 1}", 500) for i in range(len(points))]
+
+    for i, (lat, lon) in enumerate(points):
+        if data[i] != 500:
+            LAST_GOOD.put("ndfd", point_key(lat, lon), data[i])
+            continue
+
+        last = LAST_GOOD.fallback("ndfd", point_key(lat, lon))
+        if last is not None: data[i] = dict(last)
+
+    return data
+
+def parse_ndfd(xml, date):
+    # Returns the 1st location's NDFD values nearest date (local, tz-aware) keyed like msg,
+    # 500 if xml has no time layouts or parameters
+    data = parse_ndfd_all(xml, date, 1)
+    return next(iter(data.values())) if data != 500 else 500
+
+@traced("ndfd.parse")
+def parse_ndfd_all(xml, date, limit=None):
+    # Returns parse_ndfd for each location (up to limit) keyed by location-key, 500 if xml has
+    # no time layouts or parameters. Reads the XML in one pass, keeping only the time layouts
+    # and the elements named in NDFD_MAP
+    tags = {v["name"] for v in NDFD_MAP.values()}
+    idxs, locations, date = {}, {}, date.replace(tzinfo=None)
+
+    try:
+        for _, el in iterparse(BytesIO(xml), tag=("time-layout", "parameters")):
+            # Idx of the start time nearest date per layout (times are in date's local tz)
+            if el.tag == "time-layout":
+                svts = [abs(dt.fromisoformat(x.text).replace(tzinfo=None) - date) for x in el.iter("start-valid-time")]
+                idxs[el.find(".//layout-key").text] = svts.index(min(svts))
+
+            # 1st element of each tag + type; elems w/o a type in NDFD_MAP match any type
+            elif limit is None or len(locations) < limit:
+                items = locations.setdefault(el.get("applicable-location"), {})
+                for item in el.iter(*tags):
+                    items.setdefault((item.tag, item.get("type")), item)
+                    items.setdefault((item.tag, None), item)
+                continue
+
+            el.clear()
+    except (XMLSyntaxError, AttributeError, TypeError, ValueError): return 500
 
     # Return error if date-indexing failed
-    if not (all([svts, data, idxs]) and len(svts) == len(idxs)): return 500
+    if not (idxs and locations): return 500
+
+    return {k: ndfd_values(items, idxs) for k, items in locations.items()}
 
-    # Parse NDFD data
-    for k, v in data_map.items():
+def ndfd_values(items, idxs):
+    # Returns the values of a location's NDFD elements at their layouts' idxs keyed like msg
+    msg = {}
+    for k, v in NDFD_MAP.items():
         child = "value" if k != "icon" else "icon-link"
 
-        item = data.find(**{x: y for x, y in v.items() if x != "param"})
-        try: item = item.find_all(child)[idxs[item.attrs["time-layout"]]].text
-        except: item = None
+        item = items.get((v["name"], v.get("attrs", {}).get("type")))
+        try: item = "".join(list(item.iter(child))[idxs[item.get("time-layout")]].itertext())
+        except (AttributeError, IndexError, KeyError): item = None
 
         if k == "ceil" and item: item = isnum(item) or item.title()
         elif k != "icon" and item: item = isnum(item)
 
         msg[k] = item
 
-    # Get station id from NWS
-    try: msg["stations"].append(get(URLS["mapclick"], {
-        "lat": lat, "lon": lon, "units": 0, "lg": "english", "FcstType": "json"
-    }).json()["location"]["metar"])
-    except (JSONDecodeError, KeyError, ValueError): pass
-
     return msg
 
+def get_metar(lat, lon):
+    # Returns the NWS (METAR) station id for a point, the last good one while it's recent or
+    # MapClick is failing, None if it failed
+    return LAST_GOOD.get("mapclick", point_key(lat, lon), lambda: load_metar(lat, lon))
+
+@traced("mapclick")
+def load_metar(lat, lon):
+    # Returns the NWS (METAR) station id for a point from MapClick, None if it failed
+    try: return fetch("mapclick", metar_query(lat, lon)).json()["location"]["metar"]
+    except (JSONDecodeError, KeyError, ValueError, RequestException): return None
+
+async def get_metar_async(lat, lon):
+    return await LAST_GOOD.get_async("mapclick", point_key(lat, lon), lambda: load_metar_async(lat, lon))
+
+@traced("mapclick")
+async def load_metar_async(lat, lon):
+    try: return (await afetch("mapclick", metar_query(lat, lon))).json()["location"]["metar"]
+    except (KeyError, ValueError, RequestException): return None
+
+def metar_query(lat, lon):
+    return {"lat": lat, "lon": lon, "units": 0, "lg": "english", "FcstType": "json"}
+
+SKEY, VKEY, OKEY, SYN_MAP = "STATION", "SENSOR_VARIABLES", "OBSERVATIONS", {
+    "t": "air_temp", "ceil": "ceiling", "vis": "visibility", "p": "pressure", 
+    "wgust": "wind_gust", "wspeed": "wind_speed", "rh": "relative_humidity",
+    "wdir": "wind_cardinal_direction", "dew": "dew_point_temperature"
+}
+
 def get_synoptic(lat, lon, msg):
-    skey, vkey, okey, syn_map = "STATION", "SENSOR_VARIABLES", "OBSERVATIONS", {
-        "t": "air_temp", "ceil": "ceiling", "vis": "visibility", "p": "pressure", 
-        "wgust": "wind_gust", "wspeed": "wind_speed", "rh": "relative_humidity",
-        "wdir": "wind_cardinal_direction", "dew": "dew_point_temperature"
+    # Returns msg updated with the latest nearby Synoptic obs, 500 if the request failed
+    data = get_synoptic_data(lat, lon)
+    if data == 500: return 500
+
+    # Assemble missing vars and make unique query for each
+    for k, v in missing_vars(data, msg).items(): data[k] = get_synoptic_var(lat, lon, v) or v
+
+    return merge_synoptic(data, msg)
+
+def syn_payload(lat, lon, vars, limit, bbox=None):
+    # Returns the Synoptic latest-obs query for active stations within SYN_RADIUS mi, or
+    # every station in bbox ((lat, lon) sw and ne corners) if given
+    area = {"radius": f"{lat},{lon},{SYN_RADIUS}", "limit": limit} if not bbox else {
+        "bbox": ",".join([str(x) for x in (bbox[0][1], bbox[0][0], bbox[1][1], bbox[1][0])])
     }
 
-    payload = {
-        "token": getenv("SYNOPTIC_TOKEN"), "limit": 5, "status": "active",
-        "units": "english,pres|inhg", "vars": ",".join([x for x in syn_map.values()]),
-        "radius": f"{lat},{lon},20", "within": 60
+    return {
+        "token": getenv("SYNOPTIC_TOKEN"), "status": "active", "units": "english,pres|inhg",
+        "vars": vars, "within": 60, **area
     }
 
+def get_synoptic_data(lat, lon):
+    # Returns msg keys mapped to the 1st station reporting them (or the var name if none do),
+    # the point's last good ones while they're recent or Synoptic is failing, 500 if it failed
+    data = LAST_GOOD.get("syn", point_key(lat, lon), lambda: load_synoptic(lat, lon))
+    return 500 if data is None else dict(data)
+
+@traced("synoptic")
+def load_synoptic(lat, lon):
+    # Returns get_synoptic_data from a new Synoptic request, None if it failed
+    payload = syn_payload(lat, lon, ",".join([x for x in SYN_MAP.values()]), 5)
+
     # Make request for synoptic data, return error if necessary
-    try: data = get(URLS["syn"], payload).json()[skey]
-    except (JSONDecodeError, KeyError): return 500
+    try: data = fetch("syn", payload).json()[SKEY]
+    except (JSONDecodeError, KeyError, RequestException): return None
 
-    # data to dict with (k, ⌊stn w/ v⌉ or v) pairs
-    st0orv = lambda st, v: st[0] if st else v
-    data = {k: st0orv([s for s in data if v in s[vkey]], v) for k, v in syn_map.items()}
+    return syn_pick(data)
 
-    # Assemble missing vars and make unique query for each
-    mia = {k: v for k, v in data.items() if not msg[k] and type(v) == str}
+async def get_synoptic_data_async(lat, lon):
+    data = await LAST_GOOD.get_async("syn", point_key(lat, lon), lambda: load_synoptic_async(lat, lon))
+    return 500 if data is None else dict(data)
+
+@traced("synoptic")
+async def load_synoptic_async(lat, lon):
+    payload = syn_payload(lat, lon, ",".join([x for x in SYN_MAP.values()]), 5)
 
-    for k, v in mia.items():
-        payload["vars"], payload["limit"] = v, 1
-        try: data[k] = get(URLS["synoptic"], payload).json()[skey][0]
-        except (JSONDecodeError, KeyError, IndexError): pass
+    try: data = (await afetch("syn", payload)).json()[SKEY]
+    except (ValueError, KeyError, RequestException): return None
 
+    return syn_pick(data)
+
+def syn_pick(stations):
+    # Returns msg keys mapped to the 1st of stations reporting them (or the var name if none do)
+    st0orv = lambda st, v: st[0] if st else v
+    return {k: st0orv([s for s in stations if v in s[VKEY]], v) for k, v in SYN_MAP.items()}
+
+@traced("synoptic")
+def get_synoptic_bbox(bbox):
+    # Returns the stations in bbox reporting any SYN_MAP var (the bbox's last good ones if
+    # the request failed), 500 if there are none
+    payload, key = syn_payload(None, None, ",".join([x for x in SYN_MAP.values()]), None, bbox), str(bbox)
+
+    try: data = fetch("syn", payload).json()[SKEY]
+    except (JSONDecodeError, KeyError, RequestException):
+        data = LAST_GOOD.fallback("syn", key)
+        return 500 if data is None else data
+
+    LAST_GOOD.put("syn", key, data)
+    return data
+
+def syn_near_many(points, deadline=CURRENT_DEADLINE):
+    # Returns the Synoptic stations within SYN_RADIUS mi of each (lat, lon) in points, nearest
+    # first, from one bbox query per SYN_CELL deg cell of points; 500 where a query failed
+    # and [] where it was still pending at the deadline
+    cells = {}
+    for i, (lat, lon) in enumerate(points): cells.setdefault((floor(lat / SYN_CELL), floor(lon / SYN_CELL)), []).append(i)
+
+    # Pad cells by the radius so points near their edges see every station in range
+    def bbox(cell):
+        lat0, lat1 = cell[0] * SYN_CELL - SYN_RADIUS / 69, (cell[0] + 1) * SYN_CELL + SYN_RADIUS / 69
+        dlon = SYN_RADIUS / (69 * max(cos(radians(max(abs(lat0), abs(lat1)))), 0.01))
+        return (lat0, cell[1] * SYN_CELL - dlon), (lat1, (cell[1] + 1) * SYN_CELL + dlon)
+
+    futures = {cell: submit(get_synoptic_bbox, bbox(cell)) for cell in cells}
+    wait(futures.values(), timeout=deadline)
+
+    near = [[]] * len(points)
+    for cell, future in futures.items():
+        if not future.done(): continue
+        if future.result() == 500:
+            for i in cells[cell]: near[i] = 500
+            continue
+
+        # Great-circle mi from each of the cell's points to its stations
+        stations = [s for s in future.result() if isnum(s.get("LATITUDE")) is not None and isnum(s.get("LONGITUDE")) is not None]
+        xyz = to_xyz([float(s["LATITUDE"]) for s in stations], [float(s["LONGITUDE"]) for s in stations]).reshape(-1, 3)
+        for i in cells[cell]:
+            miles = 2 * EARTH_MI * np.arcsin(np.minimum(np.linalg.norm(xyz - to_xyz(*points[i]), axis=1) / 2, 1))
+            near[i] = [stations[j] for j in np.argsort(miles, kind="stable") if miles[j] <= SYN_RADIUS]
+
+    return near
+
+def missing_vars(data, msg):
+    # Returns the vars that neither msg nor the radius query had a value for
+    return {k: v for k, v in data.items() if not msg[k] and type(v) == str}
+
+@traced("synoptic.fallback")
+def get_synoptic_var(lat, lon, var):
+    # Returns the nearest station reporting var, None if there isn't one
+    try: return fetch("syn", syn_payload(lat, lon, var, 1)).json()[SKEY][0]
+    except (JSONDecodeError, KeyError, IndexError, RequestException): return None
+
+@traced("synoptic.fallback")
+async def get_synoptic_var_async(lat, lon, var):
+    try: return (await afetch("syn", syn_payload(lat, lon, var, 1))).json()[SKEY][0]
+    except (ValueError, KeyError, IndexError, RequestException): return None
+
+def merge_synoptic(data, msg):
     # Parse data
     for k, st in data.items():
         if type(st) == str: continue
-        value = st[okey][list(st[vkey][syn_map[k]].keys())[0]]["value"]
+        value = st[OKEY][list(st[VKEY][SYN_MAP[k]].keys())[0]]["value"]
 
         # Add value/stid to msg; wdir in cardinal dirs.
         msg[k] = value if k == "wdir" else isnum(value)
@@ -116,14 +334,111 @@ def get_synoptic(lat, lon, msg):
 
     return msg
 
-def finalize_current(msg: dict, lat, lon):
+@traced("current.gather")
+def gather_current(lat, lon, msg, deadline=CURRENT_DEADLINE):
+    # Returns msg filled from NDFD, MapClick and Synoptic requested concurrently, or the
+    # CODES key of a failed source. Sources still pending at the deadline are left out
+    end = monotonic() + deadline
+    done = lambda f: f.result() if f.done() else None
+
+    # NDFD, the NWS station and the Synoptic radius query don't depend on each other
+    ndfd, metar, syn = [submit(f, lat, lon) for f in (get_ndfd_data, get_metar, get_synoptic_data)]
+    wait([ndfd, metar, syn], timeout=deadline)
+
+    if done(ndfd) == 500: return "ndfd"
+    if done(syn) == 500: return "synoptic"
+
+    msg.update(done(ndfd) or {})
+    msg["stations"].append(done(metar))
+
+    # Fire a fallback query for each var still missing, keeping the radius result's precedence
+    data = done(syn) or {}
+    fallbacks = {k: submit(get_synoptic_var, lat, lon, v) for k, v in missing_vars(data, msg).items()}
+    wait(fallbacks.values(), timeout=max(end - monotonic(), 0))
+
+    data.update({k: done(f) for k, f in fallbacks.items() if done(f)})
+
+    return merge_synoptic(data, msg)
+
+@traced("current.gather")
+async def gather_current_async(lat, lon, msg, deadline=CURRENT_DEADLINE):
+    # gather_current() with the sources requested as tasks on the running event loop
+    end = monotonic() + deadline
+    done = lambda t: t.result() if t.done() else None
+
+    ndfd, metar, syn = [create_task(f(lat, lon)) for f in (get_ndfd_data_async, get_metar_async, get_synoptic_data_async)]
+    await wait_async([ndfd, metar, syn], timeout=deadline)
+
+    if done(ndfd) == 500: return "ndfd"
+    if done(syn) == 500: return "synoptic"
+
+    msg.update(done(ndfd) or {})
+    msg["stations"].append(done(metar))
+
+    data = done(syn) or {}
+    fallbacks = {k: create_task(get_synoptic_var_async(lat, lon, v)) for k, v in missing_vars(data, msg).items()}
+    if fallbacks: await wait_async(fallbacks.values(), timeout=max(end - monotonic(), 0))
+
+    data.update({k: done(t) for k, t in fallbacks.items() if done(t)})
+
+    return merge_synoptic(data, msg)
+
+@traced("current.gather")
+def gather_current_many(points, msgs, deadline=CURRENT_DEADLINE):
+    # Returns gather_current for each (lat, lon) in points filling the matching msg in msgs,
+    # with one NDFD query per NDFD_BATCH points sharing a tz and one Synoptic query per cell
+    # MapClick is skipped (it's per point), so stations only lists Synoptic stations
+    end = monotonic() + deadline
+    done = lambda f: f.result() if f.done() else None
+
+    # NDFD start times are local, so each query only holds points in one tz
+    tzs = {}
+    for i, (lat, lon) in enumerate(points): tzs.setdefault(get_tz(lat, lon), []).append(i)
+    batches = [(tz, idxs[j:j + NDFD_BATCH]) for tz, idxs in tzs.items() for j in range(0, len(idxs), NDFD_BATCH)]
+
+    futures = [submit(get_ndfd_many, [points[i] for i in idxs], tz) for tz, idxs in batches]
+    near = syn_near_many(points, deadline)
+    wait(futures, timeout=max(end - monotonic(), 0))
+
+    ndfd = [None] * len(points)
+    for f, (_, idxs) in zip(futures, batches):
+        for i, data in zip(idxs, done(f) or [None] * len(idxs)): ndfd[i] = data
+
+    for i, msg in enumerate(msgs):
+        if ndfd[i] == 500: msgs[i] = "ndfd"
+        elif near[i] == 500: msgs[i] = "synoptic"
+        else:
+            msg.update(ndfd[i] or {})
+
+            # Radius query picks come from the 5 nearest stations, fallbacks from any in range
+            data, fallback = syn_pick(near[i][:5]), syn_pick(near[i])
+            data.update({k: fallback[k] for k in missing_vars(data, msg)})
+            msgs[i] = merge_synoptic(data, msg)
+
+    return msgs
+
+def current_calcs(msgs):
+    # Returns wx_calcs for each gathered msg (None for failed ones) from one pass over all
+    col = lambda k: np.array([m[k] if type(m) == dict and m[k] is not None else np.nan for m in msgs], dtype=float)
+    calcs = {k: v.tolist() for k, v in wx_calcs_many(col("t"), col("wspeed"), col("rh"), col("dew")).items()}
+
+    # Same types as wx_calcs: rh only if it was missing, heat and chill as ints
+    value = lambda v, f: None if v != v else f(v)
+    return [None if type(m) != dict else {
+        **({} if m["rh"] else {"rh": value(calcs["rh"][i], float)}),
+        "heat": value(calcs["heat"][i], int), "chill": value(calcs["chill"][i], int)
+    } for i, m in enumerate(msgs)]
+
+@traced("current.finalize")
+def finalize_current(msg: dict, lat, lon, calcs=None):
     # Returns the response data formatted to match WeatherStar 4000 output
+    # calcs are the msg's current_calcs if they've been run over a batch
 
     fmt = lambda x, y: f"{round(msg[x])}{y}" if type(msg[x]) == float else None
 
     # Get icon, wx description, heat index, wind chill and any remaining formatting
-    msg.update(icon_wx(lat, lon, link=msg["icon"]))
-    msg.update(wx_calcs(msg["t"], msg["wspeed"], msg["rh"], msg["dew"]))
+    msg.update(icon_wx(lat, lon, link=msg["icon"], date=dt.now(ZoneInfo(get_tz(lat, lon)))))
+    msg.update(calcs or wx_calcs(msg["t"], msg["wspeed"], msg["rh"], msg["dew"]))
     msg.update({
         "t": fmt("t", "&deg;"), "dew": fmt("dew", "&deg;"), "heat": fmt("heat", "&deg;"),
         "chill": fmt("chill", "&deg;"), "rh": fmt("rh", "%"), "vis": fmt("vis", " mi."),
@@ -1,107 +1,67 @@
 from datetime import datetime as dt, timedelta as tdelta, timezone as tz
-from math import cos
-from re import findall, finditer, search
-from requests import get
-
-from src.helpers import ICON_HI, STATIONS, URLS, wx_calcs
-
-# Retrive and format NBM bulletin data 
-def get_nbm(lat, lon, product):
-    # Returns NBM bulletin data for product for the nearest station
-
-    elems = ["SKY", "WSP", "GST", "WDR", "TMP", "DPT", "VIS", "CIG", "PZR", "PSN", "PPL", "PRA"]
-
-    match product:
-        case "nbe":
-            h_iter, h_row, elems = 12, 2, elems + ["T12"]
-            
-            get_sdate = lambda b, d: dt.strptime(" ".join([
-                str((d + tdelta(days=1)).year), str((d + tdelta(days=1)).month),
-                list(filter(None, findall(r"\d*", b[1].split("|")[0])))[0],
-                list(filter(None, findall(r"\d*", b[2].split("|")[0])))[0]
-            ]), "%Y %m %d %H").replace(tzinfo=tz.utc)
-
-        case "nbs":
-            h_iter, h_row, elems = 3, 3, elems + ["T03"]
-            
-            get_sdate = lambda b, d: dt.strptime(" ".join([
-                str((d + tdelta(hours=6)).year),
-                search(r"[A-Z]{3}", search(r"(?<=\/)[A-Z]*\s*\d*", b[1]).group(0)).group(0),
-                list(filter(None, findall(r"\d*", search(r"(?<=\/)[A-Z]*\s*\d*", b[1]).group(0))))[0],
-                list(filter(None, findall(r"\d*", b[2])))[0]
-            ]), "%Y %b %d %H").replace(tzinfo=tz.utc)
-
-        case "nbh": 
-            h_iter, h_row, elems = 1, 1, elems + ["T01"]
-            get_sdate = lambda b, d: d + tdelta(hours=1)
-
-    # Get nearest station
-    deltas = [sum(x) for x in zip(
-        [(abs(lon - STATIONS[s]["LON"]) * cos(lat)) ** 2 for s in STATIONS],
-        [abs(lat - STATIONS[s]["LAT"]) ** 2 for s in STATIONS]
-    )]
-
-    station = list(STATIONS.keys())[deltas.index(min(deltas))]
-
-    # Find ideal bulletin
-    furl = lambda d: URLS["nbm"] % {"d": d.strftime("%Y%m%d"), "h": d.strftime("%H"), "p": product}
-
-    nbm_date = dt.utcnow() - tdelta(hours=1) if product == "nbh" else dt.utcnow()
-
-    bulletin = get(furl(nbm_date))
-    while bulletin.status_code != 200:
-        nbm_date -= tdelta(hours=1)
-        bulletin = get(furl(nbm_date))
-
-    # Get station bulletin for product + 1st datetime; Return error if any fail
-    try:
-        bulletin = bulletin.text
-        b = bulletin[bulletin.index(station):]
-        b = b[:b.index(search(r"\n\s{10}", b).group(0))].split("\n")
-        hr0 = get_sdate(b, nbm_date)
-    except (ValueError, AttributeError): return "nbm_text", station
-
-    # Eliminate CLIMO column if it exists (usually in nbe)
-    if "CLIMO" in b[1]: b = [x[:b[1].index("CLIMO")] for x in b]
-
-    # The values are organized into cols separated by the end-indexes of each hour
-    idxs = [0] + [h.end(0) for h in finditer(r"\d*", b[h_row]) if h.group(0)]
-
-    # Limit bulletin rows to those with relevant elements
-    b = [r for r in b if search(r"\w{3}", r).group(0) in elems]
-
-    # Reorganize bulletin as a dict keyed by elems with lists of their hour-values
-    b = {search(r"\w{3}", row).group(0): [float(v[0]) if v else None for v in [
-        list(filter(None, findall(r"\d*", row[idxs[i]:idxs[i + 1]])))
-        for i in range(len(idxs) - 1)]] for row in b}
-    
-    # Modify "CIG" and "VIS" values if necessary 
-    # cig measured in 100s miles, -88 if unlimited, vis in 1/10 miles
-    if "CIG" in b: b["CIG"] = ["Unlimited" if v == -88 else v for v in b["CIG"]]
-    if "CIG" in b: b["CIG"] = [v * 100 if type(v) == float else v for v in b["CIG"]]
-    if "VIS" in b: b["VIS"] = [v / 10 if type(v) == float else v for v in b["VIS"]]
-
-    # Organize data into a dict keyed by hour with dicts of element values
-    data = {hr0 + tdelta(hours=(i * h_iter)): {k: v[i] for k, v in b.items()} 
-            for i in range(len(idxs) - 1)}
-
-    return data, station
+from functools import lru_cache
+from re import findall, search
+import numpy as np
+
+from src.helpers import get_icon_hi, wx_calcs, wx_calcs_many
+from src.nbm_array import parse_bulletin
+from src.nbm_store import BULLETINS
+from src.station_index import get_station_index
+
+ELEMS = ["SKY", "WSP", "GST", "WDR", "TMP", "DPT", "VIS", "CIG", "PZR", "PSN", "PPL", "PRA"]
+
+# Per-product hours between cols, row that marks col ends, elems, and 1st-hour parser
+PRODUCTS = {
+    "nbe": {
+        "h_iter": 12, "h_row": 2, "elems": ELEMS + ["T12"],
+        "get_sdate": lambda b, d: dt.strptime(" ".join([
+            str((d + tdelta(days=1)).year), str((d + tdelta(days=1)).month),
+            list(filter(None, findall(r"\d*", b[1].split("|")[0])))[0],
+            list(filter(None, findall(r"\d*", b[2].split("|")[0])))[0]
+        ]), "%Y %m %d %H").replace(tzinfo=tz.utc)
+    },
+    "nbs": {
+        "h_iter": 3, "h_row": 3, "elems": ELEMS + ["T03"],
+        "get_sdate": lambda b, d: dt.strptime(" ".join([
+            str((d + tdelta(hours=6)).year),
+            search(r"[A-Z]{3}", search(r"(?<=\/)[A-Z]*\s*\d*", b[1]).group(0)).group(0),
+            list(filter(None, findall(r"\d*", search(r"(?<=\/)[A-Z]*\s*\d*", b[1]).group(0))))[0],
+            list(filter(None, findall(r"\d*", b[2])))[0]
+        ]), "%Y %b %d %H").replace(tzinfo=tz.utc)
+    },
+    "nbh": {
+        "h_iter": 1, "h_row": 1, "elems": ELEMS + ["T01"],
+        "get_sdate": lambda b, d: (d + tdelta(hours=1)).replace(tzinfo=tz.utc)
+    },
+}
+
+def bulletin_parser(product):
+    # Returns a BulletinStore.array parser for product's whole bulletins
+    return lambda bulletin, index, nbm_date: parse_bulletin(bulletin, index, nbm_date, PRODUCTS[product])
+
+# Let the bulletin tracker parse new cycles before requests ask for them
+BULLETINS.parsers.update({p: bulletin_parser(p) for p in PRODUCTS})
+
+# parse_nbm msg keys and their elems, the SKY pcts cloud conds start at, the max SKY pcts of
+# "hi" and "showers", and the elems whose pcts (>= 90 for current, 20 for forecasts) add conds
+NBM_MSG = {"wspeed": "WSP", "wgust": "GST", "wdir": "WDR", "t": "TMP", "dew": "DPT", "vis": "VIS", "ceil": "CIG"}
+NBM_SKY = {"skc": 0, "few": 12.5, "sct": 37.5, "bkn": 62.5, "ovc": 87.5}
+NBM_SPRC, NBM_PRC = {"hi": 60, "showers": 60}, {
+    "wind": "WSP", "rain": "PRA", "snow": "PSN", "fzra": "PZR", 
+    "sleet": "PPL", "tsra": "T01", "tsra": "T03", "tsra": "T12"
+}
+KT_MPH = 1.15077945
 
 # Parse NBM bulletin data by the hour 
 def parse_nbm(data, is_current=False):
     # Returns data from the hour in current-endpoint format
-    msg = {"wspeed": "WSP", "wgust": "GST", "wdir": "WDR", "t": "TMP", "dew": "DPT", "vis": "VIS", "ceil": "CIG"}
-    sky = {"skc": 0, "few": 12.5, "sct": 37.5, "bkn": 62.5, "ovc": 87.5}
-    sprc, prc = {"hi": 60, "showers": 60}, {
-        "wind": "WSP", "rain": "PRA", "snow": "PSN", "fzra": "PZR", 
-        "sleet": "PPL", "tsra": "T01", "tsra": "T03", "tsra": "T12"
-    }
+    msg, sky, sprc, prc = NBM_MSG, NBM_SKY, NBM_SPRC, NBM_PRC
 
     # Limit data to conditions that exist and aren't NBM null (i.e., -99)
     data = {k: v for k, v in data.items() if v not in (None, -99)}
 
     # Get WSP in mph, TMP, and DPT if they exist
-    wsp = data["WSP"] * 1.15077945 if "WSP" in data else None
+    wsp = data["WSP"] * KT_MPH if "WSP" in data else None
     tmp = data["TMP"] if "TMP" in data else None
     dpt = data["DPT"] if "DPT" in data else None
 
@@ -116,13 +76,69 @@ def parse_nbm(data, is_current=False):
     conds += [k for k, v in prc.items() if v in data and data[v] >= qual]
     conds += [k for k, v in sky.items() if "SKY" in data and data["SKY"] >= v]
     conds += [k for k, v in sprc.items() if "SKY" in data and data["SKY"] <= v]
-    conds = [e for e in ICON_HI if all([x in conds for x in e.split("_")])]
+    conds = [e for e in get_icon_hi() if all([x in conds for x in e.split("_")])]
 
     # Find the maximum hierarchical condition (default skc)
-    max_cond = max(conds, key=lambda x: ICON_HI[x]) if conds else "skc"
+    max_cond = max(conds, key=lambda x: get_icon_hi()[x]) if conds else "skc"
 
     # Generate return data
     msg = {k: data[v] if v in data else None for k, v in msg.items()}
     msg.update({"rh": calcs["rh"], "name": max_cond})
 
-    return msg    
+    return msg
+
+def get_nbm_arrays(points, products):
+    # Returns each product's NBMArray for its latest cycle ("nbm_text" if it failed) and the
+    # nearest station of each (lat, lon) in points
+    stations = [x[0][0] for x in get_station_index().nearest_many(points)]
+    return {p: BULLETINS.array(p, bulletin_parser(p)) for p in products}, stations
+
+@lru_cache(maxsize=None)
+def cond_table(tokens):
+    # Returns the icon names parse_nbm can pick from conds tokens (those whose every "_" part
+    # is one) in icons.json order, their hierarchies and a names x tokens mask of their parts
+    names = [n for n, h in get_icon_hi().items() if h is not None and all([x in tokens for x in n.split("_")])]
+    mask = np.array([[t in n.split("_") for t in tokens] for n in names], dtype=np.int64)
+    return names, np.array([get_icon_hi()[n] for n in names]), mask
+
+def nbm_hours(data, elems, is_current=False):
+    # Returns parse_nbm for every hour col of a station's elems x hours array at once: arrays
+    # keyed like its msg (NaN for None), plus "hi", the hierarchy of each hour's condition
+    nan = np.full(data.shape[1], np.nan)
+    col = lambda e: data[elems.index(e)] if e in elems else nan
+    ok = lambda x: ~np.isnan(x) & (x != 0)
+    tmp, dpt, wsp, sky = col("TMP"), col("DPT"), col("WSP") * KT_MPH, col("SKY")
+    calcs = wx_calcs_many(tmp, wsp, dpt=dpt)
+
+    # Conds by hour, then each hour's highest ranked icon made only of its conds (1st in
+    # icons.json order on ties, skc if none)
+    qual = 90 if is_current else 20
+    conds = {"cold": ~np.isnan(calcs["chill"]) | (ok(tmp) & (tmp <= 0)), "hot": ~np.isnan(calcs["heat"])}
+    conds.update({k: col(v) >= qual for k, v in NBM_PRC.items()})
+    conds.update({k: sky >= v for k, v in NBM_SKY.items()})
+    conds.update({k: sky <= v for k, v in NBM_SPRC.items()})
+
+    names, hier, mask = cond_table(tuple(conds))
+    missing = (~np.stack(list(conds.values()), axis=1)).astype(np.int64) @ mask.T
+    scores = np.where(missing == 0, hier, -1)
+    best = scores.argmax(axis=1)
+
+    msg = {k: col(v) for k, v in NBM_MSG.items()}
+    msg.update({**calcs, "hi": np.where(scores.max(axis=1) >= 0, hier[best], get_icon_hi()["skc"])})
+    msg["name"] = np.where(scores.max(axis=1) >= 0, np.array(names, dtype=object)[best], "skc")
+
+    return msg
+
+def merge_hours(*products):
+    # Returns (hours, nbm_hours msg) over the hours of (NBMArray, station) products (which
+    # must have the station), each hour taken from the 1st product that has it, in time order
+    hours, parts = [], []
+    for array, station in products:
+        seen = set(hours)
+        keep = [i for i, h in enumerate(array.hours) if h not in seen]
+        hours += [array.hours[i] for i in keep]
+        parts.append({k: v[keep] for k, v in nbm_hours(array.view(station), array.elems).items()})
+
+    order = np.argsort(np.array([h.timestamp() for h in hours]), kind="stable")
+    return [hours[i] for i in order], {k: np.concatenate([p[k] for p in parts])[order] for k in parts[0]}
+
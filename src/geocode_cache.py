@@ -0,0 +1,91 @@
+import json
+from os import getenv, makedirs, path
+from sqlite3 import connect, Error as SQLiteError
+from tempfile import gettempdir
+from threading import local
+from time import time
+
+# SQLite db shared by every worker process, kept across restarts
+GEOCODE_DB = getenv("GEOCODE_DB", path.join(gettempdir(), "rainbow-rest", "geocode.sqlite"))
+
+# Secs lookups and failed lookups are kept, max entries, puts between eviction passes, and
+# decimal places reverse lookup points are snapped to
+GEOCODE_TTL, NEGATIVE_TTL = int(getenv("GEOCODE_TTL", 30 * 86400)), int(getenv("NEGATIVE_TTL", 3600))
+GEOCODE_SIZE, EVICT_EVERY, GEOCODE_PRECISION = int(getenv("GEOCODE_SIZE", 100000)), 100, 3
+
+class GeocodeCache:
+    # Forward (by normalized address) and reverse (by snapped point) geocoder results in
+    # SQLite (WAL mode so processes can read while one writes). None values are cached
+    # failed lookups. Lookups that fail for transient reasons shouldn't be put
+
+    def __init__(self, db=GEOCODE_DB, size=GEOCODE_SIZE):
+        self.db, self.size, self.local, self.puts = db, size, local(), 0
+        self.counts = {"hits": 0, "negative_hits": 0, "misses": 0, "errors": 0}
+
+    def conn(self):
+        # Returns this thread's connection, creating the db and table on first use
+        if not getattr(self.local, "conn", None):
+            makedirs(path.dirname(self.db), exist_ok=True)
+            conn = connect(self.db, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS geocode (kind TEXT, key TEXT, value TEXT, expires REAL, "
+                "PRIMARY KEY (kind, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS geocode_expires ON geocode (expires)")
+            self.local.conn = conn
+
+        return self.local.conn
+
+    def get(self, kind, key):
+        # Returns (True, value) for a fresh entry (value None if the lookup failed), else (False, None)
+        try: row = self.conn().execute(
+            "SELECT value FROM geocode WHERE kind = ? AND key = ? AND expires > ?", (kind, key, time())
+        ).fetchone()
+        except SQLiteError:
+            self.counts["errors"] += 1
+            return False, None
+
+        if not row:
+            self.counts["misses"] += 1
+            return False, None
+
+        self.counts["hits" if row[0] else "negative_hits"] += 1
+        return True, json.loads(row[0]) if row[0] else None
+
+    def put(self, kind, key, value):
+        # Stores a lookup's result (None if it failed), evicting every EVICT_EVERY puts
+        ttl = GEOCODE_TTL if value is not None else NEGATIVE_TTL
+
+        try:
+            with self.conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)",
+                    (kind, key, json.dumps(value) if value is not None else None, time() + ttl)
+                )
+        except SQLiteError: self.counts["errors"] += 1
+
+        self.puts += 1
+        if not self.puts % EVICT_EVERY: self.evict()
+
+    def evict(self):
+        # Drops expired entries, then those expiring soonest beyond self.size
+        try:
+            with self.conn() as conn:
+                conn.execute("DELETE FROM geocode WHERE expires <= ?", (time(),))
+                conn.execute(
+                    "DELETE FROM geocode WHERE rowid IN (SELECT rowid FROM geocode ORDER BY expires "
+                    "LIMIT max((SELECT count(*) FROM geocode) - ?, 0))", (self.size,)
+                )
+        except SQLiteError: self.counts["errors"] += 1
+
+    def stats(self):
+        # Returns this process's hit/miss counts and the entries held by all processes
+        try: entries = self.conn().execute("SELECT count(*) FROM geocode").fetchone()[0]
+        except SQLiteError: entries = None
+
+        return {**self.counts, "entries": entries}
+
+
+GEOCODES = GeocodeCache()
@@ -1,20 +1,36 @@
-from datetime import datetime as dt, timezone as tz
-import inspect
-import json
+from functools import lru_cache, wraps
 from math import exp
+from os import getenv
 from re import findall, search
 
 from astral import LocationInfo as Loc
 from astral.sun import sun
+from dotenv import load_dotenv
 from flask import jsonify, Response
+import numpy as np
 from timezonefinder import TimezoneFinder
 
-# datamaps_dir = "/home/animatronic/mysite/static/data_maps/"
-# with open(datamaps_dir + "icons.json") as f: ICONS = json.load(f)
-# with open(datamaps_dir + "NBMstations.json") as f: STATIONS = json.load(f)
-with open("static/data_maps/icons.json") as f: ICONS = json.load(f)
-with open("static/data_maps/NBMstations.json") as f: STATIONS = json.load(f)
-ICON_HI = {k: v["hierarchy"] for k, v in ICONS.items()}
+from src.metrics import traced
+from src.tables import load
+
+# Station and icon tables are compiled from static/data_maps and loaded on first use
+# STATIONS and ICONS are read-only structured arrays (see src.tables), ICON_HI a dict
+def __getattr__(name):
+    if name == "STATIONS": return load("stations")
+    if name == "ICONS": return load("icons")
+    if name == "ICON_HI": return get_icon_hi()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@lru_cache(maxsize=None)
+def get_icon_ids():
+    # Returns icon name -> ICONS row idx
+    return {n.decode(): i for i, n in enumerate(load("icons")["name"])}
+
+@lru_cache(maxsize=None)
+def get_icon_hi():
+    # Returns icon name -> hierarchy (None if it has none) in icons.json order
+    icons = load("icons")
+    return {n.decode(): None if h < 0 else int(h) for n, h in zip(icons["name"], icons["hierarchy"].tolist())}
 
 # Bounding boxes US regions. Format: minlat, maxlat, minlon, maxlon
 US_BBOXS = {
@@ -29,6 +45,10 @@ US_BBOXS = {
 CODES = {
     "InvalidPoint": {"n": "InvalidPoint", "c": 461, "d": "lat and lon arguments must be float values corresponding to a geopoint within the US including AK, GU, HI, and PR"},
     "InvalidAddress": {"n": "InvalidAddress", "c": 462, "d": "The address argument must be a string corresponding to a location within the US including AK, GU, HI, and PR; e.g., 'Bushwick, Brooklyn'"},
+    "InvalidPoints": {"n": "InvalidPoints", "c": 463, "d": "The request body must be a JSON object whose points are a non-empty list of [lat, lon] pairs or {lat, lon} objects, up to the server's max points"},
+    "InvalidBatch": {"n": "InvalidBatch", "c": 464, "d": "The request body must be a JSON object whose items are a non-empty list of {route, lat, lon} (or {route, address}) objects, up to the server's max batch size"},
+    "InvalidRoute": {"n": "InvalidRoute", "c": 465, "d": "A batch item's route must be one of forward, reverse, alerts, almanac, current, forecast or hourly"},
+    "InvalidParams": {"n": "InvalidParams", "c": 466, "d": "Optional arguments must be whole numbers in range (days: 1-10 for forecast, hours: 1-72 for hourly); routes take no other arguments"},
     "google": {"n": "GoogleGeocodeAPIError", "c": 521, "d": "The Google Maps Geocoding API request failed"},
     "nbm_text": {"n": "NBMRequestFailed", "c": 522, "d": "The NOMADS request for the NBM text bulletin request failed"},
     "ndfd": {"n": "NDFDAPIError", "c": 523, "d": "The NDFD XML API request failed"},
@@ -43,9 +63,28 @@ URLS = {
     "nominatim": "https://nominatim.openstreetmap.org/reverse", 
     "mapclick": "https://forecast.weather.gov/MapClick.php",
     "ndfd": "https://digital.mdl.nws.noaa.gov/xml/sample_products/browser_interface/ndfdXMLclient.php",
+    "google": "https://maps.googleapis.com",
 }
 
-def validate(route, lat=None, lon=None, address=None):
+load_dotenv()
+
+# Decimal places lat/lon are rounded to for timezone lookups and the lookup cache size
+TZ_PRECISION = int(getenv("TZ_PRECISION", 3))
+TZ_CACHE_SIZE = int(getenv("TZ_CACHE_SIZE", 16384))
+
+# Decimal places lat/lon are rounded to for sun events and the events cache size
+SUN_PRECISION = int(getenv("SUN_PRECISION", 2))
+SUN_CACHE_SIZE = int(getenv("SUN_CACHE_SIZE", 16384))
+
+# Optional whole-number args by route and their (min, max)
+ROUTE_PARAMS = {"forecast": {"days": (1, 10)}, "hourly": {"hours": (1, 72)}}
+
+def validate(route, lat=None, lon=None, address=None, **params):
+    # Check that any other args are the route's optional args (already ints) and in range
+    ranges = ROUTE_PARAMS.get(route, {})
+    if not all([k in ranges and type(v) == int and ranges[k][0] <= v <= ranges[k][1] for k, v in params.items()]):
+        return "InvalidParams"
+
     # Check that address is a string or a zipcode (long or short)
     val_address = type(address) == str or len(str(address)) in (5, 9)
 
@@ -64,40 +103,84 @@ def gen_response(data):
     code, ctype = f'{CODES[data]["c"]} {CODES[data]["n"]}', "string"
     return Response(data, headers={"Content-Type": ctype}), code
 
+def responds(route):
+    # Wraps a route that returns data or a CODES key so it returns gen_response(...) instead
+    # The raw route stays at route.__wrapped__ for batch requests
+    @wraps(route)
+    def wrapper(*args, **kwargs): return gen_response(route(*args, **kwargs))
+
+    return wrapper
+
+def responds_async(route):
+    # responds() for a coroutine function route
+    @wraps(route)
+    async def wrapper(*args, **kwargs): return gen_response(await route(*args, **kwargs))
+
+    return wrapper
+
+def gen_error(data):
+    # Returns the JSON for an error code as one item of a multi-item response
+    return {"error": CODES[data]["n"], "code": CODES[data]["c"]}
+
 def isnum(x):
     # Helper method to quickly determine if a value is numeric
     if type(x) in (bool, None): return None
     try: return float(x)
     except (ValueError, TypeError): return None
 
-def icon_wx(lat, lon, name=None, link=None):
-    # Returns day/night accurate icon url from icons using astral
+def isint(x):
+    # Returns x as an int if it's a whole number, else None
+    x = isnum(x)
+    return int(x) if x is not None and x.is_integer() else None
 
-    # Calculate day or night value
-    if inspect.stack()[1][3] == "finalize_current":
-        date = dt.now(tz=tz.utc)
-        s = sun(Loc("", "", "", lat, lon).observer, date)
-        daynite = "day" if (s["sunrise"] < date < s["dusk"]) else "night"
-    else: daynite = "day"
+def icon_wx(lat, lon, name=None, link=None, date=None):
+    # Returns day/night accurate icon url from icons using astral
+    # Icons are day icons unless a tz-aware date is given that falls outside sunrise-dusk
+    s = get_sun(lat, lon, date) if date else None
+    daynite = "night" if s and not (s["sunrise"] < date < s["dusk"]) else "day"
 
     # Parse link for icon name
     if link and not name:
         if "DualImage" in link:
             names = findall(r"(?<=\?[a-z]{1}=)\w+(?=&)|(?<=&[a-z]{1}=)\w+(?=&)", link)
-            name = max(names, key=lambda x: ICON_HI[x]) if names else "skc"
+            name = max(names, key=lambda x: get_icon_hi()[x]) if names else "skc"
         else:
             try: name = search(r"\D+", search(r"(?<=/)\w+(?=\.[a-z]{3}$)", link).group(0)).group(0)
             except: name = "skc"
     elif not name: name = "skc"
 
-    return {"icon": ICONS[name][daynite], "wx": ICONS[name]["description"]}
+    icon = load("icons")[get_icon_ids()[name]]
+    return {"icon": icon[daynite].decode(), "wx": icon["description"].decode()}
 
-def get_tz(lat, lon):
-    # Helper method that returns the timezone using timezonefinder
-    return TimezoneFinder().timezone_at(lat=lat, lng=lon)
+@lru_cache(maxsize=None)
+def get_tzfinder():
+    # Returns the process-wide TimezoneFinder, created on first use
+    return TimezoneFinder()
 
-def get_hix(t, rh):
-    # Returns heat index if relevant. Source:
+@lru_cache(maxsize=TZ_CACHE_SIZE)
+@traced("tz")
+def tz_at(lat, lon):
+    # Returns the timezone for an already-quantized point
+    return get_tzfinder().timezone_at(lat=lat, lng=lon)
+
+def get_tz(lat, lon, precision=TZ_PRECISION):
+    # Helper method that returns the timezone using timezonefinder, memoized by grid point
+    # Hit/miss counts are available from tz_at.cache_info()
+    return tz_at(round(lat, precision), round(lon, precision))
+
+@lru_cache(maxsize=SUN_CACHE_SIZE)
+def sun_on(lat, lon, day, tzinfo):
+    # Returns astral sun events for an already-quantized point and local date
+    # None if the sun doesn't rise or set that day (e.g., polar day/night)
+    try: return sun(Loc("", "", "", lat, lon).observer, day, tzinfo=tzinfo)
+    except ValueError: return None
+
+def get_sun(lat, lon, date, precision=SUN_PRECISION):
+    # Returns dawn, sunrise, noon, sunset and dusk on the local date of a tz-aware date
+    return sun_on(round(lat, precision), round(lon, precision), date.date(), date.tzinfo)
+
+def calc_hix(t, rh):
+    # Returns the heat index (of numbers or arrays). Source:
     # Anderson, G Brooke et al. “Methods to calculate the heat index as an exposure 
     # metric in environmental health research.” Environmental health perspectives 
     # vol. 121,10 (2013): 1111-9. doi:10.1289/ehp.1206273
@@ -109,18 +192,18 @@ def get_hix(t, rh):
     hix += (c5 * t ** 2) + (c6 * rh ** 2) + (c7 * t ** 2 * rh)
     hix += (c8 * t * rh ** 2) + (c9 * t ** 2 * rh ** 2)
 
-    return round(hix) if hix >= 95 else None
+    return hix
 
-def get_chill(t, ws):
-    # Returns wind chill if relevant 
+def calc_chill(t, ws):
+    # Returns the wind chill (of numbers or arrays)
     # Model from the National Weather Service
     c1, c2, c3, c4 = 35.74, 0.6125, 35.75, 0.427
 
-    wc = c1 + (c2 * t) - (c3 * ws ** 0.16) + (c4 * t * ws ** 0.16)
-    return round(wc) if wc <= -18 else None
+    v = ws ** 0.16
+    return c1 + (c2 * t) - (c3 * v) + (c4 * t * v)
 
-def get_rh(t, dpt):
-    # Returns relative humidity. Source:
+def calc_rh(t, dpt, exp=exp):
+    # Returns relative humidity (of numbers, or arrays with exp=np.exp). Source:
     # Alduchov, Oleg; Eskridge, Robert (1997-11-01), Improved Magnus' Form 
     # Approximation of Saturation Vapor Pressure, NOAA, doi:10.2172/548871
     t, dpt = (t - 32) * (5 / 9), (dpt - 32) * (5 / 9)
@@ -128,6 +211,20 @@ def get_rh(t, dpt):
 
     return 100 * ((exp((b * dpt) / (l + dpt)) / exp((b * t) / (l + t))))
 
+def get_hix(t, rh):
+    # Returns heat index if relevant
+    hix = calc_hix(t, rh)
+    return round(hix) if hix >= 95 else None
+
+def get_chill(t, ws):
+    # Returns wind chill if relevant 
+    wc = calc_chill(t, ws)
+    return round(wc) if wc <= -18 else None
+
+def get_rh(t, dpt):
+    # Returns relative humidity
+    return calc_rh(t, dpt)
+
 def wx_calcs(t=None, ws=None, rh=None, dpt=None):
     # Returns a dict with heat index, wind chill, and relative humidity
     response = {} if rh else {"rh": None}
@@ -142,3 +239,20 @@ def wx_calcs(t=None, ws=None, rh=None, dpt=None):
     response["chill"] = get_chill(t, ws) if t and ws else None
 
     return response
+
+def wx_calcs_many(t, ws=None, rh=None, dpt=None):
+    # Returns wx_calcs over float arrays (NaN for None) as a dict of arrays, NaN where it
+    # gives None. 0 counts as missing like in wx_calcs, and rh is the given rh where there's
+    # one, else calculated from t and dpt
+    nan = np.full(np.shape(t), np.nan)
+    ws, rh, dpt = [nan if x is None else x for x in (ws, rh, dpt)]
+    ok = lambda x: ~np.isnan(x) & (x != 0)
+
+    with np.errstate(invalid="ignore", over="ignore", divide="ignore"):
+        rh = np.where(ok(rh), rh, np.where(ok(t) & ok(dpt), calc_rh(t, dpt, np.exp), np.nan))
+        hix, wc = calc_hix(t, rh), calc_chill(t, ws)
+
+        return {
+            "rh": rh, "heat": np.where(ok(t) & ok(rh) & (hix >= 95), np.round(hix), np.nan),
+            "chill": np.where(ok(t) & ok(ws) & (wc <= -18), np.round(wc), np.nan)
+        }
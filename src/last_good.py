@@ -0,0 +1,151 @@
+from asyncio import get_running_loop
+from collections import OrderedDict
+from contextvars import ContextVar
+from os import getenv
+from threading import Lock
+from time import time
+
+from src.client import submit
+
+# Secs each source's last good results are served as is; older ones are served marked stale
+# while they're refreshed in the background
+FRESH = {"ndfd": 300, "syn": 120, "mapclick": 86400}
+
+# Max secs old a last good result can be to be served, max results kept, and decimal places
+# points are snapped to for keys
+MAX_STALE = int(getenv("MAX_STALE", 3 * 3600))
+LAST_GOOD_SIZE = int(getenv("LAST_GOOD_SIZE", 16384))
+LAST_GOOD_PRECISION = 2
+
+# The current request's {source: secs old of the oldest stale result it used}, None outside requests
+STALE = ContextVar("stale", default=None)
+
+def begin_stale():
+    # Starts collecting the current request's stale sources
+    STALE.set({})
+
+def mark_stale(source, age):
+    # Records that the current request used a result from source that's age secs old
+    stale = STALE.get()
+    if stale is not None: stale[source] = max(stale.get(source, 0), round(age))
+
+def is_stale():
+    return bool(STALE.get())
+
+def finish_stale():
+    # Returns the current request's X-Stale header value (None if it used no stale results)
+    stale, _ = STALE.get() or {}, STALE.set(None)
+    return ", ".join([f"{k};age={v}" for k, v in stale.items()]) or None
+
+def point_key(lat, lon):
+    return f"{round(lat, LAST_GOOD_PRECISION)},{round(lon, LAST_GOOD_PRECISION)}"
+
+class LastGood:
+    # The last good result of upstream sources keyed by (source, key), so requests can be
+    # answered when an upstream is slow or down. Loads return None when they fail
+
+    def __init__(self, size=LAST_GOOD_SIZE, max_stale=MAX_STALE):
+        self.size, self.max_stale = size, max_stale
+        self.entries, self.refreshing, self.tasks, self.lock = OrderedDict(), set(), set(), Lock()
+        self.counts = {"fresh": 0, "stale": 0, "misses": 0, "fallbacks": 0, "refreshes": 0}
+
+    def put(self, source, key, value):
+        # Stores a good result, evicting the least recently stored beyond self.size
+        with self.lock:
+            self.entries.pop((source, key), None)
+            self.entries[(source, key)] = (value, time())
+            while len(self.entries) > self.size: self.entries.popitem(last=False)
+
+    def peek(self, source, key):
+        # Returns (value, secs old) of the last good result, (None, None) if there's none
+        # within max_stale
+        with self.lock: value, at = self.entries.get((source, key), (None, 0))
+        return (value, time() - at) if value is not None and time() - at <= self.max_stale else (None, None)
+
+    def load(self, source, key, load):
+        # Returns load(), keeping it as the last good result if it didn't fail
+        value = load()
+        if value is not None: self.put(source, key, value)
+        return value
+
+    def get(self, source, key, load):
+        # Returns the last good result as is if it's younger than FRESH[source] secs, marked
+        # stale (and refreshed in the background) if it's older, else load()
+        value, age = self.peek(source, key)
+        if value is None:
+            self.counts["misses"] += 1
+            return self.load(source, key, load)
+
+        if age < FRESH.get(source, 0): self.counts["fresh"] += 1
+        else:
+            self.counts["stale"] += 1
+            mark_stale(source, age)
+            self.refresh(source, key, load)
+
+        return value
+
+    async def get_async(self, source, key, load):
+        # get() for a coroutine function load, refreshing in a task of the running loop
+        value, age = self.peek(source, key)
+        if value is None:
+            self.counts["misses"] += 1
+            value = await load()
+            if value is not None: self.put(source, key, value)
+            return value
+
+        if age < FRESH.get(source, 0): self.counts["fresh"] += 1
+        else:
+            self.counts["stale"] += 1
+            mark_stale(source, age)
+            self.refresh_async(source, key, load)
+
+        return value
+
+    def fallback(self, source, key):
+        # Returns the last good result marked stale for a failed load, None if there's none
+        value, age = self.peek(source, key)
+        if value is not None:
+            self.counts["fallbacks"] += 1
+            mark_stale(source, age)
+
+        return value
+
+    def refresh(self, source, key, load):
+        # Runs load in the pool to replace a result, unless it's already being refreshed
+        with self.lock:
+            if (source, key) in self.refreshing: return
+            self.refreshing.add((source, key))
+
+        def run():
+            try: self.load(source, key, load)
+            finally:
+                with self.lock: self.refreshing.discard((source, key))
+
+        self.counts["refreshes"] += 1
+        submit(run)
+
+    def refresh_async(self, source, key, load):
+        # refresh() for a coroutine function load
+        with self.lock:
+            if (source, key) in self.refreshing: return
+            self.refreshing.add((source, key))
+
+        async def run():
+            try:
+                value = await load()
+                if value is not None: self.put(source, key, value)
+            finally:
+                with self.lock: self.refreshing.discard((source, key))
+
+        # Hold a reference so the task isn't collected before it's done
+        self.counts["refreshes"] += 1
+        task = get_running_loop().create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def stats(self):
+        # Returns fresh/stale/miss counts and the number of results held
+        return {**self.counts, "entries": len(self.entries)}
+
+
+LAST_GOOD = LastGood()
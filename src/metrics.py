@@ -0,0 +1,145 @@
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from os import getenv
+from threading import Lock
+from time import perf_counter
+
+# Time request stages and upstream calls (set METRICS=0 to turn spans, Server-Timing and
+# /metrics histograms off; spans then cost one global lookup)
+METRICS = getenv("METRICS", "1") != "0"
+
+# Histogram bucket upper bounds in secs
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The current request's {stage: [secs of each call]}, None outside requests
+SPANS = ContextVar("spans", default=None)
+
+class Histograms:
+    # Prometheus-style latency histograms and error counts keyed by (metric, label)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets, self.series, self.lock = buckets, {}, Lock()
+
+    def get(self, metric, label):
+        # Returns a series, creating it on first use (call with self.lock held)
+        return self.series.setdefault((metric, label), {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0, "errors": 0})
+
+    def observe(self, metric, label, secs, error=False):
+        with self.lock:
+            s = self.get(metric, label)
+            idx = bisect_left(self.buckets, secs)
+            if idx < len(self.buckets): s["buckets"][idx] += 1
+            s["sum"], s["count"], s["errors"] = s["sum"] + secs, s["count"] + 1, s["errors"] + error
+
+    def error(self, metric, label):
+        # Counts an error without a latency (e.g., an upstream 5xx after a timed call)
+        with self.lock: self.get(metric, label)["errors"] += 1
+
+    def render(self):
+        # Returns the histograms and error counts in the Prometheus text format
+        lines, names = [], {"request": "route", "upstream": "upstream", "stage": "stage"}
+        with self.lock: series = {k: {**v, "buckets": list(v["buckets"])} for k, v in self.series.items()}
+
+        for metric in names:
+            keys = sorted([k for k in series if k[0] == metric])
+            if not keys: continue
+
+            name = f"rainbow_{metric}_seconds"
+            lines += [f"# HELP {name} {metric.title()} latency in secs", f"# TYPE {name} histogram"]
+            for _, label in keys:
+                s, total, tag = series[(metric, label)], 0, f'{names[metric]}="{label}"'
+                for bound, count in zip(self.buckets, s["buckets"]):
+                    total += count
+                    lines.append(f'{name}_bucket{{{tag},le="{bound}"}} {total}')
+                lines += [f'{name}_bucket{{{tag},le="+Inf"}} {s["count"]}', f"{name}_sum{{{tag}}} {s['sum']:.6f}",
+                          f"{name}_count{{{tag}}} {s['count']}"]
+
+            if metric == "stage": continue
+            name = f"rainbow_{metric}_errors_total"
+            lines += [f"# HELP {name} {metric.title()} errors", f"# TYPE {name} counter"]
+            lines += [f'{name}{{{names[metric]}="{label}"}} {series[(metric, label)]["errors"]}' for _, label in keys]
+
+        return lines
+
+
+HISTOGRAMS = Histograms()
+
+@contextmanager
+def timed_span(name):
+    # Records the wrapped block's secs under the request's stage and the stage histogram
+    start = perf_counter()
+    try: yield
+    finally:
+        secs, spans = perf_counter() - start, SPANS.get()
+        if spans is not None:
+            # Spans from pool threads share the request's dict; setdefault/append are atomic
+            spans.setdefault(name, []).append(secs)
+        HISTOGRAMS.observe("stage", name, secs)
+
+NULL_SPAN = nullcontext()
+
+def span(name):
+    # Returns a context manager timing a request stage, a no-op if METRICS is off
+    return timed_span(name) if METRICS else NULL_SPAN
+
+def traced(name):
+    # Decorates a function (or coroutine function) to run in span(name); returns it unwrapped
+    # if METRICS is off
+    def decorator(f):
+        if not METRICS: return f
+
+        if iscoroutinefunction(f):
+            @wraps(f)
+            async def async_wrapper(*args, **kwargs):
+                with timed_span(name): return await f(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with timed_span(name): return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def begin():
+    # Starts collecting the current request's spans
+    if METRICS: SPANS.set({})
+
+def finish(route, secs, error):
+    # Records a request's latency and returns its Server-Timing header value (None if off)
+    if not METRICS: return None
+
+    HISTOGRAMS.observe("request", route, secs, error)
+    spans, _ = SPANS.get() or {}, SPANS.set(None)
+
+    timing = [f"{name};dur={1000 * sum(times):.1f}" + (f';desc="x{len(times)}"' if len(times) > 1 else "")
+              for name, times in spans.items()]
+    return ", ".join(timing + [f"total;dur={1000 * secs:.1f}"])
+
+def upstream(key, secs, error):
+    # Records an upstream call in its histogram and as a request stage
+    if not METRICS: return
+
+    HISTOGRAMS.observe("upstream", key, secs, error)
+    spans = SPANS.get()
+    if spans is not None: spans.setdefault(f"upstream.{key}", []).append(secs)
+
+def upstream_error(key):
+    if METRICS: HISTOGRAMS.error("upstream", key)
+
+def render(gauges):
+    # Returns the Prometheus text for the histograms plus gauges ({group: stats dict}); only
+    # numeric stats are exported
+    lines = HISTOGRAMS.render()
+    for group, stats in gauges.items():
+        for k, v in stats.items():
+            if type(v) not in (int, float) or type(v) == bool: continue
+            name = f"rainbow_{group}_{k}"
+            lines += [f"# TYPE {name} gauge", f"{name} {v}"]
+
+    return "\n".join(lines) + "\n"
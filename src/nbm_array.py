@@ -0,0 +1,108 @@
+from datetime import datetime as dt, timedelta as tdelta
+import json
+from os import path, replace
+from re import finditer, search
+import numpy as np
+
+from src.metrics import traced
+
+class NBMArray:
+    # A whole NBM bulletin as a stations x elems x hours float array. Missing and -99
+    # values are NaN, CIG is in ft (inf if unlimited) and VIS in miles
+
+    def __init__(self, stations, elems, hours, data):
+        self.stations, self.elems, self.hours, self.data = stations, elems, hours, data
+
+    def view(self, station):
+        # Returns a station's elems x hours data (a view, not a copy), None if it's missing
+        return self.data[self.stations[station]] if station in self.stations else None
+
+    def to_dict(self, station):
+        # Returns a station's data keyed by hour then elem (like bench/nbm_parse.py's per-station
+        # parser)
+        data = self.view(station)
+        if data is None: return "nbm_text"
+
+        value = lambda v: None if np.isnan(v) else "Unlimited" if np.isinf(v) else v
+        return {hr: {e: value(v) for e, v in zip(self.elems, data[:, i].tolist())}
+                for i, hr in enumerate(self.hours)}
+
+def save(array, file):
+    # Writes an NBMArray as file.npy (its data) and file.json (its station index, elems and
+    # hours), each atomically and the data last so readers that find the data find both
+    meta = {"stations": sorted(array.stations, key=array.stations.get), "elems": array.elems,
+            "hours": [h.isoformat() for h in array.hours]}
+    with open(file + ".json.part", "w") as f: json.dump(meta, f)
+    replace(file + ".json.part", file + ".json")
+
+    with open(file + ".npy.part", "wb") as f: np.save(f, np.ascontiguousarray(array.data))
+    replace(file + ".npy.part", file + ".npy")
+
+def load(file):
+    # Returns an NBMArray written by save() with its data memory-mapped read-only, so every
+    # process that loads it shares one copy of its pages; None if it hasn't been saved
+    if not path.exists(file + ".npy"): return None
+    with open(file + ".json") as f: meta = json.load(f)
+
+    data = np.load(file + ".npy", mmap_mode="r").view(np.ndarray)
+    return NBMArray({s: i for i, s in enumerate(meta["stations"])}, meta["elems"],
+                    [dt.fromisoformat(h) for h in meta["hours"]], data)
+
+@traced("nbm.parse")
+def parse_bulletin(bulletin, index, nbm_date, spec):
+    # Returns an NBMArray for every station in a bulletin (bytes or mmap) given its
+    # station -> (start, end) byte index and product spec from forecast_mthds.PRODUCTS
+    h_iter, h_row, elems, get_sdate = spec.values()
+    if not index: return None
+
+    # Column layout and 1st hour come from the 1st block; all blocks in a cycle share them
+    start, end = min(index.values())
+    b = bytes(bulletin[start:end]).decode().split("\n")
+    if "CLIMO" in b[1]: b = [x[:b[1].index("CLIMO")] for x in b]
+
+    idxs = [search(r"\w{3}", b[h_row]).end()] + [h.end(0) for h in finditer(r"\d+", b[h_row])]
+    hr0, width = get_sdate(b, nbm_date), idxs[-1]
+    hours = [hr0 + tdelta(hours=(i * h_iter)) for i in range(len(idxs) - 1)]
+
+    # Find line starts and the 3-letter elem label of each line
+    buf = np.frombuffer(bulletin, dtype=np.uint8)
+    starts = np.concatenate([[0], np.flatnonzero(buf == 10) + 1])
+    ends = np.concatenate([starts[1:] - 1, [len(buf)]])
+    lbl = np.minimum(starts + (buf[np.minimum(starts, len(buf) - 1)] == 32), len(buf) - 3)
+    codes = (buf[lbl].astype(np.int32) << 16) | (buf[lbl + 1].astype(np.int32) << 8) | buf[lbl + 2]
+
+    # Keep rows of wanted elems inside station blocks and map each to its station and elem
+    stations = sorted(index, key=lambda s: index[s][0])
+    block_starts = np.array([index[s][0] for s in stations])
+    elem_codes = np.array([int.from_bytes(e.encode(), "big") for e in elems])
+    order = np.argsort(elem_codes)
+
+    rows = np.flatnonzero(np.isin(codes, elem_codes) & (starts >= block_starts[0]))
+    row_stn = np.searchsorted(block_starts, starts[rows], side="right") - 1
+    row_elem = order[np.searchsorted(elem_codes[order], codes[rows])]
+
+    # Gather rows into a fixed-width char matrix, blanking anything past each line's end
+    cols = starts[rows][:, None] + np.arange(width)[None, :]
+    chars = np.where(cols < ends[rows][:, None], buf[np.minimum(cols, len(buf) - 1)], 32)
+
+    # Decode each hour col: digits of its 1st number, negative if it has a minus sign
+    values = np.full((len(rows), len(hours)), np.nan)
+    for i in range(len(hours)):
+        cell = chars[:, idxs[i]:idxs[i + 1]].astype(np.int64)
+        digit = (cell >= 48) & (cell <= 57)
+        value = np.zeros(len(rows))
+        for j in range(cell.shape[1]): value = np.where(digit[:, j], value * 10 + cell[:, j] - 48, value)
+        sign = np.where((cell == 45).any(axis=1), -1, 1)
+        values[:, i] = np.where(digit.any(axis=1), sign * value, np.nan)
+
+    # Apply NBM conventions: -99 missing; cig in 100s ft, -88 if unlimited; vis in 1/10 miles
+    values[values == -99] = np.nan
+    if "CIG" in elems:
+        cig = row_elem == elems.index("CIG")
+        values[cig] = np.where(values[cig] == -88, np.inf, values[cig] * 100)
+    if "VIS" in elems: values[row_elem == elems.index("VIS")] /= 10
+
+    data = np.full((len(stations), len(elems), len(hours)), np.nan)
+    data[row_stn, row_elem] = values
+
+    return NBMArray({s: i for i, s in enumerate(stations)}, elems, hours, data)
@@ -0,0 +1,287 @@
+from contextlib import contextmanager
+from datetime import datetime as dt, timedelta as tdelta
+from fcntl import lockf, LOCK_EX
+from mmap import mmap, ACCESS_READ
+from os import getenv, makedirs, path, register_at_fork, remove, replace
+from re import compile as recompile, M
+from tempfile import gettempdir
+from threading import Lock, Thread
+from time import sleep, time
+from requests import HTTPError, RequestException
+
+from src.client import fetch
+from src.helpers import URLS
+from src.last_good import mark_stale
+from src.metrics import traced
+from src.nbm_array import load as load_array, save as save_array
+
+# Cycles kept per product, secs before re-probing a missing cycle, max hrs to probe back
+KEEP_CYCLES, MISS_TTL, MAX_PROBE = 2, 300, 24
+
+# Fewest station blocks (and parsed stations) a cycle's bulletin must have to be handed to
+# requests; fewer means it's truncated or garbled and is fetched again
+MIN_STATIONS = int(getenv("NBM_MIN_STATIONS", 1000))
+
+# Secs between background checks for new cycles, and products tracked from startup (others
+# are tracked once requested)
+POLL_EVERY = int(getenv("NBM_POLL_EVERY", 60))
+PREFETCH = [x for x in getenv("NBM_PREFETCH", "nbe,nbs,nbh").split(",") if x]
+
+# Local dir bulletins are downloaded to and memory-mapped from
+NBM_DIR = getenv("NBM_DIR", path.join(gettempdir(), "rainbow-rest", "nbm"))
+
+# Share parsed cycles between the worker processes using NBM_DIR: one parses each cycle into
+# memory-mapped files there and the others map them read-only (set NBM_SHARED=0 to parse in
+# each process)
+NBM_SHARED = getenv("NBM_SHARED", "1") != "0"
+
+# Station block header, e.g. " KDEN    NBM V4.1 NBS GUIDANCE ..."
+HEADER = recompile(rb"^ ?(\S+) +NBM V", M)
+
+class BulletinStore:
+    # Caches NBM text bulletins keyed by (product, cycle) and the arrays parsed from them
+    # so each bulletin is downloaded and parsed once per cycle. Bulletins are kept on disk
+    # and memory-mapped
+    # A background tracker polls for new cycles and downloads and parses them before
+    # handing them to requests, so requests only probe NOMADS before it finds one
+    # Workers sharing a dir take turns (see writer) so each cycle is downloaded and parsed
+    # by one of them; the rest reuse its bulletin and parsed arrays
+
+    def __init__(self, keep=KEEP_CYCLES, miss_ttl=MISS_TTL, dir=NBM_DIR):
+        self.keep, self.miss_ttl, self.dir = keep, miss_ttl, dir
+        self.cycles, self.missing, self.ready, self.parsers, self.errors, self.version = {}, {}, {}, {}, {}, 0
+        self.locks, self.lock, self.tracker = {p: Lock() for p in ("nbe", "nbs", "nbh")}, Lock(), None
+        self.tracked = set(PREFETCH)
+        register_at_fork(after_in_child=self.forked)
+        self.counts = {"fetches": 0, "evictions": 0, "rejected": 0, "arrays": 0, "attached": 0, "probes": 0, "polls": 0}
+
+    def file(self, key):
+        # Returns the local path of a (product, cycle) bulletin
+        return path.join(self.dir, f"{key[0]}.{key[1]:%Y%m%d%H}.txt")
+
+    @contextmanager
+    def writer(self, product):
+        # Holds a product's lock across the processes sharing self.dir while one of them
+        # downloads or parses its cycles (released when the lock file closes)
+        # A POSIX lock, as unlike flock() it isn't inherited by processes forked while it's
+        # held; it doesn't exclude threads of this process, so hold the product's Lock too
+        makedirs(self.dir, exist_ok=True)
+        with open(path.join(self.dir, f"{product}.lock"), "w") as f:
+            lockf(f, LOCK_EX)
+            yield
+
+    def url(self, key):
+        # Returns the NOMADS url of a (product, cycle) bulletin
+        return URLS["nbm"] % {"d": key[1].strftime("%Y%m%d"), "h": key[1].strftime("%H"), "p": key[0]}
+
+    def latest(self, product):
+        # Returns the ready (product, cycle) key, None if none could be found
+        # Only requests made before the tracker has found a cycle probe NOMADS themselves
+        # The ready cycle is marked stale while the last check for a newer one failed
+        self.start()
+        self.tracked.add(product)
+        if product in self.ready:
+            if product in self.errors: mark_stale("nbm", (dt.utcnow() - self.ready[product][1]).total_seconds())
+            return self.ready[product]
+
+        with self.locks[product]: return self.ready.get(product) or self.discover(product)
+
+    @traced("nbm.probe")
+    def discover(self, product, since=None, retry_missing=False):
+        # Makes the newest published cycle (newer than since, within MAX_PROBE hrs) ready and
+        # returns its key, None if there's no new one. Probes are HEAD requests so unpublished
+        # cycles cost no body; recently unpublished ones are skipped unless retry_missing
+        # Call with the product's lock held
+        self.errors.pop(product, None)
+        date = dt.utcnow().replace(minute=0, second=0, microsecond=0)
+        if product == "nbh": date -= tdelta(hours=1)
+
+        for _ in range(MAX_PROBE):
+            key = (product, date)
+            if since and date <= since: return None
+
+            # Reuse a bulletin downloaded before a restart or by another process, which may
+            # evict it before it's mapped here (it's downloaded again then)
+            if key in self.cycles or path.exists(self.file(key)):
+                try: return self.make_ready(key)
+                except FileNotFoundError: pass
+
+            if retry_missing or self.missing.get(key, 0) < time():
+                # Another process may have downloaded it while this one waited
+                try:
+                    with self.writer(product): found = path.exists(self.file(key)) or (self.published(key) and self.download(key))
+                    if found: return self.make_ready(key)
+                except (RequestException, OSError):
+                    self.errors[product] = time()
+                    return None
+
+                self.missing[key] = time() + self.miss_ttl
+
+            date -= tdelta(hours=1)
+
+        return None
+
+    def published(self, key):
+        # Returns whether NOMADS has a cycle's bulletin, from a HEAD request
+        # Raises HTTPError on server errors so an outage isn't taken for unpublished cycles
+        self.counts["probes"] += 1
+        response = fetch("nbm", url=self.url(key), method="HEAD")
+        if response.status_code >= 500: raise HTTPError(f"NOMADS returned {response.status_code}", response=response)
+        return response.status_code == 200 and response.headers.get("Content-Length") != "0"
+
+    def make_ready(self, key):
+        # Maps a downloaded cycle, parses it if its product's parser is known, then hands it
+        # to requests (bumping the version so cached forecasts expire) and returns its key
+        # A cycle that doesn't look whole is dropped with its files instead (returning None),
+        # so the next poll downloads it again while requests keep the ready cycle
+        if key not in self.cycles: self.add(key)
+
+        cycle = self.cycles[key]
+        if key[0] in self.parsers and cycle["array"] is None: cycle["array"] = self.parse(key, self.parsers[key[0]])
+
+        if not self.whole(key):
+            del self.cycles[key]
+            self.remove_files(key)
+            self.errors[key[0]] = time()
+            self.counts["rejected"] += 1
+            return None
+
+        self.evict(key[0])
+        if self.ready.get(key[0]) != key:
+            self.ready[key[0]] = key
+            self.version += 1
+
+        return key
+
+    def whole(self, key):
+        # Returns whether a mapped cycle has MIN_STATIONS station blocks and, if its product
+        # has a parser, an array with as many stations
+        cycle, parsed = self.cycles[key], key[0] in self.parsers
+        if len(cycle["index"]) < MIN_STATIONS: return False
+        return not parsed or (cycle["array"] is not None and len(cycle["array"].stations) >= MIN_STATIONS)
+
+    def parse(self, key, parse_all):
+        # Returns parse_all(bulletin, index, cycle) for a cycle. Shared, that's the array saved
+        # next to its bulletin by the 1st process to parse it, memory-mapped; the others wait
+        # for it on the writer lock. Parses in memory if the dir isn't writable
+        cycle = self.cycles[key]
+        build = lambda: parse_all(cycle["mm"], cycle["index"], key[1])
+        if not NBM_SHARED:
+            self.counts["arrays"] += 1
+            return build()
+
+        array = None
+        try:
+            with self.writer(key[0]):
+                shared = load_array(self.file(key))
+                if shared is not None:
+                    self.counts["attached"] += 1
+                    return shared
+
+                array = build()
+                self.counts["arrays"] += 1
+                if array is None: return None
+
+                save_array(array, self.file(key))
+                return load_array(self.file(key))
+        except OSError:
+            return array if array is not None else build()
+
+    def poll(self):
+        # Makes the newest published cycle of each tracked product ready
+        for product in list(self.tracked):
+            with self.locks[product]:
+                ready = self.ready.get(product)
+                self.discover(product, ready[1] if ready else None, retry_missing=bool(ready))
+
+        self.counts["polls"] += 1
+
+    def start(self):
+        # Starts the background tracker (once per process, on first use)
+        if self.tracker and self.tracker.is_alive(): return
+
+        def loop():
+            while True:
+                try: self.poll()
+                except Exception: pass
+                sleep(POLL_EVERY)
+
+        with self.lock:
+            if not (self.tracker and self.tracker.is_alive()):
+                self.tracker = Thread(target=loop, name="nbm-tracker", daemon=True)
+                self.tracker.start()
+
+    def forked(self):
+        # Runs in forked children (pre-forked workers), which get none of the parent's
+        # threads and may get locks its threads held: replaces the locks and starts the
+        # child's own tracker if the parent had one
+        started = self.tracker is not None
+        self.locks, self.lock, self.tracker = {p: Lock() for p in ("nbe", "nbs", "nbh")}, Lock(), None
+        if started: self.start()
+
+    def download(self, key):
+        # Streams a bulletin to disk, returns False if it isn't published
+        with fetch("nbm", url=self.url(key), stream=True) as bulletin:
+            if bulletin.status_code != 200: return False
+
+            makedirs(self.dir, exist_ok=True)
+            with open(self.file(key) + ".part", "wb") as f:
+                for chunk in bulletin.iter_content(1 << 20): f.write(chunk)
+
+        # Treat an empty bulletin as unpublished
+        if not path.getsize(self.file(key) + ".part"): return False
+
+        replace(self.file(key) + ".part", self.file(key))
+        self.counts["fetches"] += 1
+
+        return True
+
+    def add(self, key):
+        # Maps a cycle's bulletin and indexes its station blocks in one pass
+        with open(self.file(key), "rb") as f: mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+        starts = [(m.group(1).decode(), m.start()) for m in HEADER.finditer(mm)]
+        index = {stn: (start, end) for (stn, start), (_, end) in zip(starts, starts[1:] + [("", len(mm))])}
+        self.cycles[key] = {"mm": mm, "index": index, "array": None}
+
+    def evict(self, product):
+        # Drops the product's oldest cycles beyond self.keep
+        # Evicted maps close once in-flight readers drop them; unlinking keeps them readable
+        old = sorted([k for k in self.cycles if k[0] == product], key=lambda k: k[1])[:-self.keep]
+        for k in old:
+            del self.cycles[k]
+            self.remove_files(k)
+        self.counts["evictions"] += len(old)
+
+        self.missing = {k: v for k, v in self.missing.items() if v >= time()}
+
+    def remove_files(self, key):
+        # Deletes a cycle's bulletin and parsed array files (another process may have already)
+        for file in (self.file(key), self.file(key) + ".npy", self.file(key) + ".json"):
+            try: remove(file)
+            except FileNotFoundError: pass
+
+    def array(self, product, parse_all):
+        # Returns parse_all(bulletin, index, cycle) for the latest cycle, built once per cycle
+        # The tracker builds new cycles' arrays with self.parsers before handing them over
+        self.parsers[product] = parse_all
+        key = self.latest(product)
+        if not key: return "nbm_text"
+
+        cycle = self.cycles.get(key)
+        if cycle and cycle["array"] is None:
+            with self.locks[product]:
+                if cycle["array"] is None: cycle["array"] = self.parse(key, parse_all)
+
+        return cycle["array"] if cycle and cycle["array"] is not None else "nbm_text"
+
+    def stats(self):
+        # Returns fetch/parse counts, the cycles currently held and ready and the store version
+        # Copies of the cycles, as the tracker adds and drops them meanwhile
+        return {
+            **self.counts, "cycles": [f"{p}.{d:%Y%m%d%H}" for p, d in sorted(list(self.cycles))],
+            "ready": {p: f"{d:%Y%m%d%H}" for p, (_, d) in sorted(list(self.ready.items()))}, "version": self.version
+        }
+
+
+BULLETINS = BulletinStore()
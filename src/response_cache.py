@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from datetime import datetime as dt
+from hashlib import blake2b
+from os import getenv
+from threading import Lock
+from time import time
+from zoneinfo import ZoneInfo
+
+from flask import Response, make_response
+
+from src.alerts_store import ALERTS
+from src.helpers import get_tz
+from src.last_good import is_stale
+from src.nbm_store import BULLETINS
+
+# Secs each route's responses are cached for
+ROUTE_TTLS = {"forward": 86400, "reverse": 86400, "alerts": 120, "almanac": 3600, "current": 300, "forecast": 1800, "hourly": 900}
+
+# Tokens that expire a route's cached responses early when they change: a new NBM cycle,
+# changed alerts, or a new local day
+ROUTE_VERSIONS = {
+    "forecast": lambda lat, lon: BULLETINS.version,
+    "hourly": lambda lat, lon: BULLETINS.version,
+    "alerts": lambda lat, lon: ALERTS.version,
+    "almanac": lambda lat, lon: dt.now(ZoneInfo(get_tz(lat, lon))).date(),
+}
+
+# Deg lat/lon are snapped to for cache keys, max entries and max response bytes held
+CACHE_GRID = float(getenv("CACHE_GRID", 0.01))
+CACHE_SIZE = int(getenv("CACHE_SIZE", 4096))
+CACHE_BYTES = int(getenv("CACHE_BYTES", 64 << 20))
+
+class ResponseCache:
+    # LRU cache of successful route responses keyed by route and grid-snapped point (or
+    # address). Entries expire after their route's TTL or when its version token changes
+
+    def __init__(self, size=CACHE_SIZE, max_bytes=CACHE_BYTES, grid=CACHE_GRID):
+        self.size, self.max_bytes, self.grid = size, max_bytes, grid
+        self.entries, self.bytes, self.lock = OrderedDict(), 0, Lock()
+        self.counts = {"hits": 0, "misses": 0, "not_modified": 0, "evictions": 0}
+
+    def snap(self, params):
+        # Returns params with lat/lon snapped to the grid so nearby points share an entry
+        if "lat" not in params: return params
+        snap = lambda x: round(round(x / self.grid) * self.grid, 6)
+        return {**params, "lat": snap(params["lat"]), "lon": snap(params["lon"])}
+
+    def version(self, route, params):
+        # Returns the route's current version token, None if it only expires by TTL
+        return ROUTE_VERSIONS[route](params["lat"], params["lon"]) if route in ROUTE_VERSIONS else None
+
+    def get(self, key, version):
+        # Returns a fresh entry for key (marking it recently used), None if there isn't one
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or entry["expires"] <= time() or entry["version"] != version: return None
+
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        # Stores an entry, evicting the least recently used beyond the size and byte limits
+        with self.lock:
+            if key in self.entries: self.bytes -= len(self.entries.pop(key)["body"])
+            self.entries[key], self.bytes = entry, self.bytes + len(entry["body"])
+
+            while self.entries and (len(self.entries) > self.size or self.bytes > self.max_bytes):
+                self.bytes -= len(self.entries.popitem(last=False)[1]["body"])
+                self.counts["evictions"] += 1
+
+    def respond(self, resource, route, params, handler, if_none_match=None):
+        # Returns handler(**params)'s response, from cache if fresh, with ETag/Cache-Control
+        # headers, or a 304 if if_none_match (werkzeug ETags) has its ETag. Errors and responses
+        # built from stale upstream results aren't cached
+        key, version, params, entry = self.lookup(resource, route, params)
+        if not entry:
+            response = make_response(handler(**params))
+            entry = self.store(key, version, route, response)
+            if not entry: return response
+
+        return self.serve(entry, if_none_match)
+
+    async def respond_async(self, resource, route, params, handler, if_none_match=None):
+        # respond() for a coroutine function handler
+        key, version, params, entry = self.lookup(resource, route, params)
+        if not entry:
+            response = make_response(await handler(**params))
+            entry = self.store(key, version, route, response)
+            if not entry: return response
+
+        return self.serve(entry, if_none_match)
+
+    def lookup(self, resource, route, params):
+        # Returns (key, version token, snapped params, fresh entry or None), counting a hit
+        # or miss
+        params = self.snap(params)
+        key, version = (resource, route, *sorted(params.items())), self.version(route, params)
+
+        entry = self.get(key, version)
+        self.counts["hits" if entry else "misses"] += 1
+
+        return key, version, params, entry
+
+    def store(self, key, version, route, response):
+        # Caches a handler's response under the version token taken before it ran and returns
+        # its entry, None if it can't be cached
+        # A response built while a new cycle/alerts came in is stored under the old token, so
+        # it's rebuilt on the next request rather than served as current until its TTL
+        if response.status_code != 200 or is_stale(): return None
+
+        body = response.get_data()
+        entry = {
+            "body": body, "mimetype": response.mimetype, "etag": blake2b(body, digest_size=16).hexdigest(),
+            "expires": time() + ROUTE_TTLS.get(route, 0), "version": version
+        }
+        self.put(key, entry)
+
+        return entry
+
+    def serve(self, entry, if_none_match=None):
+        # Returns the response for a cached entry, a 304 if if_none_match has its ETag
+        headers = {"ETag": f'"{entry["etag"]}"', "Cache-Control": f'public, max-age={max(int(entry["expires"] - time()), 0)}'}
+        if if_none_match and if_none_match.contains_weak(entry["etag"]):
+            self.counts["not_modified"] += 1
+            return Response(status=304, headers=headers)
+
+        return Response(entry["body"], mimetype=entry["mimetype"], headers=headers)
+
+    def stats(self):
+        # Returns hit/miss counts, the hit ratio and the entries and bytes held
+        requests = self.counts["hits"] + self.counts["misses"]
+        return {
+            **self.counts, "hit_ratio": round(self.counts["hits"] / requests, 3) if requests else None,
+            "entries": len(self.entries), "bytes": self.bytes
+        }
+
+
+RESPONSES = ResponseCache()
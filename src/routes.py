@@ -4,25 +4,66 @@ from dotenv import load_dotenv
 from datetime import datetime as dt, timedelta as tdelta, timezone as tz
 from zoneinfo import ZoneInfo
 
-from bs4 import BeautifulSoup as BSoup
+from functools import lru_cache
+from re import findall
 from googlemaps import Client as Maps
-from html import unescape
-from requests import get, JSONDecodeError
+from googlemaps.exceptions import ApiError, Timeout, TransportError
+import numpy as np
+from requests import JSONDecodeError, RequestException
 
-from src.helpers import ICON_HI, URLS, get_tz, gen_response, icon_wx
+from src.alerts_store import ALERTS
+from src.async_client import afetch
+from src.client import BREAKERS, SESSIONS, UPSTREAMS, CircuitOpen, fetch, timed
+from src.helpers import URLS, get_tz, gen_error, icon_wx, responds, responds_async
 from src.almanac_mthds import get_lunar, get_solar
-from src.current_mthds import get_ndfd, get_synoptic, finalize_current
-from src.forecast_mthds import get_nbm, parse_nbm
+from src.current_mthds import (
+    current_calcs, gather_current, gather_current_async, gather_current_many, get_ndfd, get_synoptic, finalize_current
+)
+from src.forecast_mthds import NBM_MSG, get_nbm_arrays, merge_hours
+from src.geocode_cache import GEOCODES, GEOCODE_PRECISION
+from src.metrics import span, traced
 
 load_dotenv()
 
+# Fetch /wx/current sources concurrently (set CURRENT_CONCURRENT=0 for one at a time)
+CURRENT_CONCURRENT = getenv("CURRENT_CONCURRENT", "1") != "0"
+
+@lru_cache(maxsize=None)
+def get_maps():
+    # Returns the shared Google Maps client, using the pooled "google" session
+    connect, read = UPSTREAMS["google"]["timeout"]
+    return Maps(
+        getenv("MAPS_KEY"), connect_timeout=connect, read_timeout=read, retry_timeout=read,
+        requests_session=SESSIONS["google"], base_url=URLS["google"]
+    )
+
+@responds
 def forward(address):
-    # Get geodata, return error code if missing data/failure
+    # Returns geodata for an address, from the geocode cache if it was looked up recently
+    key = " ".join(findall(r"[\w#]+", str(address).lower()))
+    found, msg = GEOCODES.get("forward", key)
+    if found: return msg or "google"
+
+    # Get geodata, return error code if the request failed or Google's breaker is open
+    try:
+        BREAKERS["google"].check()
+        with timed("google"): data = get_maps().geocode(address)
+    except CircuitOpen: return "google"
+    # Timeout is raised once retries of server errors run past retry_timeout
+    except (ApiError, Timeout, TransportError):
+        BREAKERS["google"].record(False)
+        return "google"
+
+    BREAKERS["google"].record(True)
+
+    # Return error code if missing data, remembering the address has no result
     try:
-        data = Maps(getenv("MAPS_KEY")).geocode(address)[0]
+        data = data[0]
         geo_comps, ad_comps = data["geometry"]["location"], data["address_components"]
         lat, lon = geo_comps["lat"], geo_comps["lng"]
-    except (IndexError, KeyError, TypeError): return gen_response("google")
+    except (IndexError, KeyError, TypeError):
+        GEOCODES.put("forward", key, None)
+        return "google"
 
     get_comp = lambda cs: [x for x in ad_comps if any([y in x["types"] for y in cs])] or None
     i0or_none = lambda cs: get_comp(cs)[0] if get_comp(cs) else None
@@ -41,14 +82,53 @@ def forward(address):
     loc_groups = [x for x in loc_groups if all(x)]
     loc = ", ".join([x["short_name"] for x in loc_groups[0]]) if loc_groups else None
 
-    return gen_response({"lat": lat, "lon": lon, "loc": loc, "tz": get_tz(lat, lon)})
+    msg = {"lat": lat, "lon": lon, "loc": loc, "tz": get_tz(lat, lon)}
+    GEOCODES.put("forward", key, msg)
+
+    return msg
 
+@responds
 def reverse(lat, lon):
-    try: data = get(
-        URLS["nominatim"], headers=eval(getenv("PERSONAL_USER_AGENT")), 
-        params={"lat": lat, "lon": lon, "format": "geojson"}
-    ).json()["features"][0]["properties"]["address"]
-    except (JSONDecodeError, KeyError, TypeError): gen_response("nominatim")
+    # Returns the address of a point snapped to GEOCODE_PRECISION, from the geocode cache if
+    # it was looked up recently
+    lat, lon = round(lat, GEOCODE_PRECISION), round(lon, GEOCODE_PRECISION)
+    found, msg = GEOCODES.get("reverse", f"{lat},{lon}")
+    if found: return msg or "nominatim"
+
+    # Return error code if the request failed or was refused (e.g., rate limited)
+    try:
+        data = fetch("nominatim", **reverse_query(lat, lon))
+        if data.status_code != 200: return "nominatim"
+        data = data.json()
+    except (JSONDecodeError, RequestException): return "nominatim"
+
+    return reverse_msg(lat, lon, data)
+
+@responds_async
+async def reverse_async(lat, lon):
+    # reverse() with a non-blocking Nominatim request
+    lat, lon = round(lat, GEOCODE_PRECISION), round(lon, GEOCODE_PRECISION)
+    found, msg = GEOCODES.get("reverse", f"{lat},{lon}")
+    if found: return msg or "nominatim"
+
+    try:
+        data = await afetch("nominatim", **reverse_query(lat, lon))
+        if data.status_code != 200: return "nominatim"
+        data = data.json()
+    except (ValueError, RequestException): return "nominatim"
+
+    return reverse_msg(lat, lon, data)
+
+def reverse_query(lat, lon):
+    return {"headers": eval(getenv("PERSONAL_USER_AGENT")), "params": {"lat": lat, "lon": lon, "format": "geojson"}}
+
+def reverse_msg(lat, lon, data):
+    # Returns reverse()'s msg from a Nominatim response, remembering the point in the geocode
+    # cache (as having no result if data has no address)
+    try: data = data["features"][0]["properties"]["address"]
+    except (IndexError, KeyError, TypeError):
+        GEOCODES.put("reverse", f"{lat},{lon}", None)
+        return "nominatim"
 
     targets = [
         "city_block", "subdivision", "neighbourhood", "quarter", 
@@ -56,88 +136,163 @@ def reverse(lat, lon):
         "county", "region", "state", "postcode", "country"
     ]
 
-    return gen_response({"address": ", ".join([data[x] for x in targets if x in data])})
+    msg = {"address": ", ".join([data[x] for x in targets if x in data])}
+    GEOCODES.put("reverse", f"{lat},{lon}", msg)
+
+    return msg
 
+@responds
 def alerts(lat, lon):
     # Returns active weather alerts collected from the NWS MapClick API
-    payload = {"lat": lat, "lon": lon, "unit": 0, "lg": "english", "FcstType": "json"}
+    with span("alerts"): data = ALERTS.get(lat, lon)
+    return alerts_msg(data)
+
+@responds_async
+async def alerts_async(lat, lon):
+    with span("alerts"): data = await ALERTS.get_async(lat, lon)
+    return alerts_msg(data)
 
-    try: 
-        data = get(URLS["mapclick"], payload).json()
-        zdata, adata = data["location"], data["data"]["hazardUrl"]
-    except (JSONDecodeError, KeyError): return gen_response("nws_mapclick")
+def alerts_msg(data):
+    # Returns alerts()'s msg from ALERTS.get's (zones, alert texts), error code if it's None
+    if not data: return "nws_mapclick"
 
     # Get alert zones and alerts or boilerplate "no alerts"
-    zones = ", ".join([zdata[x] for x in zdata if x in ["zone", "firezone", "county"]])
-    alerts = [a.text for a in [BSoup(get(unescape(l)).text, "lxml").pre for l in adata] if a]
+    zones, alerts = data
     alerts = alerts or ["There are no active watches, warnings or advisories."]
     alerts = ["<pre class='alert-entry'>" + a.replace("\n", "&#10;") + "</pre>" for a in alerts]
 
     msg = {"zones": zones, "alerts": alerts}
 
-    return gen_response(msg)
+    return msg
 
+@responds
 def almanac(lat, lon):
     tz = ZoneInfo(get_tz(lat, lon))
     date = dt.now(tz=tz)
 
-    return gen_response({
+    return {
         "solar": get_solar(lat, lon, tz, date), 
         "lunar": get_lunar(lat, lon, tz, date)
-    })
+    }
 
-def current(lat, lon):
-    msg = {**{"stations": []}, **{x: None for x in [
+def new_current():
+    # Returns an empty current() msg
+    return {**{"stations": []}, **{x: None for x in [
         "t", "rh", "dew", "wind", "vis", "p", "ceil", "heat", 
         "wbgt", "chill", "wx", "icon", "wspeed", "wgust", "wdir"
     ]}}
 
-    # Get NDFD data, return error if request failed
-    msg = get_ndfd(lat, lon, msg)
-    if msg == 500: return gen_response("ndfd")
+@responds
+def current(lat, lon):
+    msg = new_current()
 
-    # Get Synoptic data, return error if request failed
-    msg = get_synoptic(lat, lon, msg)
-    if msg == 500: return gen_response("synoptic")
+    # Get NDFD, NWS and Synoptic data concurrently, return error if a request failed
+    if CURRENT_CONCURRENT:
+        msg = gather_current(lat, lon, msg)
+        if type(msg) == str: return msg
+
+    else:
+        # Get NDFD data, return error if request failed
+        msg = get_ndfd(lat, lon, msg)
+        if msg == 500: return "ndfd"
+
+        # Get Synoptic data, return error if request failed
+        msg = get_synoptic(lat, lon, msg)
+        if msg == 500: return "synoptic"
 
     # 
     msg["stations"] = list(set(filter(None, msg["stations"])))
     
-    return gen_response(finalize_current(msg, lat, lon))
+    return finalize_current(msg, lat, lon)
+
+@responds_async
+async def current_async(lat, lon):
+    # current() with its sources requested without blocking (always concurrently)
+    msg = await gather_current_async(lat, lon, new_current())
+    if type(msg) == str: return msg
+
+    msg["stations"] = list(set(filter(None, msg["stations"])))
 
-def forecast(lat, lon):
-    # Returns forecasted weather data from the National Blend of Models
-    # Short and Extended products (NBS and NBE respectively)
+    return finalize_current(msg, lat, lon)
+
+def current_many(points):
+    # Returns current() data (or an error item) for each (lat, lon) in points from NDFD
+    # list-of-points and Synoptic bbox queries, so upstream calls grow with batches not points
+    msgs = gather_current_many(points, [new_current() for _ in points])
+    calcs = current_calcs(msgs)
+
+    return [gen_error(msg) if type(msg) == str else finalize_current(msg, lat, lon, c)
+            for msg, c, (lat, lon) in zip(msgs, calcs, points)]
+
+@responds
+def forecast(lat, lon, days=3):
+    # Returns forecasted weather data by day (3 by default, up to the NBE horizon) from the
+    # National Blend of Models Short and Extended products (NBS and NBE respectively)
     # See details here: https://vlab.noaa.gov/web/mdl/nbm-textcard-v4.1
-    day_range, products = 3, ["nbe", "nbs"]
+    arrays, stations = get_nbm_arrays([(lat, lon)], ["nbs", "nbe"])
+    return build_forecast(lat, lon, arrays, stations[0], days)
+
+def forecast_many(points, days=3):
+    # Returns forecast() data (or an error item) for each (lat, lon) in points, looking up
+    # their stations together and reading each product's bulletin once for the group
+    arrays, stations = get_nbm_arrays(points, ["nbs", "nbe"])
+    msgs = [build_forecast(lat, lon, arrays, s, days) for (lat, lon), s in zip(points, stations)]
+
+    return [gen_error(msg) if type(msg) == str else msg for msg in msgs]
 
-    # Get bulletins, return error response if any bulletin requests failed
-    bulletins = {p: get_nbm(lat, lon, p)[0] for p in products}
-    if any([type(x) != dict for x in bulletins.values()]): return gen_response("nbm_text")
+@traced("forecast.build")
+def build_forecast(lat, lon, arrays, station, days):
+    # Returns the daily forecast for a point from its station's nbs data by hour, and nbe data
+    # for hours nbs doesn't have, rolled up over all hours of each day at once
+    if any([type(x) == str or x.view(station) is None for x in arrays.values()]): return "nbm_text"
+    hours, data = merge_hours(*[(arrays[p], station) for p in ("nbs", "nbe")])
 
     # Determine local start date and convert to UTC
     local_sd = (dt.now(tz=ZoneInfo(get_tz(lat, lon))) + tdelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
     utc_sd = dt.utcfromtimestamp(local_sd.timestamp()).replace(tzinfo=tz.utc)
 
-    # Group bulletin data by local day and parse
-    msg = []
-    for x in range(day_range):
-        conds, temps, start = [], [], utc_sd + tdelta(hours=(24 * x))
-
-        for hr in [start + tdelta(hours=x) for x in range(24)]:
-            hdata = None
-            if hr in bulletins["nbs"]: hdata = parse_nbm(bulletins["nbs"][hr])
-            elif hr in bulletins["nbe"]: hdata = parse_nbm(bulletins["nbe"][hr])
-            
-            if hdata: conds.append(hdata["name"]), temps.append(hdata["t"])
+    # Days are 24 hr blocks from the local start date, up to the last bulletin hour
+    ts, msg = np.array([h.timestamp() for h in hours]), []
+    for x in range(days):
+        start = (utc_sd + tdelta(hours=(24 * x))).timestamp()
+        if start > ts[-1]: break
 
-        day_cond = max(conds, key=lambda x: ICON_HI[x]) if conds else "skc"
+        day = (ts >= start) & (ts < start + 86400)
+        temps = data["t"][day][~np.isnan(data["t"][day])]
+        day_cond = data["name"][day][data["hi"][day].argmax()] if day.any() else "skc"
 
         msg.append({**{
-            "hi": round(max(temps)) if temps else None, 
-            "lo": round(min(temps)) if temps else None,
+            "hi": round(float(temps.max())) if len(temps) else None,
+            "lo": round(float(temps.min())) if len(temps) else None,
             "wday": (local_sd + tdelta(days=x)).strftime("%a").upper()
         }, **icon_wx(lat, lon, day_cond)})
 
-    return gen_response(msg)
-     
\ No newline at end of file
+    return msg
+
+@responds
+def hourly(lat, lon, hours=24):
+    # Returns forecasted weather data by hour for the next hours from the NBM Hourly product
+    # (NBH), then the Short product's 3-hourly data past its horizon
+    arrays, stations = get_nbm_arrays([(lat, lon)], ["nbh", "nbs"])
+    return build_hourly(lat, lon, arrays, stations[0], hours)
+
+@traced("forecast.build")
+def build_hourly(lat, lon, arrays, station, hours):
+    # Returns parse_nbm's data and a day/night icon for each bulletin hour from the current
+    # hour to hours ahead
+    if any([type(x) == str or x.view(station) is None for x in arrays.values()]): return "nbm_text"
+    times, data = merge_hours(*[(arrays[p], station) for p in ("nbh", "nbs")])
+
+    now, tzinfo = dt.now(tz.utc).replace(minute=0, second=0, microsecond=0), ZoneInfo(get_tz(lat, lon))
+    idxs = [i for i, hr in enumerate(times) if now <= hr < now + tdelta(hours=hours)]
+
+    # NaN values are None and unlimited ceilings "Unlimited" like in NBMArray.to_dict
+    value = lambda v: None if v != v else "Unlimited" if v == float("inf") else v
+    cols = {k: [value(v) for v in data[k][idxs].tolist()] for k in [*NBM_MSG, "rh", "heat", "chill"]}
+
+    msg = []
+    for j, i in enumerate(idxs):
+        local = times[i].astimezone(tzinfo)
+        msg.append({"time": local.isoformat(), **{k: v[j] for k, v in cols.items()}, **icon_wx(lat, lon, data["name"][i], date=local)})
+
+    return msg
@@ -0,0 +1,73 @@
+from functools import lru_cache
+from itertools import product
+import numpy as np
+
+from src.tables import load
+
+EARTH_KM = 6371.0088
+
+# Rings of cells nearest() searches before scanning every station
+MAX_RINGS = 3
+
+def to_xyz(lats, lons):
+    # Returns unit-sphere xyz coords for lat/lon degrees
+    lats, lons = np.radians(np.asarray(lats, float)), np.radians(np.asarray(lons, float))
+    return np.stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)], axis=-1)
+
+class StationIndex:
+    # Grid-bucket spatial index over array-backed station coordinates. Buckets are cells
+    # of unit-sphere xyz space so distance bounds hold at the poles and antimeridian too
+
+    def __init__(self, ids, lats, lons, cell_km=100):
+        self.ids, self.cell = list(ids), cell_km / EARTH_KM
+        self.xyz = to_xyz(lats, lons)
+
+        # Bucket station idxs by xyz cell
+        cells = np.floor(self.xyz / self.cell).astype(int)
+        order = np.lexsort(cells.T[::-1])
+        keys, starts = np.unique(cells[order], axis=0, return_index=True)
+        self.buckets = {tuple(k): v for k, v in zip(keys.tolist(), np.split(order, starts[1:]))}
+
+    def ring(self, cell, r):
+        # Returns station idxs in the cells at Chebyshev distance r from cell
+        found = [self.buckets.get((cell[0] + a, cell[1] + b, cell[2] + c))
+                 for a, b, c in product(range(-r, r + 1), repeat=3) if max(abs(a), abs(b), abs(c)) == r]
+        return np.concatenate([x for x in found if x is not None] or [np.empty(0, int)])
+
+    def nearest(self, lat, lon, k=1, rings=None):
+        # Returns the k nearest stations to a point as (id, km) pairs, closest first
+        point, k, rings = to_xyz(lat, lon), min(k, len(self.ids)), {} if rings is None else rings
+        cell = tuple(np.floor(point / self.cell).astype(int).tolist())
+        idxs, chords = np.empty(0, int), np.empty(0)
+
+        # Stations in unsearched rings are at least r cells (of chord length) away
+        for r in range(MAX_RINGS + 1):
+            if (cell, r) not in rings: rings[(cell, r)] = self.ring(cell, r)
+            new = rings[(cell, r)]
+            if len(new):
+                idxs = np.concatenate([idxs, new])
+                chords = np.concatenate([chords, np.linalg.norm(self.xyz[new] - point, axis=1)])
+            if len(idxs) >= k and np.partition(chords, k - 1)[k - 1] <= r * self.cell: break
+
+        # Points far from every station scan them all instead (ring r has ~(2r+1)^3 cells)
+        else: idxs, chords = np.arange(len(self.ids)), np.linalg.norm(self.xyz - point, axis=1)
+
+        # Convert chord lengths to great-circle km
+        best = np.argsort(chords, kind="stable")[:k]
+        return [(self.ids[idxs[i]], float(2 * EARTH_KM * np.arcsin(min(chords[i] / 2, 1)))) for i in best]
+
+    def nearest_many(self, points, k=1):
+        # Returns nearest() for each (lat, lon) in points, sharing ring lookups between them
+        rings = {}
+        return [self.nearest(lat, lon, k, rings) for lat, lon in points]
+
+@lru_cache(maxsize=None)
+def get_station_index():
+    # Returns the index over the NBM stations table, built on first use
+    stations = load("stations")
+    return StationIndex([x.decode() for x in stations["id"]], stations["lat"], stations["lon"])
+
+def __getattr__(name):
+    # STATION_INDEX is built on first use
+    if name == "STATION_INDEX": return get_station_index()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,65 @@
+from functools import lru_cache
+import json
+from os import chmod, fdopen, getenv, path, remove, replace
+from tempfile import mkstemp
+import numpy as np
+
+# Dir of the JSON data maps and the .npy tables compiled from them
+# Build ahead of deploys with: python -m src.tables
+DATA_DIR = getenv("DATA_DIR", "static/data_maps")
+SOURCES = {"stations": "NBMstations.json", "icons": "icons.json"}
+
+def compile_stations(data):
+    # Returns NBM station id, lat and lon cols (other fields aren't used)
+    width = max([len(k) for k in data])
+    return np.array(
+        [(k, v["LAT"], v["LON"]) for k, v in data.items()],
+        dtype=[("id", f"S{width}"), ("lat", "f8"), ("lon", "f8")]
+    )
+
+def compile_icons(data):
+    # Returns icon rows in icons.json order; -1 hierarchy for icons without one
+    width = lambda f: max([len(str(v[f]).encode()) for v in data.values()])
+    return np.array(
+        [(k, v["day"], v["night"], v["description"], -1 if v["hierarchy"] is None else v["hierarchy"])
+         for k, v in data.items()],
+        dtype=[("name", f"S{max([len(k) for k in data])}"), ("day", f"S{width('day')}"),
+               ("night", f"S{width('night')}"), ("description", f"S{width('description')}"), ("hierarchy", "i4")]
+    )
+
+COMPILERS = {"stations": compile_stations, "icons": compile_icons}
+
+def compile_table(name):
+    # Returns a table compiled from its JSON source
+    with open(path.join(DATA_DIR, SOURCES[name])) as f: return COMPILERS[name](json.load(f))
+
+def build(name):
+    # Writes a compiled table next to its source (atomically so running workers never see
+    # a partial file). Each build writes its own temp file, as workers starting cold may
+    # build the same table at once
+    fd, part = mkstemp(dir=DATA_DIR, prefix=f"{name}.", suffix=".part")
+    try:
+        with fdopen(fd, "wb") as f: np.save(f, compile_table(name))
+        chmod(part, 0o644)
+        replace(part, path.join(DATA_DIR, f"{name}.npy"))
+    finally:
+        if path.exists(part): remove(part)
+
+@lru_cache(maxsize=None)
+def load(name):
+    # Returns a compiled table memory-mapped read-only, so forked workers share its pages
+    # Builds it first if it's missing or older than its source, or compiles it in memory if
+    # DATA_DIR isn't writable
+    src, npy = path.join(DATA_DIR, SOURCES[name]), path.join(DATA_DIR, f"{name}.npy")
+
+    if not path.exists(npy) or path.getmtime(npy) < path.getmtime(src):
+        try: build(name)
+        except OSError: return compile_table(name)
+
+    return np.load(npy, mmap_mode="r")
+
+
+if __name__ == "__main__":
+    for name in SOURCES:
+        build(name)
+        print(f"{name}: {len(load(name))} rows -> {path.join(DATA_DIR, name)}.npy")